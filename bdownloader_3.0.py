@@ -1,12 +1,41 @@
-from os import path, makedirs, remove, listdir
-from subprocess import run, Popen, PIPE, STDOUT, TimeoutExpired
-from time import sleep
-from json import loads, dumps
+from os import path, makedirs, remove, rmdir, listdir, link, replace, rename, stat, utime, getpid, cpu_count, walk
+from sys import argv
+from socket import gethostname
+from argparse import ArgumentParser
+from sys import platform as sys_platform
+from subprocess import run, Popen, PIPE, TimeoutExpired
+try:
+    from os import sched_getaffinity
+except ImportError:  # Windows/macOS
+    sched_getaffinity = None
+try:
+    from subprocess import BELOW_NORMAL_PRIORITY_CLASS
+except ImportError:  # 非Windows
+    BELOW_NORMAL_PRIORITY_CLASS = 0
+try:
+    from fcntl import flock, LOCK_EX, LOCK_UN
+except ImportError:  # Windows
+    flock = None
+try:
+    from msvcrt import locking, LK_LOCK, LK_UNLCK
+except ImportError:  # 非Windows
+    locking = None
+from time import sleep, time, monotonic
+from json import loads, dumps, dump
 from re import compile
 from uuid import uuid4
+from random import uniform
+from urllib.parse import urlparse
+from hashlib import sha256
+from struct import unpack
 from tqdm import tqdm
-from threading import RLock, Lock
-from asyncio import create_task, gather, Semaphore, run as asyncio_run, CancelledError, sleep as asyncio_sleep
+from threading import RLock, Lock, Thread, Event
+from collections import deque
+from asyncio import create_task, gather, Semaphore, Condition, run as asyncio_run, CancelledError, sleep as asyncio_sleep, get_running_loop
+from asyncio import TimeoutError as AsyncTimeoutError, Lock as AsyncLock, shield
+from functools import partial
+from types import SimpleNamespace
+from multiprocessing import get_context, get_all_start_methods
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from logging import basicConfig, FileHandler, StreamHandler, getLogger, INFO, ERROR, WARNING
 from configparser import ConfigParser
@@ -16,6 +45,7 @@ import shutil
 # 导入bilibili-api库
 from bilibili_api import Credential, cheese, video, sync
 from bilibili_api import login_v2
+from bilibili_api.exceptions import ResponseCodeException, NetworkException
 
 # 设置日志系统
 basicConfig(
@@ -112,19 +142,107 @@ def check_ffmpeg():
         print("请确保 FFmpeg 已正确安装")
         return False
 
+# 工作目录：临时文件(scratch)和输出可以分别放在不同的磁盘上，由 configure_workspace 设置
+SCRATCH_DIR = './download/temp'
+OUTPUT_DIR = './download'
+FAILED_DIR = './download/failed'
+QUARANTINE_DIR = './download/failed/quarantine'  # 合成失败的输入及其清单
+KEEP_FAILED_INPUTS = True
+SCRATCH_SUBDIR = 'bdownloader-tmp'  # 配置了 scratch_dir 时只使用并清空其中的这个子目录
+
+# path_a 是否为 path_b 本身或位于其下
+def path_within(path_a, path_b):
+    path_a, path_b = path.realpath(path_a), path.realpath(path_b)
+    try:
+        return path.commonpath([path_a, path_b]) == path_b
+    except ValueError:  # Windows 下位于不同盘符
+        return False
+
+def configure_workspace(config):
+    global SCRATCH_DIR, OUTPUT_DIR, FAILED_DIR, QUARANTINE_DIR, KEEP_FAILED_INPUTS
+    OUTPUT_DIR = config.get('General', 'output_dir', fallback='./download').strip() or './download'
+    FAILED_DIR = path.join(OUTPUT_DIR, 'failed')
+    QUARANTINE_DIR = path.join(FAILED_DIR, 'quarantine')
+    KEEP_FAILED_INPUTS = config.getboolean('General', 'keep_failed_inputs', fallback=True)
+    # 临时目录在启动和结束时会被清空：配置的目录只使用程序自己创建的子目录，
+    # 且配置的目录不能与输出目录、缓存目录互相包含，否则改用输出目录下的temp目录
+    default_scratch = path.join(OUTPUT_DIR, 'temp')
+    scratch_root = config.get('General', 'scratch_dir', fallback='').strip()
+    cache_dir = config.get('General', 'cache_dir', fallback='').strip()
+    SCRATCH_DIR = path.join(scratch_root, SCRATCH_SUBDIR) if scratch_root else default_scratch
+    for name, other in (('output_dir', OUTPUT_DIR), ('cache_dir', cache_dir)):
+        if scratch_root and other and (path_within(scratch_root, other) or path_within(other, scratch_root)):
+            logger.warning(f"scratch_dir 与 {name} 互相包含，改用输出目录下的temp目录")
+            SCRATCH_DIR = default_scratch
+            break
+    for other in (OUTPUT_DIR, cache_dir, config.get('General', 'deferred_queue_dir', fallback='').strip(),
+                  config.get('General', 'encode_spool_dir', fallback='').strip()):
+        if other and path_within(other, SCRATCH_DIR):
+            raise Exception(f"临时目录 {SCRATCH_DIR} 包含 {other}，清理临时目录时会删除其中的文件，请修改相关目录设置")
+    logger.info(f"临时目录: {SCRATCH_DIR}，输出目录: {OUTPUT_DIR}")
+
 # 创建下载目录
 def ensure_dirs():
-    if not path.exists('./download/temp'):
-        makedirs('./download/temp')
-    if not path.exists('./download/failed'):
-        makedirs('./download/failed')
+    makedirs(SCRATCH_DIR, exist_ok=True)
+    makedirs(FAILED_DIR, exist_ok=True)
+
+# 合成时先写到输出目录下的 .part 文件，成功后在同一文件系统内原子重命名
+def partial_output_path(output_file):
+    root, ext = path.splitext(output_file)
+    return f"{root}.part{ext}"
+
+# 临时空间记账：为每集预留预计占用的空间，合成完成后释放，避免写满临时目录所在的磁盘
+class ScratchSpace:
+    def __init__(self, root, max_bytes=0, min_free_bytes=0):
+        self.root = root
+        self.min_free_bytes = min_free_bytes
+        free = shutil.disk_usage(root).free
+        # 可用容量取配置上限和启动时剩余空间中较小者，并保留最小剩余空间
+        self.capacity = max(0, min(max_bytes, free) if max_bytes else free) - min_free_bytes
+        self.reserved = 0
+        self.peak_reserved = 0
+        self.condition = None
+
+    # 预留空间，不足时等待其他集释放；没有任何预留时总是放行，避免单集超过容量时死锁
+    async def acquire(self, nbytes):
+        if self.condition is None:
+            self.condition = Condition()
+        async with self.condition:
+            if self.reserved and self.reserved + nbytes > self.capacity:
+                logger.info(f"临时空间不足（已预留 {self.reserved / 1024 ** 3:.2f}GB，"
+                            f"需要 {nbytes / 1024 ** 3:.2f}GB，容量 {self.capacity / 1024 ** 3:.2f}GB），等待其他任务完成...")
+            await self.condition.wait_for(lambda: not self.reserved or self.reserved + nbytes <= self.capacity)
+            if nbytes > self.capacity:
+                logger.warning(f"单集预计需要 {nbytes / 1024 ** 3:.2f}GB 临时空间，超过可用容量 {self.capacity / 1024 ** 3:.2f}GB")
+            self.reserved += nbytes
+            self.peak_reserved = max(self.peak_reserved, self.reserved)
+
+    async def release(self, nbytes):
+        async with self.condition:
+            self.reserved = max(0, self.reserved - nbytes)
+            self.condition.notify_all()
+
+# 临时空间记账实例，由 main 创建
+scratch_space = None
+
+def init_scratch_space(config):
+    global scratch_space
+    max_gb = config.getfloat('General', 'scratch_max_gb', fallback=0)
+    min_free_gb = config.getfloat('General', 'scratch_min_free_gb', fallback=1)
+    scratch_space = ScratchSpace(SCRATCH_DIR, int(max_gb * 1024 ** 3), int(min_free_gb * 1024 ** 3))
+    logger.info(f"临时空间可用容量: {scratch_space.capacity / 1024 ** 3:.2f}GB")
+    return scratch_space
+
+# 根据DASH码率和时长估算一路流的大小（字节），无法估算时返回0
+def estimate_stream_bytes(stream, duration):
+    bandwidth = getattr(stream, 'bandwidth', 0) or 0
+    return int(bandwidth * (duration or 0) / 8)
 
 # 全局变量，用于管理进度条
 PROGRESS_BARS = {}
 PROGRESS_BAR_LOCK = RLock()  # 使用可重入锁
 
 # 预编译正则表达式，提高性能
-TIME_PATTERN = compile(r'(\d{2}):(\d{2}):(\d{2})')
 ILLEGAL_FILENAME_CHARS = compile(r'[<>:"/\\|?*]')
 
 # 加载配置文件
@@ -136,12 +254,67 @@ def load_config():
     default_config = {
         'General': {
             'concurrent_downloads': '2',
-            'concurrent_ffmpeg': '1',
+            'concurrent_ffmpeg': '0',       # 0为按CPU核心数和线程预算自动确定
             'gpu_mode': 'auto',  # 'auto', 'force_gpu', 'force_cpu'
             'convert_framerate': 'false',  # 新增：是否转换帧率
             'target_framerate': '30',       # 新增：目标帧率
             'max_retries': '3',             # 新增：最大重试次数
-            'retry_delay': '5'              # 新增：重试延迟
+            'retry_delay': '5',             # 新增：重试延迟
+            'retry_max_delay': '60',        # 新增：重试和限流退避的最长等待（秒）
+            'breaker_threshold': '5',       # 新增：同一CDN节点连续失败多少次后暂停使用
+            'breaker_cooldown': '60',       # 新增：CDN节点熔断后的暂停时长（秒）
+            'connect_timeout': '15',        # 新增：连接超时（秒）
+            'read_timeout': '20',           # 新增：读空闲超时（秒），超过此时长没有收到数据即断开续传
+            'min_speed_kb': '64',           # 新增：单个下载的最低持续速度（KB/s），0为不检测
+            'speed_window': '30',           # 新增：统计最低速度的时间窗口（秒）
+            'api_rate': '5',                # 新增：B站API每秒最多请求次数，被限流时自动降速
+            'api_burst': '10',              # 新增：API请求允许的突发次数
+            'api_url_ttl': '600',           # 新增：下载地址的缓存时间（秒），过期后重新获取
+            'download_processes': '0',      # 新增：下载工作进程数，0或1为在主进程中下载；高带宽下单进程CPU不足时调大
+            'max_download_speed_mb': '0',   # 新增：所有下载合计的带宽上限（MB/s），0为不限制
+            'encode_spool_dir': '',         # 新增：共享合成任务目录，设置后合成交给 encode-worker 进程执行，留空为本机合成
+            'encode_lease_seconds': '120',  # 新增：合成任务租约时长（秒），合成进程超过该时间未刷新则重新排队
+            'encode_claim_timeout': '600',  # 新增：合成任务无人领取的最长等待（秒），超时撤回任务改为本机合成，0为一直等待
+            'deferred_encode': 'false',     # 新增：延后转码，下载后先流复制保存，H265/帧率转换写入队列，之后用 transcode 命令集中处理
+            'deferred_queue_dir': '',       # 新增：延后转码队列目录，留空为输出目录下的 encode_queue
+            'encode_profile': 'default',    # 新增：编码配置，lecture 为幻灯片讲座优化（丢弃重复帧、可变帧率、长GOP），仅在H265转换时生效
+            'lecture_decimate': 'mpdecimate=hi=768:lo=320:frac=0.33',  # 新增：讲座配置判定重复帧的滤镜参数
+            'lecture_keyint_seconds': '10', # 新增：讲座配置强制关键帧的间隔（秒）
+            'lecture_x265_params': 'deblock=-3,-3:psy-rd=2.0:aq-strength=1.2',  # 新增：讲座配置的x265参数
+            'transcode_min_saving_ratio': '0.15',  # 新增：预计H265转码节省比例低于该值时直接流复制，0为不限制
+            'transcode_min_mb_per_minute': '2',    # 新增：每分钟编码时间预计节省的MB数低于该值时直接流复制，0为不限制
+            'transcode_bpp': '0.02',        # 新增：估算转码后大小时，参考复杂度下x265所需的每像素比特数
+            'head_fallback': 'true',        # 新增：下载响应中没有文件大小时，是否再发HEAD请求获取
+            'x265_preset': 'medium',        # 新增：libx265编码预设，可用 benchmarks/bench_ffmpeg.py 测定
+            'encoder_selection': 'profile', # 新增：profile 为按 calibrate 命令的校准结果选择编码器和预设，off 为固定使用 x265_preset
+            'encoder_size_target': '1.1',   # 新增：选择编码器时允许的输出大小，相对 x265_preset 下 libx265 输出的倍数
+            'encoder_codecs': 'hevc',       # 新增：可选用的输出编码，逗号分隔，可加入 av1 / h264
+            'encoder_max_psnr_loss': '0.5', # 新增：选择编码器时允许的画质损失，相对 x265_preset 下 libx265 的PSNR（dB）
+            'verify_downloads': 'true',     # 新增：下载时校验MP4结构并计算sha256
+            'cache_dir': '',                # 新增：原始音视频流缓存目录，留空则不缓存
+            'cache_max_gb': '50',           # 新增：缓存容量上限（GB），超出时淘汰最久未用的流
+            'chunk_workers': '0',           # 新增：长视频分段并行编码的进程数，0为自动，1为关闭
+            'chunk_min_duration': '1200',   # 新增：时长（秒）不短于此值的视频才分段编码
+            'chunk_seconds': '0',           # 新增：每段时长（秒），0为自动
+            'encode_threads': '0',          # 新增：每个合成进程的线程数，0为自动
+            'reserved_cores': '1',          # 新增：预留给下载和界面的CPU核心数
+            'encode_nice': '10',            # 新增：编码进程的nice值，0为不降低优先级
+            'encode_cpuset': '',            # 新增：把编码进程绑定到指定CPU（如 2-7），留空不绑定
+            'output_dir': './download',     # 新增：成品视频的保存目录
+            'keep_failed_inputs': 'true',   # 新增：合成失败时把已下载的音视频流移到 failed/quarantine 保留，可用 remerge 命令重新合成
+            'scratch_dir': '',              # 新增：临时文件目录，留空为输出目录下的temp；程序在其中创建 bdownloader-tmp 子目录，启动和结束时只清空该子目录
+            'scratch_max_gb': '0',          # 新增：临时目录最多占用的空间（GB），0为按剩余空间
+            'scratch_min_free_gb': '1',     # 新增：临时目录所在磁盘至少保留的剩余空间（GB）
+            'preflight': 'true',            # 新增：下载前获取每集码率和时长，估算下载量、磁盘占用和耗时
+            'schedule_order': 'longest_first',  # 新增：处理顺序，longest_first 按预计耗时从长到短，course 按课程顺序
+            'early_episodes': '0',          # 新增：longest_first 时，课程顺序的前N集仍最先处理，方便尽早观看
+            'output_format': 'mp4',         # 新增：输出格式，mp4 / fmp4（分片MP4，边写边可播放）/ mkv
+            'faststart': 'false',           # 新增：mp4 输出时把moov移到文件开头，便于网页播放，但需要完整重写一遍文件
+            'audio_only': 'false',          # 新增：仅下载音频，保存为独立音频文件
+            'extra_outputs': '',            # 新增：视频模式下每集额外生成的文件，逗号分隔：original（流复制的原始存档）/ audio（独立音频文件），与主输出在同一次ffmpeg中生成
+            'audio_codec': 'copy',          # 新增：仅音频模式的编码，copy（m4a，不重新编码）/ aac（m4a）/ opus
+            'audio_bitrate': '64k',         # 新增：仅音频模式重新编码时的码率
+            'audio_concurrent_downloads': '8'  # 新增：仅音频模式的默认并行下载数
         }
     }
     
@@ -283,16 +456,6 @@ def detect_video_framerate(video_path):
         logger.error(f"检测视频帧率时出错: {e}")
         return None
 
-# 解析时间为秒
-def parse_time_2_sec(s):
-    duration_match = TIME_PATTERN.search(s)
-    if not duration_match:
-        return 0
-    hours, minutes, seconds_milliseconds = duration_match.groups()
-    seconds = int(hours) * 3600 + int(minutes) * 60
-    seconds += int(seconds_milliseconds)
-    return seconds
-
 # 格式化标题，使进度条显示整齐
 def format_title(title, max_length=20):
     if len(title) > max_length:
@@ -349,74 +512,906 @@ class ProgressManager:
 # 初始化进度条管理器
 progress_mgr = ProgressManager()
 
+# 编码进程的优先级前缀和创建标志，由 configure_encoder_priority 设置
+ENCODER_PREFIX = ""
+ENCODER_CREATIONFLAGS = 0
+
+# 可用的CPU核心数（考虑进程亲和性限制）
+def usable_cpu_count():
+    if sched_getaffinity:
+        try:
+            return len(sched_getaffinity(0))
+        except OSError:
+            pass
+    return cpu_count() or 1
+
+# 根据核心数和每个编码的线程预算确定并行合成数，预留核心给下载和界面
+def plan_encode_budget(concurrent_ffmpeg=0, encode_threads=0, reserved_cores=1):
+    budget = max(1, usable_cpu_count() - reserved_cores)
+    if concurrent_ffmpeg <= 0 and encode_threads <= 0:
+        # libx265 单进程超过8线程后收益很小：按每个最多8线程确定进程数，再把核心平均分给各进程，
+        # 例如15个核心分为 2x7，而不是 1x8 让近一半核心空闲
+        concurrent_ffmpeg = -(-budget // 8)
+        encode_threads = budget // concurrent_ffmpeg
+    elif concurrent_ffmpeg <= 0:
+        concurrent_ffmpeg = max(1, budget // encode_threads)
+    elif encode_threads <= 0:
+        encode_threads = max(1, budget // concurrent_ffmpeg)
+    if concurrent_ffmpeg * encode_threads > budget:
+        logger.warning(f"编码线程总数 {concurrent_ffmpeg}x{encode_threads} 超过可用核心 {budget}，可能与下载争抢CPU")
+    logger.info(f"编码调度: 可用核心 {budget}（预留 {reserved_cores}），并行合成 {concurrent_ffmpeg} 个，每个 {encode_threads} 线程")
+    return concurrent_ffmpeg, encode_threads
+
+# 以较低的CPU/IO优先级运行编码进程，并可绑定到指定CPU集合，让下载和界面保持响应
+def configure_encoder_priority(nice_level=10, cpuset=''):
+    global ENCODER_PREFIX, ENCODER_CREATIONFLAGS
+    prefix = []
+    if sys_platform == 'win32':
+        ENCODER_CREATIONFLAGS = BELOW_NORMAL_PRIORITY_CLASS if nice_level > 0 else 0
+        if cpuset:
+            logger.warning("Windows 下暂不支持绑定编码进程的CPU集合")
+    else:
+        if nice_level > 0 and shutil.which('nice'):
+            prefix.append(f'nice -n {nice_level}')
+        if nice_level > 0 and shutil.which('ionice'):
+            prefix.append('ionice -c 2 -n 7')
+        if cpuset:
+            if shutil.which('taskset'):
+                prefix.append(f'taskset -c {cpuset}')
+            else:
+                logger.warning("未找到 taskset，忽略 encode_cpuset 设置")
+    ENCODER_PREFIX = ' '.join(prefix) + ' ' if prefix else ""
+    if ENCODER_PREFIX:
+        logger.info(f"编码进程将以低优先级运行: {ENCODER_PREFIX.strip()}")
+
+# 为编码命令加上优先级前缀
+def encoder_command(cmd_line):
+    return ENCODER_PREFIX + cmd_line
+
+# 输出封装格式，由 configure_output_format 设置
+# mp4: 普通MP4，moov在文件末尾，写完前无法播放
+# fmp4: 分片MP4，边写边可播放，不需要重写文件
+# mkv: Matroska，同样可以边写边播放
+OUTPUT_FORMATS = {
+    'mp4': ('.mp4', ''),
+    'fmp4': ('.mp4', '-movflags +frag_keyframe+empty_moov+default_base_moof'),
+    'mkv': ('.mkv', ''),
+}
+OUTPUT_FORMAT = 'mp4'
+OUTPUT_EXTENSION = '.mp4'
+OUTPUT_MUX_ARGS = ''
+# faststart 需要把整个文件再读写一遍，用于估算代价的磁盘速度（字节/秒）
+FASTSTART_DISK_SPEED = 200 * 1024 * 1024
+
+def configure_output_format(output_format='mp4', faststart=False):
+    global OUTPUT_FORMAT, OUTPUT_EXTENSION, OUTPUT_MUX_ARGS
+    if output_format not in OUTPUT_FORMATS:
+        logger.warning(f"未知的输出格式 {output_format}，使用 mp4")
+        output_format = 'mp4'
+    OUTPUT_FORMAT = output_format
+    OUTPUT_EXTENSION = OUTPUT_FORMATS[output_format][0]
+    OUTPUT_MUX_ARGS = output_mux_args(output_format, faststart)
+    if faststart and output_format != 'mp4':
+        logger.warning(f"faststart 只适用于 mp4 输出，{output_format} 格式忽略该设置")
+    logger.info(f"输出格式: {output_format} {OUTPUT_MUX_ARGS}".strip())
+
+# 按输出格式计算封装参数，不修改全局设置；合成进程中同时执行的任务可能使用不同的格式
+def output_mux_args(output_format='mp4', faststart=False):
+    mux_args = OUTPUT_FORMATS.get(output_format, OUTPUT_FORMATS['mp4'])[1]
+    if faststart and output_format == 'mp4':
+        mux_args = '-movflags +faststart'
+    return mux_args
+
+# 为输出文件加上封装参数，mux_args 为 None 时使用全局设置
+def output_target(output_file, mux_args=None):
+    return f'{OUTPUT_MUX_ARGS if mux_args is None else mux_args} "{output_file}"'.strip()
+
+# 汇总编码吞吐，用于检查并行合成数和线程预算的选择是否合理
+class EncodeStats:
+    def __init__(self):
+        self.lock = Lock()
+        self.count = 0
+        self.media_seconds = 0
+        self.busy_seconds = 0
+        self.first_start = None
+        self.last_end = None
+        self.skipped = 0
+        self.skipped_media_seconds = 0
+        self.extra_outputs = {}  # 附加输出 -> [成功数, 失败数]
+
+    # 预计收益不足、改为流复制的集数，统计编码速度时不计入
+    def skip_transcode(self, media_seconds, input_bytes=0):
+        with self.lock:
+            self.skipped += 1
+            self.skipped_media_seconds += media_seconds or 0
+
+    def extra_output(self, kind, ok):
+        with self.lock:
+            self.extra_outputs.setdefault(kind, [0, 0])[0 if ok else 1] += 1
+
+    def record(self, media_seconds, started, finished):
+        with self.lock:
+            self.count += 1
+            self.media_seconds += media_seconds or 0
+            self.busy_seconds += finished - started
+            self.first_start = started if self.first_start is None else min(self.first_start, started)
+            self.last_end = finished if self.last_end is None else max(self.last_end, finished)
+
+    def summary(self):
+        with self.lock:
+            if not self.count:
+                return None
+            span = max(self.last_end - self.first_start, 0.001)
+            return {
+                'episodes': self.count,
+                'media_seconds': self.media_seconds,
+                'wall_seconds': span,
+                'realtime_factor': self.media_seconds / span,
+                'busy_seconds': self.busy_seconds,
+                'average_parallelism': self.busy_seconds / span,
+                'skipped_transcodes': self.skipped,
+                'skipped_media_seconds': self.skipped_media_seconds,
+                'extra_outputs': {kind: tuple(counts) for kind, counts in self.extra_outputs.items()},
+            }
+
+encode_stats = EncodeStats()
+
+# 流完整性校验：ISO-BMFF(MP4/m4s)顶层box结构与滚动哈希
+# 可以作为文件第一个顶层box的类型，其他开头（例如HTML错误页）视为损坏
+FIRST_BOX_TYPES = {b'ftyp', b'styp', b'sidx', b'moov', b'moof', b'free', b'skip', b'mdat'}
+INTEGRITY_SUFFIX = '.integrity.json'
+
+class StreamCorruptError(Exception):
+    def __init__(self, message, offset):
+        super().__init__(message)
+        self.offset = offset
+
+# 边下载边解析顶层box头，只检查box边界，不拷贝数据；在每个完整box结束处记录检查点
+class StreamValidator:
+    def __init__(self, expected_size=0):
+        self.expected_size = expected_size
+        self.hasher = sha256()
+        self.offset = 0          # 已校验的字节数
+        self.box_end = 0         # 当前box的结束位置
+        self.header = b''        # 跨数据块的box头
+        self.boxes = 0
+        self.open_ended = False  # size为0的box一直延伸到文件末尾
+        self.checkpoint = (0, self.hasher.copy(), 0)
+
+    def feed(self, data):
+        view = memoryview(data)
+        pos = 0
+        total = len(view)
+        while pos < total:
+            # 处于box负载中：直接跳过负载，只更新哈希
+            if self.open_ended or self.offset < self.box_end:
+                step = total - pos if self.open_ended else min(self.box_end - self.offset, total - pos)
+                self.hasher.update(view[pos:pos + step])
+                self.offset += step
+                pos += step
+                if not self.open_ended and self.offset == self.box_end:
+                    self._box_done()
+                continue
+            # 读取box头（8字节，largesize时16字节）
+            need = 16 if len(self.header) >= 8 and unpack('>I', self.header[:4])[0] == 1 else 8
+            step = min(need - len(self.header), total - pos)
+            self.header += bytes(view[pos:pos + step])
+            self.hasher.update(view[pos:pos + step])
+            self.offset += step
+            pos += step
+            if len(self.header) < 8:
+                continue
+            size, box_type = unpack('>I4s', self.header[:8])
+            if size == 1 and len(self.header) < 16:
+                continue
+            self._check_header(size, box_type)
+
+    def _check_header(self, size, box_type):
+        header_len = len(self.header)
+        box_start = self.offset - header_len
+        if size == 1:
+            size = unpack('>Q', self.header[8:16])[0]
+        if any(c < 0x20 or c > 0x7e for c in box_type):
+            raise StreamCorruptError(f"偏移 {box_start} 处的box类型非法: {box_type!r}", box_start)
+        if self.boxes == 0 and box_type not in FIRST_BOX_TYPES:
+            raise StreamCorruptError(f"文件开头不是MP4结构（{box_type!r}），可能是错误页面", box_start)
+        self.header = b''
+        if size == 0:
+            self.open_ended = True
+            return
+        if size < header_len:
+            raise StreamCorruptError(f"偏移 {box_start} 处的box大小非法: {size}", box_start)
+        if self.expected_size and box_start + size > self.expected_size:
+            raise StreamCorruptError(f"偏移 {box_start} 处的box超出文件末尾: {box_type.decode()} {size}", box_start)
+        self.box_end = box_start + size
+        if self.offset == self.box_end:
+            self._box_done()
+
+    def _box_done(self):
+        self.boxes += 1
+        self.checkpoint = (self.offset, self.hasher.copy(), self.boxes)
+
+    # 回退到最后一个完整box的边界，返回该位置
+    def rollback(self):
+        self.offset, hasher, self.boxes = self.checkpoint
+        self.hasher = hasher.copy()
+        self.box_end = self.offset
+        self.header = b''
+        self.open_ended = False
+        return self.offset
+
+    # box结构完整时返回哈希值，否则返回None
+    def finish(self):
+        if self.boxes == 0 and not self.open_ended:
+            return None
+        if self.header or (not self.open_ended and self.offset != self.box_end):
+            return None
+        if self.expected_size and self.offset != self.expected_size:
+            return None
+        return self.hasher.hexdigest()
+
+# 用本地已有的部分文件恢复校验状态；结构损坏时截断到最后一个完整box
+def resume_validator(save_path, validator):
+    with open(save_path, 'rb+') as f:
+        while True:
+            block = f.read(1024 * 1024)
+            if not block:
+                break
+            try:
+                validator.feed(block)
+            except StreamCorruptError as e:
+                offset = validator.rollback()
+                logger.warning(f"本地文件已损坏（{e}），截断到 {offset} 字节: {save_path}")
+                f.truncate(offset)
+                break
+    return validator.offset
+
+def load_integrity(save_path):
+    try:
+        with open(save_path + INTEGRITY_SUFFIX, 'r', encoding='utf-8') as f:
+            return loads(f.read())
+    except (OSError, ValueError):
+        return None
+
+# 把校验结果写入与流文件同名的sidecar，供续传、缓存和合成前检查使用
+def save_integrity(save_path, url, expected_size, validator, digest=None):
+    record = {
+        'url': url.split('?')[0],
+        'expected_size': expected_size,
+        'verified_offset': validator.checkpoint[0],
+        'boxes': validator.boxes,
+        'complete': digest is not None,
+        'sha256': digest,
+    }
+    try:
+        with open(save_path + INTEGRITY_SUFFIX, 'w', encoding='utf-8') as f:
+            f.write(dumps(record, indent=2))
+    except OSError as e:
+        logger.warning(f"写入校验信息失败: {e}")
+    return record
+
+# 删除流文件及其校验sidecar
+def remove_stream_file(file_path):
+    for candidate in (file_path, file_path + INTEGRITY_SUFFIX):
+        if path.exists(candidate):
+            remove(candidate)
+
+# 计算文件的sha256
+def file_sha256(file_path):
+    hasher = sha256()
+    with open(file_path, 'rb') as f:
+        while True:
+            block = f.read(1024 * 1024)
+            if not block:
+                break
+            hasher.update(block)
+    return hasher.hexdigest()
+
+# 优先用硬链接（同一文件系统下零拷贝），失败时再复制
+def link_or_copy(src, dst):
+    if path.exists(dst):
+        remove(dst)
+    try:
+        link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+# 缓存键：同一集(cid)的同一路流在同一清晰度/编码下内容相同
+def stream_cache_key(cid, stream):
+    if hasattr(stream, 'video_quality'):
+        return f"{cid}-video-{stream.video_quality.value}-{getattr(stream.video_codecs, 'name', 'unknown')}"
+    if hasattr(stream, 'audio_quality'):
+        return f"{cid}-audio-{stream.audio_quality.value}"
+    return f"{cid}-stream-{sanitize_filename(stream.url.split('?')[0].rsplit('/', 1)[-1])}"
+
+# 跨进程的文件锁：同一进程内的线程先用线程锁排队，再对锁文件加系统锁；可重入
+class FileLock:
+    def __init__(self, lock_path):
+        self.lock_path = lock_path
+        self.thread_lock = RLock()
+        self.file = None
+        self.depth = 0
+
+    def __enter__(self):
+        self.thread_lock.acquire()
+        if self.depth == 0:
+            self.file = open(self.lock_path, 'a+b')
+            if flock:
+                flock(self.file.fileno(), LOCK_EX)
+            elif locking:
+                self.file.seek(0)
+                while True:
+                    try:
+                        locking(self.file.fileno(), LK_LOCK, 1)
+                        break
+                    except OSError:  # LK_LOCK 重试约10秒后仍被占用，继续等待
+                        continue
+        self.depth += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        self.depth -= 1
+        if self.depth == 0:
+            if flock:
+                flock(self.file.fileno(), LOCK_UN)
+            elif locking:
+                self.file.seek(0)
+                locking(self.file.fileno(), LK_UNLCK, 1)
+            self.file.close()
+            self.file = None
+        self.thread_lock.release()
+
+# 按内容寻址的原始音视频流缓存，跨课程、跨运行共享，超过容量时按最近最少使用淘汰；
+# 多个下载器实例可以共用同一个缓存目录，每次读-改-写索引都在文件锁内重新读取索引
+class StreamCache:
+    def __init__(self, root, max_bytes):
+        self.root = Path(root)
+        self.objects_dir = self.root / 'objects'
+        self.index_file = self.root / 'index.json'
+        self.max_bytes = max_bytes
+        makedirs(self.objects_dir, exist_ok=True)
+        self.lock = FileLock(self.root / 'index.lock')
+        with self.lock:
+            self.index = self._load_index()
+
+    def _load_index(self):
+        try:
+            with open(self.index_file, 'r', encoding='utf-8') as f:
+                index = loads(f.read())
+            if 'keys' in index and 'objects' in index:
+                return index
+        except (OSError, ValueError):
+            pass
+        return {'keys': {}, 'objects': {}}
+
+    def _save_index(self):
+        temp_file = f"{self.index_file}.{uuid4().hex}.tmp"
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            f.write(dumps(self.index, indent=1))
+        replace(temp_file, self.index_file)
+
+    def _object_path(self, digest):
+        return self.objects_dir / digest[:2] / digest
+
+    def total_bytes(self):
+        return sum(obj['size'] for obj in self.index['objects'].values())
+
+    # 命中时把缓存对象放到dest并返回True
+    def fetch(self, key, dest):
+        with self.lock:
+            self.index = self._load_index()
+            digest = self.index['keys'].get(key)
+            obj = self.index['objects'].get(digest) if digest else None
+            if not obj:
+                return False
+            blob = self._object_path(digest)
+            if not blob.exists() or blob.stat().st_size != obj['size']:
+                logger.warning(f"缓存对象丢失或已损坏，忽略: {key}")
+                self._drop_object(digest)
+                self._save_index()
+                return False
+            link_or_copy(blob, dest)
+            obj['last_used'] = time()
+            self._save_index()
+            logger.info(f"命中下载缓存: {key} ({obj['size']} 字节)")
+            return True
+
+    # 把下载完成的流加入缓存；优先使用下载时记录的sha256，避免重复读取文件
+    def store(self, key, file_path, digest=None):
+        try:
+            size = path.getsize(file_path)
+            if size > self.max_bytes:
+                logger.info(f"文件超过缓存容量，不缓存: {key}")
+                return False
+            if not digest:
+                record = load_integrity(file_path)
+                digest = record.get('sha256') if record and record.get('complete') else file_sha256(file_path)
+            with self.lock:
+                self.index = self._load_index()
+                blob = self._object_path(digest)
+                if digest not in self.index['objects'] or not blob.exists():
+                    makedirs(blob.parent, exist_ok=True)
+                    link_or_copy(file_path, blob)
+                self.index['objects'][digest] = {'size': size, 'last_used': time()}
+                self.index['keys'][key] = digest
+                self._evict(keep=digest)
+                self._save_index()
+            return True
+        except Exception as e:
+            logger.warning(f"写入下载缓存失败，不影响下载: {e}")
+            return False
+
+    def _drop_object(self, digest):
+        self.index['objects'].pop(digest, None)
+        for key in [k for k, d in self.index['keys'].items() if d == digest]:
+            del self.index['keys'][key]
+        blob = self._object_path(digest)
+        if blob.exists():
+            remove(blob)
+
+    # 按最近使用时间淘汰，直到总大小不超过上限
+    def _evict(self, keep=None):
+        total = self.total_bytes()
+        candidates = sorted((obj['last_used'], digest) for digest, obj in self.index['objects'].items() if digest != keep)
+        for _, digest in candidates:
+            if total <= self.max_bytes:
+                break
+            total -= self.index['objects'][digest]['size']
+            logger.info(f"下载缓存超出容量，淘汰: {digest[:16]}")
+            self._drop_object(digest)
+
+# 下载缓存实例，未配置 cache_dir 时为None
+stream_cache = None
+
+def init_stream_cache(config):
+    global stream_cache
+    cache_dir = config.get('General', 'cache_dir', fallback='').strip()
+    if not cache_dir:
+        stream_cache = None
+        return None
+    max_gb = config.getfloat('General', 'cache_max_gb', fallback=50)
+    stream_cache = StreamCache(cache_dir, int(max_gb * 1024 ** 3))
+    logger.info(f"已启用下载缓存: {cache_dir}（上限 {max_gb}GB，当前 {stream_cache.total_bytes() / 1024 ** 3:.2f}GB）")
+    return stream_cache
+
+# 下载重试策略：按错误类型决定处理方式
+# expired: 链接过期或失效(403/404/410)，重新获取下载地址后续传
+# rate_limited: 被限流(412/429)，所有下载一起退避
+# transient: 网络中断、超时、5xx、数据损坏，带抖动退避后从断点续传
+# fatal: 本地磁盘错误和其他4xx，立即失败，不浪费重试次数
+RETRY_MAX_DELAY = 60
+
+class DownloadHTTPError(Exception):
+    def __init__(self, status, url):
+        super().__init__(f"HTTP错误: {status}")
+        self.status = status
+        self.url = url
+
+class DownloadIncompleteError(Exception):
+    pass
+
+# 速度持续低于下限时主动断开，按断点续传（可能换到其他节点）
+class DownloadStalledError(DownloadIncompleteError):
+    pass
+
+# 连接超时和读空闲超时（秒），以及最低持续速度（字节/秒）和统计窗口（秒）
+CONNECT_TIMEOUT = 15
+READ_TIMEOUT = 20
+MIN_SPEED = 64 * 1024
+SPEED_WINDOW = 30
+# GET响应中没有文件大小时是否用HEAD请求补充
+HEAD_FALLBACK = True
+
+# 最低速度看门狗：统计最近一个窗口内收到的字节数，窗口填满后速度仍低于下限即判定为卡住
+class ThroughputWatchdog:
+    def __init__(self, min_speed=MIN_SPEED, window=SPEED_WINDOW):
+        self.min_speed = min_speed
+        self.window = window
+        self.started = monotonic()
+        self.total = 0
+        self.samples = deque([(self.started, 0)])
+        self.last_check = self.started
+
+    # 记录收到的数据，返回当前窗口速度低于下限时的速度，否则返回None
+    def feed(self, nbytes):
+        self.total += nbytes
+        now = monotonic()
+        if not self.min_speed or now - self.last_check < 1:
+            return None
+        self.last_check = now
+        self.samples.append((now, self.total))
+        while len(self.samples) > 1 and now - self.samples[1][0] >= self.window:
+            self.samples.popleft()
+        oldest_time, oldest_total = self.samples[0]
+        if now - self.started < self.window or now - oldest_time < self.window:
+            return None
+        speed = (self.total - oldest_total) / (now - oldest_time)
+        return speed if speed < self.min_speed else None
+
+    # 主动等待（如带宽预算限速）的时间不计入窗口
+    def pause(self, seconds):
+        self.started += seconds
+        self.samples = deque((t + seconds, total) for t, total in self.samples)
+
+def classify_download_error(error):
+    from aiohttp import ClientError
+    if isinstance(error, DownloadHTTPError):
+        if error.status in (403, 404, 410):
+            return 'expired'
+        if error.status in (412, 429):
+            return 'rate_limited'
+        if error.status >= 500 or error.status == 408:
+            return 'transient'
+        return 'fatal'
+    if isinstance(error, (ClientError, AsyncTimeoutError, StreamCorruptError, DownloadIncompleteError)):
+        return 'transient'
+    if isinstance(error, OSError):
+        return 'fatal'
+    return 'transient'
+
+# 指数退避加随机抖动，避免多个下载同时重试
+def backoff_delay(attempt, base_delay, max_delay=RETRY_MAX_DELAY):
+    delay = min(max_delay, base_delay * 2 ** attempt)
+    return delay / 2 + uniform(0, delay / 2)
+
+# 全局限流闸门：任一下载被限流时，所有下载在恢复时间前暂停发起请求
+# 传入 context 时状态 [恢复时刻, 惩罚秒数] 放在共享内存中，多进程下载时一个进程被限流，所有进程一起暂停
+class RateLimitGate:
+    def __init__(self, context=None):
+        self.state = context.Array('d', 2) if context else [0.0, 0.0]
+        self.lock = self.state.get_lock() if context else Lock()
+
+    async def wait(self):
+        delay = self.state[0] - time()
+        if delay > 0:
+            await asyncio_sleep(delay)
+
+    # 连续被限流时惩罚时间加倍，返回需要等待的秒数
+    def backoff(self, base_delay, max_delay=RETRY_MAX_DELAY):
+        with self.lock:
+            penalty = min(max_delay, max(base_delay, self.state[1] * 2))
+            self.state[1] = penalty
+            self.state[0] = max(self.state[0], time() + penalty / 2 + uniform(0, penalty / 2))
+            return self.state[0] - time()
+
+    def success(self):
+        self.state[1] = 0
+
+rate_limit_gate = RateLimitGate()
+
+# 按节点(主机:端口)的熔断器：同一CDN节点连续失败达到阈值后暂停使用一段时间，改用备用链接
+# 传入 manager 时失败计数放在管理进程中，多进程下载时所有进程共用各节点的熔断状态
+class HostCircuitBreaker:
+    def __init__(self, threshold=5, cooldown=60, manager=None):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = manager.dict() if manager else {}
+        self.open_until = manager.dict() if manager else {}
+        self.lock = manager.Lock() if manager else Lock()
+
+    def allow(self, host):
+        return time() >= self.open_until.get(host, 0)
+
+    def record_success(self, host):
+        with self.lock:
+            self.failures.pop(host, None)
+            self.open_until.pop(host, None)
+
+    def record_failure(self, host):
+        with self.lock:
+            failures = self.failures.get(host, 0) + 1
+            if failures >= self.threshold:
+                self.open_until[host] = time() + self.cooldown
+                # 冷却结束后只试探一次，再失败立即重新熔断
+                failures = self.threshold - 1
+                logger.warning(f"CDN节点 {host} 连续失败，暂停使用 {self.cooldown} 秒")
+            self.failures[host] = failures
+
+    # 从候选链接中选出第一个未熔断的，全部熔断时等待最早恢复的节点
+    async def pick(self, urls):
+        for url in urls:
+            if self.allow(urlparse(url).netloc):
+                return url
+        wait = min(self.open_until.get(urlparse(url).netloc, 0) for url in urls) - time()
+        if wait > 0:
+            logger.info(f"所有CDN节点都处于熔断状态，等待 {wait:.0f} 秒")
+            await asyncio_sleep(wait)
+        return urls[0]
+
+host_breaker = HostCircuitBreaker()
+
+def configure_retry_policy(config):
+    global RETRY_MAX_DELAY, CONNECT_TIMEOUT, READ_TIMEOUT, MIN_SPEED, SPEED_WINDOW, HEAD_FALLBACK
+    RETRY_MAX_DELAY = config.getint('General', 'retry_max_delay', fallback=60)
+    CONNECT_TIMEOUT = config.getint('General', 'connect_timeout', fallback=15)
+    READ_TIMEOUT = config.getint('General', 'read_timeout', fallback=20)
+    MIN_SPEED = int(config.getfloat('General', 'min_speed_kb', fallback=64) * 1024)
+    SPEED_WINDOW = config.getint('General', 'speed_window', fallback=30)
+    HEAD_FALLBACK = config.getboolean('General', 'head_fallback', fallback=True)
+    host_breaker.threshold = config.getint('General', 'breaker_threshold', fallback=5)
+    host_breaker.cooldown = config.getint('General', 'breaker_cooldown', fallback=60)
+
+# B站API访问层：令牌桶限速、合并相同的进行中请求、缓存结果，遇到风控码时自动降速退避
+# 风控/限流时接口返回的错误码
+RATE_LIMIT_CODES = {-352, -412, -509, -799}
+
+def is_api_rate_limited(error):
+    if isinstance(error, ResponseCodeException):
+        return error.code in RATE_LIMIT_CODES
+    if isinstance(error, NetworkException):
+        return error.status in (412, 429)
+    return False
+
+class ApiClient:
+    def __init__(self, rate=5.0, burst=10, url_ttl=600, max_retries=5):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = monotonic()
+        self.paused_until = 0
+        self.url_ttl = url_ttl
+        self.max_retries = max_retries
+        self.inflight = {}
+        self.cache = {}
+        self.listed = set()  # 课程列表中出现过的单集，其元数据已随列表返回
+        self.lock = None
+        self.stats = {'calls': 0, 'cache_hits': 0, 'coalesced': 0, 'rate_limited': 0}
+
+    # 令牌桶：按当前速率补充令牌，没有令牌时等待；被限流后的暂停期内不发请求
+    async def acquire(self):
+        if self.lock is None:
+            self.lock = AsyncLock()
+        async with self.lock:
+            while True:
+                now = monotonic()
+                if now < self.paused_until:
+                    await asyncio_sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio_sleep((1 - self.tokens) / self.rate)
+
+    # 加性增、乘性减：成功时缓慢提速到上限，被限流时速率减半并暂停
+    def on_success(self):
+        self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+    def on_rate_limited(self, attempt):
+        self.stats['rate_limited'] += 1
+        self.rate = max(0.2, self.rate / 2)
+        self.tokens = 0
+        pause = backoff_delay(attempt, 2)
+        self.paused_until = max(self.paused_until, monotonic() + pause)
+        return pause
+
+    async def fetch(self, key, factory, ttl):
+        for attempt in range(self.max_retries):
+            await self.acquire()
+            self.stats['calls'] += 1
+            try:
+                result = await factory()
+            except Exception as e:
+                if not is_api_rate_limited(e) or attempt == self.max_retries - 1:
+                    raise
+                pause = self.on_rate_limited(attempt)
+                logger.warning(f"API请求被限流（{e}），速率降至 {self.rate:.2f}次/秒，暂停 {pause:.1f} 秒")
+                continue
+            self.on_success()
+            self.cache[key] = (monotonic() + ttl if ttl else None, result)
+            return result
+
+    # 先查缓存，再合并相同的进行中请求；fresh 为 True 时跳过缓存，但仍与进行中的刷新请求合并
+    async def call(self, key, factory, ttl=None, fresh=False):
+        if not fresh:
+            cached = self.cache.get(key)
+            if cached and (cached[0] is None or cached[0] > monotonic()):
+                self.stats['cache_hits'] += 1
+                return cached[1]
+        task = self.inflight.get((key, fresh))
+        if task:
+            self.stats['coalesced'] += 1
+        else:
+            task = create_task(self.fetch(key, factory, ttl))
+            self.inflight[(key, fresh)] = task
+            task.add_done_callback(lambda _, flight=(key, fresh): self.inflight.pop(flight, None))
+        return await shield(task)
+
+    # 课程信息和列表默认一直缓存；同步时用 fresh=True 重新获取，以发现新增的集数
+    async def course_meta(self, course, fresh=False):
+        return await self.call(('course_meta', getattr(course, 'season_id', id(course))), course.get_meta, fresh=fresh)
+
+    async def course_list(self, course, fresh=False):
+        episodes = await self.call(('course_list', getattr(course, 'season_id', id(course))), course.get_list, fresh=fresh)
+        self.listed.update(ep.get_epid() for ep in episodes)
+        return episodes
+
+    # 课程列表中的单集直接读取列表返回的元数据，不发请求，也不占用令牌
+    async def episode_meta(self, ep):
+        if ep.get_epid() in self.listed:
+            return await self.listed_episode_meta(ep)
+        return await self.call(('episode_meta', ep.get_epid()), ep.get_meta)
+
+    # 课程列表接口已返回各集的元数据（bilibili_api 保存在单集对象中），直接读取并更新缓存，不占用请求配额
+    async def listed_episode_meta(self, ep):
+        result = await ep.get_meta()
+        self.cache[('episode_meta', ep.get_epid())] = (None, result)
+        return result
+
+    # 下载地址有时效，只缓存 url_ttl 秒；链接过期重新获取时使用 fresh=True
+    async def download_url(self, ep, fresh=False):
+        return await self.call(('download_url', ep.get_epid()), ep.get_download_url, self.url_ttl, fresh)
+
+api_client = ApiClient()
+
+def init_api_client(config):
+    global api_client
+    api_client = ApiClient(
+        config.getfloat('General', 'api_rate', fallback=5),
+        config.getint('General', 'api_burst', fallback=10),
+        config.getint('General', 'api_url_ttl', fallback=600)
+    )
+    return api_client
+
+# 解析 "bytes start-end/total"，返回 (start, total)，总大小未知时为0
+def parse_content_range(header):
+    try:
+        unit, _, spec = (header or '').partition(' ')
+        byte_range, _, total = spec.partition('/')
+        start = 0 if byte_range == '*' else int(byte_range.split('-')[0])
+        return start, int(total) if total not in ('', '*') else 0
+    except ValueError:
+        return 0, 0
+
+# 从GET响应中取得本次数据的起始位置和文件总大小
+def response_file_size(response):
+    if response.status == 206:
+        return parse_content_range(response.headers.get('Content-Range'))
+    return 0, int(response.headers.get('Content-Length', 0) or 0)
+
+# 响应中没有大小信息时，用HEAD请求获取文件大小
+async def head_file_size(session, url, headers):
+    head_headers = {key: value for key, value in headers.items() if key != 'Range'}
+    try:
+        async with session.head(url, headers=head_headers) as response:
+            if response.status < 400:
+                return int(response.headers.get('Content-Length', 0) or 0)
+    except Exception as e:
+        logger.warning(f"HEAD请求失败: {e}")
+    return 0
+
 # 下载文件 - 增强错误处理和重试机制
-async def download_file(url, save_path, desc, task_index, total_tasks, task_type, max_retries=3, retry_delay=5):
+# backup_urls 为备用链接；resolve_urls 为重新获取 [主链接, 备用链接...] 的协程函数，链接过期时调用
+async def download_file(url, save_path, desc, task_index, total_tasks, task_type, max_retries=3, retry_delay=5, verify=True,
+                        backup_urls=(), resolve_urls=None):
     headers = {
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
         "Referer": "https://www.bilibili.com/",
     }
     
-    from aiohttp import ClientSession, ClientPayloadError, ClientResponseError, ServerDisconnectedError
+    from aiohttp import ClientSession, ClientTimeout, ClientPayloadError, ServerDisconnectedError
     progress_bar_key = f"download_{task_index}_{task_type}"
     
     # 添加重试机制
     retry_count = 0
+    candidates = [url, *backup_urls]
     
     while retry_count < max_retries:
+        await rate_limit_gate.wait()
+        url = await host_breaker.pick(candidates)
         try:
             # 检查是否已存在部分下载的文件
             downloaded = 0
+            validator = StreamValidator() if verify else None
             if path.exists(save_path):
+                if validator:
+                    # 用本地数据恢复滚动哈希和box状态，损坏部分会被截断
+                    resume_validator(save_path, validator)
                 downloaded = path.getsize(save_path)
                 logger.info(f"发现已下载文件: {save_path}，大小: {downloaded} 字节")
             
-            # 获取文件大小
-            async with ClientSession() as session:
-                async with session.head(url, headers=headers) as response:
-                    file_size = int(response.headers.get('content-length', 0))
-            
-                # 如果文件已下载完成，则跳过
-                if downloaded == file_size and file_size > 0:
+            # 上次已完整下载并校验过的文件，本地重新计算的哈希与记录一致时无需再发请求
+            record = load_integrity(save_path) if validator and downloaded else None
+            if record and record.get('complete') and record.get('expected_size') == downloaded:
+                validator.expected_size = downloaded
+                if validator.finish() == record.get('sha256'):
                     logger.info(f"文件已完整下载，跳过: {save_path}")
                     return True
             
-                # 创建目录（如果不存在）
-                makedirs(path.dirname(save_path), exist_ok=True)
-            
-                # 创建进度条
-                position = task_index % 10
-                progress_bar = progress_mgr.create_bar(
-                    progress_bar_key,
-                    file_size, 
-                    f'[{task_index}/{total_tasks}] {desc} {task_type}',
-                    position
-                )
+            # 创建目录（如果不存在）
+            makedirs(path.dirname(save_path), exist_ok=True)
             
-                # 如果文件已部分下载，则设置进度条初始值
-                if downloaded > 0:
-                    progress_bar.update(downloaded)
-                    headers['Range'] = f'bytes={downloaded}-'
-                    logger.info(f"从断点 {downloaded}/{file_size} 字节继续下载...")
-                else:
-                    # 确保没有Range头（如果是第一次尝试）
-                    if 'Range' in headers:
-                        del headers['Range']
+            # 直接发起GET，文件大小取自响应的 Content-Range/Content-Length，不再单独发HEAD
+            if downloaded > 0:
+                headers['Range'] = f'bytes={downloaded}-'
+                logger.info(f"从断点 {downloaded} 字节继续下载...")
+            else:
+                # 确保没有Range头（如果是第一次尝试）
+                headers.pop('Range', None)
+            file_size = 0
+            size_from_head = False
             
+            # 设置连接和读空闲超时，避免卡住的连接长期占用下载名额
+            timeout = ClientTimeout(total=None, sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT)
+            async with ClientSession(timeout=timeout) as session:
                 # 下载文件
                 mode = 'ab' if downloaded > 0 else 'wb'  # 如果已部分下载，则使用追加模式
                 try:
                     async with session.get(url, headers=headers) as response:
+                        if response.status == 416 and downloaded > 0:
+                            # 断点已在文件末尾：本地文件已完整，服务器在 Content-Range 中给出实际大小
+                            _, file_size = parse_content_range(response.headers.get('Content-Range'))
+                            if file_size != downloaded:
+                                remove_stream_file(save_path)
+                                raise DownloadIncompleteError(f"本地文件大小 {downloaded} 与服务器 {file_size} 不一致，重新下载")
+                            if validator:
+                                validator.expected_size = file_size
                         # 检查响应状态
-                        if response.status != 200 and response.status != 206:
-                            raise Exception(f"HTTP错误: {response.status}")
-                        
-                        with open(save_path, mode) as f:
-                            chunk_size = 32768
-                            async for chunk in response.content.iter_chunked(chunk_size):
-                                if not chunk:
-                                    break
-                                f.write(chunk)
-                                progress_mgr.update_bar(progress_bar_key, len(chunk))
+                        elif response.status != 200 and response.status != 206:
+                            raise DownloadHTTPError(response.status, url)
+                        else:
+                            # 节点能正常响应就清零连续失败计数，只有持续失败的节点才会熔断
+                            host_breaker.record_success(urlparse(url).netloc)
+                            rate_limit_gate.success()
+                            
+                            start, file_size = response_file_size(response)
+                            # 请求了断点续传但服务器返回了完整文件，从头写入，避免重复数据
+                            if downloaded > 0 and response.status == 200:
+                                logger.warning(f"服务器未按Range返回数据，从头重新下载: {save_path}")
+                                mode = 'wb'
+                                downloaded = 0
+                                if validator:
+                                    validator = StreamValidator()
+                            elif start != downloaded:
+                                remove_stream_file(save_path)
+                                raise DownloadIncompleteError(f"服务器返回的起始位置 {start} 与断点 {downloaded} 不一致，重新下载")
+                            # 响应中没有大小信息时才回退到HEAD；HEAD的大小可能不准确，不交给校验器做精确比较
+                            if not file_size and HEAD_FALLBACK:
+                                file_size = await head_file_size(session, url, headers)
+                                size_from_head = True
+                            elif validator:
+                                validator.expected_size = file_size
+                            
+                            # 创建进度条，并设置已下载部分的初始值
+                            position = task_index % 10
+                            progress_bar = progress_mgr.create_bar(
+                                progress_bar_key,
+                                file_size or None, 
+                                f'[{task_index}/{total_tasks}] {desc} {task_type}',
+                                position
+                            )
+                            if downloaded > 0:
+                                progress_bar.update(downloaded)
+                            
+                            # 最后一次重试不再限速，避免整体网速低于下限时无法完成
+                            watchdog = ThroughputWatchdog(MIN_SPEED if retry_count < max_retries - 1 else 0, SPEED_WINDOW)
+                            with open(save_path, mode) as f:
+                                chunk_size = 32768
+                                async for chunk in response.content.iter_chunked(chunk_size):
+                                    if not chunk:
+                                        break
+                                    slow_speed = watchdog.feed(len(chunk))
+                                    if slow_speed is not None:
+                                        raise DownloadStalledError(
+                                            f"最近 {SPEED_WINDOW} 秒速度仅 {slow_speed / 1024:.1f}KB/s，低于 {MIN_SPEED / 1024:.0f}KB/s，断开后续传")
+                                    if validator:
+                                        try:
+                                            validator.feed(chunk)
+                                        except StreamCorruptError:
+                                            # 只丢弃最后一个完整box之后的数据，下次从该位置续传
+                                            f.flush()
+                                            f.truncate(validator.rollback())
+                                            raise
+                                    f.write(chunk)
+                                    progress_mgr.update_bar(progress_bar_key, len(chunk))
+                                    # 超出总带宽预算时等待，等待时间不计入低速检测
+                                    if bandwidth_budget:
+                                        wait = bandwidth_budget.take(len(chunk))
+                                        if wait:
+                                            await asyncio_sleep(wait)
+                                            watchdog.pause(wait)
                 except CancelledError:
                     logger.warning(f"下载任务被取消: {save_path}")
                     raise
@@ -433,53 +1428,318 @@ async def download_file(url, save_path, desc, task_index, total_tasks, task_type
             
             # 检查文件完整性
             actual_size = path.getsize(save_path)
+            if validator:
+                digest = validator.finish()
+                # HEAD报告的大小只做2%的容差检查，记录实际大小供下次跳过校验
+                if size_from_head:
+                    if file_size and actual_size < file_size * 0.98:
+                        digest = None
+                    elif digest:
+                        file_size = actual_size
+                save_integrity(save_path, url, file_size, validator, digest)
+                if digest is None:
+                    # 保留已校验的数据，下次重试从断点续传
+                    raise DownloadIncompleteError(f"下载不完整（{actual_size}/{file_size} 字节，已校验到 {validator.checkpoint[0]}），将从断点续传")
+                logger.info(f"✓ 完成下载: [{task_index}/{total_tasks}] {desc} {task_type} (sha256: {digest[:16]})")
+                return True
             if file_size > 0 and actual_size != file_size:
                 logger.warning(f"文件大小不匹配，预期: {file_size}，实际: {actual_size}")
                 
-                # 如果差异大于2%，则删除文件并重试
-                if actual_size < file_size * 0.98:
-                    logger.info(f"删除不完整文件并重试: {save_path}")
-                    try:
-                        remove(save_path)
-                    except:
-                        pass
-                    raise Exception(f"下载不完整，需要重新下载")
-                else:
-                    # 差异小于2%，可能服务器报告不准确，接受文件
+                # HEAD报告的大小可能不准确，差异小于2%时接受；GET响应中的大小是准确的，不足时从断点续传
+                if size_from_head and actual_size >= file_size * 0.98:
                     logger.info(f"接受文件，差异在可接受范围内")
-                    return True
+                else:
+                    if actual_size > file_size:
+                        logger.info(f"删除大小异常的文件并重试: {save_path}")
+                        remove(save_path)
+                    raise DownloadIncompleteError(f"下载不完整（{actual_size}/{file_size} 字节），将从断点续传")
             else:
                 logger.info(f"✓ 完成下载: [{task_index}/{total_tasks}] {desc} {task_type}")
-                return True
+            return True
                 
-        except (ClientResponseError, ServerDisconnectedError) as e:
-            logger.error(f"网络错误: {e}")
-            retry_count += 1
-            if retry_count < max_retries:
-                logger.info(f"将在 {retry_delay} 秒后重试 ({retry_count}/{max_retries})")
-                await asyncio_sleep(retry_delay)
-                # 指数退避策略，增加重试间隔
-                retry_delay *= 2
-            else:
-                logger.error(f"下载失败: [{task_index}] {desc} - 重试次数用尽")
-                raise
+        except CancelledError:
+            progress_mgr.close_bar(progress_bar_key)
+            raise
         except Exception as e:
-            logger.error(f"下载失败: [{task_index}] {desc} - {e}")
+            progress_mgr.close_bar(progress_bar_key)
+            kind = classify_download_error(e)
             retry_count += 1
-            if retry_count < max_retries:
-                logger.info(f"将在 {retry_delay} 秒后重试 ({retry_count}/{max_retries})")
-                await asyncio_sleep(retry_delay)
-                # 指数退避策略，增加重试间隔
-                retry_delay *= 2
-            else:
-                logger.error(f"下载失败: [{task_index}] {desc} - 重试次数用尽")
+            if kind == 'fatal':
+                logger.error(f"下载失败: [{task_index}] {desc} - {e}（不可重试的错误）")
+                raise
+            if retry_count >= max_retries:
+                logger.error(f"下载失败: [{task_index}] {desc} - {e}，重试次数用尽")
                 raise
+            
+            delay = 0
+            if kind == 'expired':
+                if resolve_urls:
+                    logger.warning(f"下载链接已失效（{e}），重新获取下载地址")
+                    try:
+                        candidates = await resolve_urls()
+                    except Exception as resolve_error:
+                        logger.error(f"重新获取下载地址失败: {resolve_error}")
+                        delay = backoff_delay(retry_count - 1, retry_delay)
+                else:
+                    # 无法重新获取时轮换到下一个备用链接
+                    candidates = candidates[1:] + candidates[:1]
+            elif kind == 'rate_limited':
+                pause = rate_limit_gate.backoff(retry_delay)
+                logger.warning(f"下载被限流（{e}），所有下载暂停 {pause:.1f} 秒")
+            else:
+                host_breaker.record_failure(urlparse(url).netloc)
+                delay = backoff_delay(retry_count - 1, retry_delay)
+                # 有备用链接时下次先换一个节点尝试，换到其他可用节点时不必等待
+                if url in candidates and len(candidates) > 1:
+                    index = candidates.index(url)
+                    candidates = candidates[index + 1:] + candidates[:index + 1]
+                    next_host = urlparse(candidates[0]).netloc
+                    if next_host != urlparse(url).netloc and host_breaker.allow(next_host):
+                        logger.info(f"改用备用链接: {next_host}")
+                        delay = 0
+                logger.error(f"下载失败: [{task_index}] {desc} - {e}")
+            if delay:
+                logger.info(f"将在 {delay:.1f} 秒后重试 ({retry_count}/{max_retries})")
+                await asyncio_sleep(delay)
     
     # 重试次数用尽
     logger.error(f"下载失败: [{task_index}] {desc} - 重试{max_retries}次后失败")
     progress_mgr.close_bar(progress_bar_key)
     raise Exception(f"重试{max_retries}次后下载失败")
 
+# 多进程下载：单个事件循环在高带宽下会先被CPU（TLS解密、分块处理、进度更新）卡住，
+# 这里把各条流的下载分散到多个工作进程，每个进程有自己的事件循环和连接；
+# 父进程负责分配任务、重新获取下载地址、显示进度条，并持有所有进程共享的带宽预算
+def process_context():
+    return get_context('fork' if 'fork' in get_all_start_methods() else 'spawn')
+
+# 所有进程共享的带宽预算，按"下一个可用时刻"排队，超出预算的进程等待相应时间
+class BandwidthBudget:
+    def __init__(self, rate, burst_seconds=0.5, context=None):
+        self.rate = rate  # 字节/秒
+        self.burst_seconds = burst_seconds
+        self.next_free = (context or process_context()).Value('d', 0.0)
+
+    def take(self, nbytes):
+        with self.next_free.get_lock():
+            now = monotonic()
+            start = max(self.next_free.value, now - self.burst_seconds)
+            self.next_free.value = start + nbytes / self.rate
+            return max(0, self.next_free.value - now)
+
+bandwidth_budget = None
+
+# 工作进程中的进度条代理：把进度发回父进程统一显示，累计到一定量再发送，减少进程间消息
+class RemoteProgress:
+    FLUSH_BYTES = 1024 * 1024
+    FLUSH_SECONDS = 0.2
+
+    def __init__(self, events):
+        self.events = events
+        self.pending = {}
+
+    def create_bar(self, key, total, desc, position=0, unit='B', leave=False):
+        self.pending[key] = [0, monotonic()]
+        self.events.put(('bar', key, total, desc, position))
+        return SimpleNamespace(update=partial(self.update_bar, key))
+
+    def update_bar(self, key, value):
+        pending = self.pending.setdefault(key, [0, monotonic()])
+        pending[0] += value
+        if pending[0] >= self.FLUSH_BYTES or monotonic() - pending[1] >= self.FLUSH_SECONDS:
+            self.flush(key)
+
+    def flush(self, key):
+        pending = self.pending.get(key)
+        if pending and pending[0]:
+            self.events.put(('update', key, pending[0]))
+        self.pending[key] = [0, monotonic()]
+
+    def close_bar(self, key):
+        if key in self.pending:
+            self.flush(key)
+            del self.pending[key]
+            self.events.put(('close', key))
+
+    def close_all(self):
+        for key in list(self.pending):
+            self.close_bar(key)
+
+def download_worker_main(worker_id, commands, events, budget, gate, breaker):
+    global progress_mgr, bandwidth_budget, rate_limit_gate, host_breaker
+    progress_mgr = RemoteProgress(events)
+    bandwidth_budget = budget
+    rate_limit_gate = gate
+    host_breaker = breaker
+    configure_retry_policy(load_config())
+    asyncio_run(download_worker_loop(worker_id, commands, events))
+
+# 工作进程的事件循环：并发执行分配来的下载任务，需要新链接时向父进程请求
+async def download_worker_loop(worker_id, commands, events):
+    loop = get_running_loop()
+    tasks = {}
+    url_requests = {}
+
+    async def resolve_remote(job_id):
+        future = loop.create_future()
+        url_requests[job_id] = future
+        events.put(('resolve', worker_id, job_id))
+        return await future
+
+    async def run_job(job_id, kwargs):
+        error = None
+        try:
+            if kwargs.pop('resolvable', False):
+                kwargs['resolve_urls'] = partial(resolve_remote, job_id)
+            await download_file(**kwargs)
+        except CancelledError:
+            error = '下载任务被取消'
+        except Exception as e:
+            error = str(e) or type(e).__name__
+        finally:
+            tasks.pop(job_id, None)
+        events.put(('done', worker_id, job_id, error))
+
+    while True:
+        message = await loop.run_in_executor(None, commands.get)
+        kind = message[0]
+        if kind == 'stop':
+            break
+        if kind == 'download':
+            tasks[message[1]] = create_task(run_job(message[1], message[2]))
+        elif kind == 'cancel' and message[1] in tasks:
+            tasks[message[1]].cancel()
+        elif kind == 'urls':
+            future = url_requests.pop(message[1], None)
+            if future and not future.done():
+                if message[3]:
+                    future.set_exception(Exception(message[3]))
+                else:
+                    future.set_result(message[2])
+    for task in list(tasks.values()):
+        task.cancel()
+    await gather(*tasks.values(), return_exceptions=True)
+    progress_mgr.close_all()
+
+class DownloadWorkerPool:
+    def __init__(self, processes, budget=None):
+        self.processes = processes
+        self.budget = budget
+        self.context = process_context()
+        # 限流闸门和熔断器在所有工作进程间共享，与带宽预算一样
+        self.manager = self.context.Manager()
+        self.gate = RateLimitGate(self.context)
+        self.breaker = HostCircuitBreaker(host_breaker.threshold, host_breaker.cooldown, self.manager)
+        self.workers = []
+        self.load = []
+        self.jobs = {}  # job_id -> (worker_id, future, resolve_urls)
+        self.next_job = 0
+        self.events = None
+        self.reader = None
+        self.loop = None
+
+    # 应在创建线程池、进度条之前启动，fork 出的子进程不会继承其他线程持有的锁
+    def start(self):
+        self.loop = get_running_loop()
+        self.events = self.context.Queue()
+        for worker_id in range(self.processes):
+            commands = self.context.Queue()
+            process = self.context.Process(target=download_worker_main, daemon=True,
+                                           args=(worker_id, commands, self.events, self.budget, self.gate, self.breaker))
+            process.start()
+            self.workers.append((process, commands))
+            self.load.append(0)
+        self.reader = Thread(target=self.read_events, daemon=True)
+        self.reader.start()
+        logger.info(f"已启动 {self.processes} 个下载工作进程")
+
+    # 父进程的事件线程：更新进度条，把完成和重新获取链接的请求转交给事件循环
+    def read_events(self):
+        while True:
+            message = self.events.get()
+            if message is None:
+                break
+            kind = message[0]
+            if kind == 'bar':
+                progress_mgr.create_bar(*message[1:])
+            elif kind == 'update':
+                progress_mgr.update_bar(message[1], message[2])
+            elif kind == 'close':
+                progress_mgr.close_bar(message[1])
+            elif kind == 'resolve':
+                self.loop.call_soon_threadsafe(create_task, self.resolve(*message[1:]))
+            elif kind == 'done':
+                self.loop.call_soon_threadsafe(self.finish, *message[1:])
+
+    async def resolve(self, worker_id, job_id):
+        job = self.jobs.get(job_id)
+        try:
+            urls, error = await job[2](), None
+        except Exception as e:
+            urls, error = None, str(e) or type(e).__name__
+        self.workers[worker_id][1].put(('urls', job_id, urls, error))
+
+    def finish(self, worker_id, job_id, error):
+        self.load[worker_id] -= 1
+        job = self.jobs.pop(job_id, None)
+        if job and not job[1].done():
+            if error:
+                job[1].set_exception(Exception(error))
+            else:
+                job[1].set_result(True)
+
+    # 与 download_file 参数一致，分配给当前任务最少的工作进程
+    async def download(self, url, save_path, desc, task_index, total_tasks, task_type, max_retries=3, retry_delay=5,
+                       verify=True, backup_urls=(), resolve_urls=None):
+        worker_id = min(range(self.processes), key=lambda i: self.load[i])
+        self.next_job += 1
+        job_id = self.next_job
+        future = self.loop.create_future()
+        self.jobs[job_id] = (worker_id, future, resolve_urls)
+        self.load[worker_id] += 1
+        self.workers[worker_id][1].put(('download', job_id, {
+            'url': url, 'save_path': save_path, 'desc': desc, 'task_index': task_index,
+            'total_tasks': total_tasks, 'task_type': task_type, 'max_retries': max_retries,
+            'retry_delay': retry_delay, 'verify': verify, 'backup_urls': list(backup_urls),
+            'resolvable': resolve_urls is not None,
+        }))
+        try:
+            return await shield(future)
+        except CancelledError:
+            self.workers[worker_id][1].put(('cancel', job_id))
+            raise
+
+    def close(self):
+        for _, commands in self.workers:
+            commands.put(('stop',))
+        for process, _ in self.workers:
+            process.join(10)
+            if process.is_alive():
+                process.terminate()
+        if self.events:
+            self.events.put(None)
+            self.reader.join(5)
+        self.manager.shutdown()
+        self.workers = []
+
+download_pool = None
+
+def init_download_pool(config):
+    global download_pool, bandwidth_budget
+    max_speed = config.getfloat('General', 'max_download_speed_mb', fallback=0)
+    processes = config.getint('General', 'download_processes', fallback=0)
+    bandwidth_budget = BandwidthBudget(max_speed * 1024 * 1024) if max_speed > 0 else None
+    if processes > 1:
+        download_pool = DownloadWorkerPool(processes, bandwidth_budget)
+        download_pool.start()
+    return download_pool
+
+def close_download_pool():
+    global download_pool
+    if download_pool:
+        download_pool.close()
+        download_pool = None
+
 # 使用bilibili-api扫码登录
 async def login_with_qrcode():
     # 创建二维码登录实例
@@ -497,6 +1757,37 @@ async def login_with_qrcode():
     print("登录成功")
     return qr.get_credential()
 
+# 读取保存的登录凭证，无效时扫码登录并保存；interactive 为 False 时不扫码，返回 None
+async def load_credential(interactive=True):
+    credential = None
+    if path.exists('./bilibili.session'):
+        try:
+            with open('bilibili.session', 'r', encoding='utf-8') as file:
+                cookies_data = loads(file.read())
+                credential = Credential(
+                    sessdata=cookies_data.get('SESSDATA', ''),
+                    bili_jct=cookies_data.get('bili_jct', ''),
+                    buvid3=cookies_data.get('buvid3', '')
+                )
+            
+            # 验证凭证是否有效
+            if not await credential.check_valid():
+                logger.info("凭证已过期，需要重新登录")
+                credential = None
+        except Exception as e:
+            logger.error(f"读取会话文件出错: {e}")
+            credential = None
+    
+    if credential is None:
+        if not interactive:
+            return None
+        credential = await login_with_qrcode()
+    
+    # 保存凭证到文件
+    with open('bilibili.session', 'w', encoding='utf-8') as file:
+        file.write(dumps(credential.get_cookies(), indent=4, ensure_ascii=False))
+    return credential
+
 # 清理文件名，移除非法字符
 def sanitize_filename(filename):
     # 替换Windows不允许的文件名字符
@@ -508,30 +1799,260 @@ def sanitize_filename(filename):
         sanitized = "未命名视频"
     return sanitized
 
+# 确定是否应该转换帧率
+def needs_framerate_conversion(convert_framerate, target_framerate, original_framerate):
+    if convert_framerate and original_framerate is not None:
+        # 只有原始帧率与目标帧率不同时才进行转换
+        if abs(target_framerate - original_framerate) > 0.5:
+            logger.info(f"原始帧率({original_framerate})和目标帧率({target_framerate})差异大于0.5，需要转换")
+            return True
+        logger.info(f"原始帧率{original_framerate}fps与目标帧率{target_framerate}fps相近，跳过转换")
+        return False
+    if convert_framerate and original_framerate is None:
+        # 无法检测原始帧率，但用户要求转换
+        logger.info("无法检测原始帧率，但用户要求帧率转换，强制执行")
+        return True
+    return False
+
+# 讲座编码配置：幻灯片类课程的大部分帧与前一帧几乎相同，
+# 用 mpdecimate 丢弃近似重复帧并输出可变帧率，配合长GOP和适合静态画面的编码参数
+ENCODE_PROFILE = 'default'
+LECTURE_DECIMATE = 'mpdecimate=hi=768:lo=320:frac=0.33'
+LECTURE_KEYINT_SECONDS = 10  # 丢帧后按帧数计的GOP会很长，另外按时间强制关键帧，保证拖动进度条时的定位
+LECTURE_X265_PARAMS = 'deblock=-3,-3:psy-rd=2.0:aq-strength=1.2'  # 参照 x264 的 stillimage 调优，保留文字边缘
+
+def configure_encode_profile(config):
+    global ENCODE_PROFILE, LECTURE_DECIMATE, LECTURE_KEYINT_SECONDS, LECTURE_X265_PARAMS
+    ENCODE_PROFILE = config.get('General', 'encode_profile', fallback='default').strip().lower()
+    if ENCODE_PROFILE not in ('default', 'lecture'):
+        logger.warning(f"未知的编码配置 {ENCODE_PROFILE}，使用 default")
+        ENCODE_PROFILE = 'default'
+    LECTURE_DECIMATE = config.get('General', 'lecture_decimate', fallback=LECTURE_DECIMATE).strip()
+    LECTURE_KEYINT_SECONDS = config.getint('General', 'lecture_keyint_seconds', fallback=LECTURE_KEYINT_SECONDS)
+    LECTURE_X265_PARAMS = config.get('General', 'lecture_x265_params', fallback=LECTURE_X265_PARAMS).strip()
+    if ENCODE_PROFILE == 'lecture':
+        logger.info(f"使用讲座编码配置: {LECTURE_DECIMATE}，关键帧间隔 {LECTURE_KEYINT_SECONDS} 秒")
+    return ENCODE_PROFILE
+
+# 讲座配置的输出参数：可变帧率输出（保留丢帧后的原始时间戳）和按时间强制的关键帧
+def lecture_output_args():
+    return (f'-fps_mode vfr -g 9999 '
+            f'-force_key_frames "expr:gte(t,n_forced*{LECTURE_KEYINT_SECONDS})"')
+
+# 转码收益估算：x265 在默认画质下需要的码率主要取决于分辨率、帧率和画面复杂度，而不是输入码率；
+# 输入码率已经很低时转码省下的空间很少，却要花费大量编码时间，这类视频直接流复制
+TRANSCODE_BPP = 0.02                    # 参考复杂度下 x265 所需的每像素比特数
+TRANSCODE_REFERENCE_COMPLEXITY = 0.12   # 参考复杂度：非关键帧平均大小 / 关键帧平均大小
+TRANSCODE_MIN_SAVING_RATIO = 0.15       # 预计节省比例低于该值时不转码
+TRANSCODE_MIN_MB_PER_MINUTE = 2.0       # 每分钟编码时间预计节省的MB数低于该值时不转码
+TRANSCODE_PROBE_SECONDS = 120
+
+def configure_transcode_policy(config):
+    global TRANSCODE_BPP, TRANSCODE_MIN_SAVING_RATIO, TRANSCODE_MIN_MB_PER_MINUTE
+    TRANSCODE_BPP = config.getfloat('General', 'transcode_bpp', fallback=TRANSCODE_BPP)
+    TRANSCODE_MIN_SAVING_RATIO = config.getfloat('General', 'transcode_min_saving_ratio', fallback=TRANSCODE_MIN_SAVING_RATIO)
+    TRANSCODE_MIN_MB_PER_MINUTE = config.getfloat('General', 'transcode_min_mb_per_minute', fallback=TRANSCODE_MIN_MB_PER_MINUTE)
+
+# 流复制读取开头一段视频包，统计帧率和关键帧/非关键帧的平均大小，只解封装不解码
+def probe_video_packets(video_file, seconds=TRANSCODE_PROBE_SECONDS):
+    cmd = ['ffmpeg', '-v', 'error', '-t', str(seconds), '-i', video_file,
+           '-map', '0:v:0', '-c', 'copy', '-f', 'framecrc', '-']
+    result = run(cmd, stdout=PIPE, stderr=PIPE, text=True, timeout=120)
+    if result.returncode != 0:
+        return None
+    time_base = None
+    key_sizes, delta_sizes, timestamps = [], [], []
+    for line in result.stdout.splitlines():
+        if line.startswith('#tb 0:'):
+            num, _, den = line.split(':', 1)[1].strip().partition('/')
+            time_base = int(num) / int(den)
+            continue
+        if not line or line.startswith('#'):
+            continue
+        fields = [field.strip() for field in line.split(',')]
+        # 只有非关键帧会带 F= 标记（关键帧标记位为1）
+        flags = int(fields[6][2:], 16) if len(fields) > 6 else 1
+        (key_sizes if flags & 1 else delta_sizes).append(int(fields[4]))
+        timestamps.append(int(fields[2]))
+    frames = len(key_sizes) + len(delta_sizes)
+    if not frames or not time_base:
+        return None
+    span = (max(timestamps) - min(timestamps)) * time_base
+    return {
+        'frames': frames,
+        'fps': (frames - 1) / span if span > 0 else 30.0,
+        'key_bytes': sum(key_sizes) / len(key_sizes) if key_sizes else 0,
+        'delta_bytes': sum(delta_sizes) / len(delta_sizes) if delta_sizes else 0,
+    }
+
+# 预计转码后的大小、节省的空间和编码耗时
+def estimate_transcode(video_file, width, height, duration):
+    packets = probe_video_packets(video_file)
+    if not packets or not duration:
+        return None
+    input_bytes = path.getsize(video_file)
+    complexity = packets['delta_bytes'] / packets['key_bytes'] if packets['key_bytes'] else 1.0
+    factor = min(3.0, max(0.2, complexity / TRANSCODE_REFERENCE_COMPLEXITY))
+    predicted_bytes = width * height * packets['fps'] * duration * TRANSCODE_BPP * factor / 8
+    # 不会比输入更大（那样就不转了），也不假设能压到输入的四分之一以下
+    predicted_bytes = min(input_bytes, max(input_bytes * 0.25, predicted_bytes))
+    mode = encode_mode_name(True)
+    encode_speed = load_performance().get('encode_speed', {}).get(mode) or DEFAULT_ENCODE_SPEED[mode]
+    return {
+        'input_bytes': input_bytes,
+        'predicted_bytes': int(predicted_bytes),
+        'saving_bytes': int(input_bytes - predicted_bytes),
+        'saving_ratio': 1 - predicted_bytes / input_bytes if input_bytes else 0,
+        'encode_seconds': duration / encode_speed,
+        'input_bpp': input_bytes * 8 / (width * height * packets['fps'] * duration),
+        'complexity': complexity,
+    }
+
+# 按节省比例和每分钟编码时间节省的空间判断是否值得转码
+def transcode_pays_off(estimate):
+    if estimate is None:
+        return True
+    mb_per_minute = estimate['saving_bytes'] / 1024 / 1024 / max(estimate['encode_seconds'] / 60, 1e-6)
+    return estimate['saving_ratio'] >= TRANSCODE_MIN_SAVING_RATIO and mb_per_minute >= TRANSCODE_MIN_MB_PER_MINUTE
+
+# 编码器校准结果：calibrate 命令在本机试编码各编码器/预设，记录速度和输出大小
+ENCODER_PROFILE_FILE = './encoder_profile.json'
+# 编码器 -> (输出编码, 要校准的预设)；本机不可用的硬件编码器试编码会失败，自动跳过
+CALIBRATION_ENCODERS = {
+    'libx265': ('hevc', ['ultrafast', 'superfast', 'veryfast', 'faster', 'fast', 'medium', 'slow']),
+    'libx264': ('h264', ['veryfast', 'medium']),
+    'libsvtav1': ('av1', ['12', '10', '8']),
+    'hevc_nvenc': ('hevc', ['p1', 'p4', 'p7']),
+    'hevc_qsv': ('hevc', ['veryfast', 'medium']),
+    'hevc_videotoolbox': ('hevc', ['']),
+}
+SELECTED_ENCODER = None  # 由 configure_encoder_selection 设置，为校准结果中的一条记录
+
+def load_encoder_profile():
+    try:
+        with open(ENCODER_PROFILE_FILE, 'r', encoding='utf-8') as f:
+            return loads(f.read())
+    except (OSError, ValueError):
+        return {}
+
+# 以 reference_preset 下 libx265 的输出为参考，选出大小不超过参考 size_target 倍、PSNR 损失不超过 max_psnr_loss 的最快编码器
+# 各编码器按默认质量参数编码，快速预设的输出往往更小但画质更差，所以同时限制画质
+def select_encoder(profile, reference_preset='medium', size_target=1.1, codecs=('hevc',), hardware=True, max_psnr_loss=0.5):
+    results = [r for r in profile.get('results', []) if r.get('ok')]
+    references = [r for r in results if r['encoder'] == 'libx265']
+    reference = next((r for r in references if r['preset'] == reference_preset), None) \
+        or min(references, key=lambda r: r['bytes'], default=None)
+    if not reference:
+        return None
+    candidates = [
+        r for r in results
+        if r['codec'] in codecs and r['bytes'] <= reference['bytes'] * size_target
+        and (r.get('psnr') is None or reference.get('psnr') is None or r['psnr'] >= reference['psnr'] - max_psnr_loss)
+        and (hardware or r['encoder'].startswith('lib'))
+    ]
+    best = max(candidates, key=lambda r: r['fps'], default=None)
+    return dict(best, size_ratio=best['bytes'] / reference['bytes']) if best else None
+
+def configure_encoder_selection(config):
+    global SELECTED_ENCODER
+    SELECTED_ENCODER = None
+    if config.get('General', 'encoder_selection', fallback='profile').strip().lower() != 'profile':
+        return
+    profile = load_encoder_profile()
+    if not profile:
+        return
+    if profile.get('host') != gethostname():
+        logger.warning(f"编码器校准结果来自主机 {profile.get('host')}，不适用于本机，请在本机重新运行 calibrate 命令")
+        return
+    codecs = tuple(c.strip().lower() for c in config.get('General', 'encoder_codecs', fallback='hevc').split(',') if c.strip())
+    SELECTED_ENCODER = select_encoder(
+        profile,
+        config.get('General', 'x265_preset', fallback='medium'),
+        config.getfloat('General', 'encoder_size_target', fallback=1.1),
+        codecs,
+        hardware=config.get('General', 'gpu_mode', fallback='auto') != 'force_cpu',
+        max_psnr_loss=config.getfloat('General', 'encoder_max_psnr_loss', fallback=0.5)
+    )
+    if SELECTED_ENCODER:
+        logger.info(f"按校准结果选用编码器 {SELECTED_ENCODER['encoder']} {SELECTED_ENCODER['preset']}"
+                    f"（{SELECTED_ENCODER['fps']:.1f} fps，输出为参考大小的 {SELECTED_ENCODER['size_ratio']:.0%}）")
+    else:
+        logger.warning("校准结果中没有满足大小目标的编码器，使用默认编码设置")
+
+# 编码器对应的输出编码，未经校准选择时为H265
+def encoder_output_codec(encoder):
+    return CALIBRATION_ENCODERS.get(encoder, ('hevc',))[0] if encoder else 'hevc'
+
+# 附加输出：与主输出在同一次 ffmpeg 调用中生成，输入只读取、解码一次
+# original 为流复制的原始音视频存档，audio 为独立音频文件（编码方式同仅音频模式）
+EXTRA_OUTPUT_NAMES = {'original': '原始存档', 'audio': '音频'}
+
+def parse_extra_outputs(config):
+    extra_outputs = {}
+    for kind in config.get('General', 'extra_outputs', fallback='').split(','):
+        kind = kind.strip().lower()
+        if not kind:
+            continue
+        if kind not in EXTRA_OUTPUT_NAMES:
+            logger.warning(f"未知的附加输出 {kind}，可选: {', '.join(EXTRA_OUTPUT_NAMES)}")
+            continue
+        extra_outputs[kind] = {}
+    if 'audio' in extra_outputs:
+        codec = config.get('General', 'audio_codec', fallback='copy').strip().lower()
+        extra_outputs['audio'] = {
+            'codec': codec if codec in AUDIO_FORMATS else 'copy',
+            'bitrate': config.get('General', 'audio_bitrate', fallback='64k').strip(),
+        }
+    return extra_outputs
+
+# 附加输出的最终路径，与主输出放在同一目录
+def extra_output_path(output_file, kind, options=None):
+    root, ext = path.splitext(output_file)
+    if kind == 'audio':
+        return root + AUDIO_FORMATS[(options or {}).get('codec', 'copy')][0]
+    return f"{root}.original{ext}"
+
+# 附加输出的 ffmpeg 输出参数，写入 .part 文件；输入0为视频流，输入1为音频流
+def extra_output_args(output_file, extra_outputs, mux_args=None):
+    args = []
+    for kind, options in extra_outputs.items():
+        target = partial_output_path(extra_output_path(output_file, kind, options))
+        if kind == 'audio':
+            codec_args = AUDIO_FORMATS[options.get('codec', 'copy')][1].format(bitrate=options.get('bitrate', '64k'))
+            args.append(f'-map 1:a:0 -vn {codec_args} "{target}"')
+        else:
+            args.append(f'-map 0:v:0 -map 1:a:0 -c copy {output_target(target, mux_args)}')
+    return ' '.join(args)
+
+# 校验附加输出：完整读一遍封装，时长应与节目时长一致
+def verify_output(output_file, duration):
+    if not path.exists(output_file) or path.getsize(output_file) == 0:
+        return False, "文件不存在或大小为0"
+    return_code, stderr_tail, last_progress = run_ffmpeg_with_progress(
+        f'ffmpeg -v error -i "{output_file}" -map 0 -c copy -f null -')
+    if return_code != 0:
+        return False, f"无法完整读取: {stderr_tail}"
+    seconds = progress_seconds(last_progress)
+    if duration and seconds is not None and seconds < duration - max(2, duration * 0.01):
+        return False, f"时长 {seconds:.1f} 秒，短于节目时长 {duration} 秒"
+    return True, ""
+
 # 构建FFmpeg命令行，支持编码转换
 def build_ffmpeg_cmd(video_file, audio_file, output_file, use_gpu=False, width=1920, height=1080, 
                      original_codec="h264", convert_to_h265=False, convert_framerate=False, 
-                     target_framerate=30, original_framerate=None, attempt=0):
+                     target_framerate=30, original_framerate=None, attempt=0, preset=None, threads=0,
+                     profile='default', encoder=None, extra_args='', mux_args=None):
     base_cmd = f'ffmpeg -y -i "{video_file}" -i "{audio_file}"'
     map_args = '-map 0:v:0 -map 1:a:0 -shortest'
-    output_args = f'"{output_file}"'
+    output_args = output_target(output_file, mux_args)
+    # 附加输出跟在主输出之后，保底方案不带附加输出，失败时由调用方单独生成
+    extra_output = f' {extra_args}' if extra_args else ''
     
     # 调试日志：显示传入的帧率参数
     logger.info(f"帧率转换设置: convert_framerate={convert_framerate}, target_framerate={target_framerate}, original_framerate={original_framerate}")
 
     # 确定是否应该转换帧率
-    should_convert_framerate = False
-    if convert_framerate and original_framerate is not None:
-        # 只有原始帧率与目标帧率不同时才进行转换
-        if abs(target_framerate - original_framerate) > 0.5:
-            should_convert_framerate = True
-            logger.info(f"原始帧率({original_framerate})和目标帧率({target_framerate})差异大于0.5，需要转换")
-        else:
-            logger.info(f"原始帧率{original_framerate}fps与目标帧率{target_framerate}fps相近，跳过转换")
-    elif convert_framerate and original_framerate is None:
-        # 无法检测原始帧率，但用户要求转换
-        should_convert_framerate = True
-        logger.info("无法检测原始帧率，但用户要求帧率转换，强制执行")
+    should_convert_framerate = needs_framerate_conversion(convert_framerate, target_framerate, original_framerate)
     
     # 构建滤镜链 - 确保帧率转换滤镜总是被添加（如果需要）
     vf_filters = []
@@ -545,22 +2066,33 @@ def build_ffmpeg_cmd(video_file, audio_file, output_file, use_gpu=False, width=1
     
     # 组合滤镜
     vf_args = f'-vf "{",".join(vf_filters)}"' if vf_filters else ""
+    # 讲座配置在帧率转换、缩放之后再丢弃重复帧
+    lecture = profile == 'lecture' and convert_to_h265
+    lecture_vf_args = f'-vf "{",".join(vf_filters + [LECTURE_DECIMATE])}" {lecture_output_args()}' if lecture else vf_args
+    # 丢帧后视频流在最后一次画面变化处就结束了，不能用 -shortest，否则会截掉后面的音频
+    lecture_map_args = '-map 0:v:0 -map 1:a:0' if lecture else map_args
     
     # 根据原始编码和转换设置决定视频编码策略
     # 确定视频编码器
     if convert_to_h265:
-        if use_gpu:
+        if encoder:
+            # 使用校准选出的编码器
+            video_codec = encoder
+        elif use_gpu:
             # 尝试多种可能的GPU编码器
             gpu_encoders = ["hevc_nvenc", "h265_nvenc", "hevc_vaapi"]
-            for encoder in gpu_encoders:
-                if check_encoder_supported(encoder):
-                    video_codec = encoder
+            for gpu_encoder in gpu_encoders:
+                if check_encoder_supported(gpu_encoder):
+                    video_codec = gpu_encoder
                     break
             else:
                 video_codec = "libx265"  # 回退到CPU编码
                 logger.info("未找到可用的GPU编码器，回退到CPU编码")
         else:
             video_codec = "libx265"
+    elif should_convert_framerate:
+        # 只转换帧率时按原始编码重新编码，滤镜不能与流复制同时使用
+        video_codec = "libx265" if original_codec in ["h265", "hevc"] else "libx264"
     elif original_codec in ["h265", "hevc"]:
         # 如果原始就是H265，直接复制
         video_codec = "copy"
@@ -568,26 +2100,42 @@ def build_ffmpeg_cmd(video_file, audio_file, output_file, use_gpu=False, width=1
         # 其他编码保持原样
         video_codec = "copy"
     
+    # 编码预设只对软件编码器和校准选出的编码器生效
+    preset_args = f'-preset {preset}' if preset and video_codec in ["libx265", "libx264", encoder] else ""
+    # 保底方案固定用 libx265，其他编码器的预设名不通用
+    cpu_preset_args = f'-preset {preset}' if preset and encoder in [None, "libx265", "libx264"] else ""
+    # 线程预算同样只限制软件编码器，libx265 还需限制其线程池；讲座配置的 x265 参数合并到同一个 -x265-params
+    x265_params = [f'pools={threads}'] if threads else []
+    if lecture and LECTURE_X265_PARAMS:
+        x265_params.append(LECTURE_X265_PARAMS)
+    cpu_thread_args = f'{f"-threads {threads}" if threads else ""} -x265-params {":".join(x265_params)}'.strip() \
+        if x265_params else ""
+    if video_codec == "libx265":
+        preset_args = f'{preset_args} {cpu_thread_args}'.strip()
+    elif threads and video_codec == "libx264":
+        preset_args = f'{preset_args} -threads {threads}'.strip()
+    cpu_preset_args = f'{cpu_preset_args} {cpu_thread_args}'.strip()
+    
     # 命令选项列表 - 优化转换方案
     cmd_options = [
         # 尝试0: 流复制（仅用于不需要转换的情况）
-        f'{base_cmd} -c:v copy -c:a copy {map_args} {output_args}',
+        f'{base_cmd} -c:v copy -c:a copy {map_args} {output_args}{extra_output}',
         
         # 尝试1: 使用检测到的编码策略（转换或复制）并添加滤镜
-        f'{base_cmd} {vf_args} -c:v {video_codec} -c:a copy {map_args} {output_args}',
+        f'{base_cmd} {lecture_vf_args} -c:v {video_codec} {preset_args} -c:a copy {lecture_map_args} {output_args}{extra_output}',
         
         # 尝试2: 添加硬件加速选项（如果使用GPU）并添加滤镜
-        f'{base_cmd} {vf_args} -c:v {video_codec} -c:a copy {map_args} {output_args}' if not use_gpu else 
-        f'{base_cmd} {vf_args} -hwaccel cuda -c:v {video_codec} -c:a copy {map_args} {output_args}',
+        f'{base_cmd} {lecture_vf_args} -c:v {video_codec} {preset_args} -c:a copy {lecture_map_args} {output_args}{extra_output}' if not use_gpu else 
+        f'{base_cmd} {lecture_vf_args} -hwaccel cuda -c:v {video_codec} -c:a copy {lecture_map_args} {output_args}{extra_output}',
         
         # 尝试3: 添加缩放（如果需要）
-        f'{base_cmd} {vf_args} -c:v {video_codec} -c:a copy {map_args} {output_args}',
+        f'{base_cmd} {lecture_vf_args} -c:v {video_codec} {preset_args} -c:a copy {lecture_map_args} {output_args}{extra_output}',
         
         # 尝试4: 使用更快的预设
-        f'{base_cmd} {vf_args} -c:v {video_codec} -preset fast -c:a copy {map_args} {output_args}',
+        f'{base_cmd} {lecture_vf_args} -c:v {video_codec} -preset fast {cpu_thread_args if video_codec == "libx265" else ""} -c:a copy {lecture_map_args} {output_args}{extra_output}',
         
-        # 尝试5: 强制使用CPU编码
-        f'{base_cmd} {vf_args} -c:v libx265 -c:a copy {map_args} {output_args}'
+        # 尝试5: 强制使用CPU编码，不丢帧，作为保底
+        f'{base_cmd} {vf_args} -c:v libx265 {cpu_preset_args} -c:a copy {map_args} {output_args}'
     ]
     
     # 记录当前方案
@@ -612,22 +2160,184 @@ def check_encoder_supported(encoder_name):
         else:
             logger.error(f"获取编码器列表失败: {result.stderr}")
             return False
-    except TimeoutExpired:
-        logger.error(f"检测编码器 {encoder_name} 超时")
-        return False
+    except TimeoutExpired:
+        logger.error(f"检测编码器 {encoder_name} 超时")
+        return False
+    except Exception as e:
+        logger.error(f"检测编码器 {encoder_name} 时出错: {e}")
+        return False
+
+# ffmpeg 进度通道：用 -progress 把 key=value 进度记录输出到 stdout，stderr 单独收集
+FFMPEG_STDERR_LINES = 50  # 出错时保留的stderr行数
+
+# 从进度记录中取出已编码的时长（秒），out_time_ms 实际也是微秒
+def progress_seconds(record):
+    for key in ('out_time_us', 'out_time_ms'):
+        value = record.get(key, 'N/A')
+        if value not in ('', 'N/A'):
+            try:
+                return max(0.0, int(value) / 1000000)
+            except ValueError:
+                pass
+    return None
+
+# 运行以 "ffmpeg " 开头的命令；每收到一条完整的进度记录调用一次 on_progress
+# 返回 (返回码, stderr末尾若干行, 最后一条进度记录)
+def run_ffmpeg_with_progress(cmd_line, on_progress=None):
+    if cmd_line.startswith('ffmpeg '):
+        cmd_line = f"ffmpeg -hide_banner -nostats -progress pipe:1 {cmd_line[len('ffmpeg '):]}"
+    process = Popen(
+        encoder_command(cmd_line),
+        stdout=PIPE,
+        stderr=PIPE,
+        universal_newlines=True,
+        encoding='utf-8',
+        errors='replace',
+        shell=True,  # 确保命令行正确解析
+        bufsize=1,
+        creationflags=ENCODER_CREATIONFLAGS  # Windows下降低优先级
+    )
+    
+    # stderr 在单独线程中读取到有界缓冲区，避免管道写满阻塞ffmpeg
+    stderr_tail = deque(maxlen=FFMPEG_STDERR_LINES)
+    def drain_stderr():
+        for line in process.stderr:
+            stderr_tail.append(line.rstrip())
+    reader = Thread(target=drain_stderr, daemon=True)
+    reader.start()
+    
+    record = {}
+    last_record = {}
+    for line in process.stdout:
+        key, sep, value = line.strip().partition('=')
+        if not sep:
+            continue
+        record[key] = value
+        # 每条记录以 progress=continue/end 结束
+        if key == 'progress':
+            last_record, record = record, {}
+            if on_progress:
+                on_progress(last_record)
+    return_code = process.wait()
+    reader.join(5)
+    return return_code, '\n'.join(stderr_tail), last_record
+
+# 把最后一条进度记录格式化为编码速度描述
+def describe_progress(record):
+    if not record:
+        return "无进度信息"
+    size = record.get('total_size', 'N/A')
+    size_text = f"{int(size) / 1024 / 1024:.1f}MB" if size.isdigit() else size
+    return f"速度 {record.get('speed', 'N/A').strip()}, {record.get('fps', 'N/A')}fps, 输出 {size_text}"
+
+# 按关键帧切分视频、多进程并行编码分段、无损拼接后再封装音频，用于长视频的H265转换
+def chunked_transcode(video_file, audio_file, output_file, progress_bar_key, duration, workers,
+                      segment_seconds=0, preset=None, convert_framerate=False, target_framerate=30,
+                      original_framerate=None, threads=0, mux_args=None):
+    work_dir = f"{path.splitext(video_file)[0]}_chunks"
+    try:
+        makedirs(work_dir, exist_ok=True)
+        # 每个进程平均分到约2个分段，便于在尾部均衡负载
+        if not segment_seconds:
+            segment_seconds = max(30, int(duration / (workers * 2)) + 1)
+        
+        # 1. 流复制切分，segment复用器只在关键帧处切分
+        split_cmd = (f'ffmpeg -y -v error -i "{video_file}" -map 0:v:0 -c copy -f segment '
+                     f'-segment_time {segment_seconds} -reset_timestamps 1 "{path.join(work_dir, "seg_%04d.mp4")}"')
+        result = run(split_cmd, shell=True, stdout=PIPE, stderr=PIPE, text=True)
+        segments = sorted(f for f in listdir(work_dir) if f.startswith('seg_'))
+        if result.returncode != 0 or not segments:
+            logger.warning(f"切分视频失败: {result.stderr[-500:]}")
+            return False
+        logger.info(f"视频已按关键帧切分为 {len(segments)} 段（约{segment_seconds}秒/段），使用 {workers} 个进程并行编码")
+        
+        vf_args = ""
+        if needs_framerate_conversion(convert_framerate, target_framerate, original_framerate):
+            vf_args = f'-vf "fps={target_framerate}"'
+        preset_args = f'-preset {preset}' if preset else ""
+        # 各分段进程分摊这一路合成的线程预算
+        if threads:
+            segment_threads = max(1, threads // workers)
+            preset_args += f' -threads {segment_threads} -x265-params pools={segment_threads}'
+        
+        # 汇总各分段的进度到同一集的进度条
+        segment_progress = {}
+        progress_lock = Lock()
+        
+        def encode_segment(segment):
+            source = path.join(work_dir, segment)
+            target = path.join(work_dir, f"enc_{segment}")
+            cmd_line = f'ffmpeg -y -i "{source}" {vf_args} -c:v libx265 {preset_args} -an "{target}"'
+            
+            def on_progress(record):
+                seconds = progress_seconds(record)
+                if seconds is None:
+                    return
+                with progress_lock:
+                    previous = sum(segment_progress.values())
+                    segment_progress[segment] = seconds
+                    progress_mgr.update_bar(progress_bar_key, sum(segment_progress.values()) - previous)
+            
+            return_code, stderr_tail, _ = run_ffmpeg_with_progress(cmd_line, on_progress)
+            if return_code != 0:
+                raise Exception(f"分段编码失败: {segment}\n{stderr_tail}")
+            return target
+        
+        # 2. 并行编码分段
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            encoded = list(executor.map(encode_segment, segments))
+        
+        # 3. 用concat分离器无损拼接，同时封装音频
+        list_file = path.join(work_dir, 'concat.txt')
+        with open(list_file, 'w', encoding='utf-8') as f:
+            for target in encoded:
+                f.write(f"file '{path.abspath(target)}'\n")
+        concat_cmd = (f'ffmpeg -y -v error -f concat -safe 0 -i "{list_file}" -i "{audio_file}" '
+                      f'-map 0:v:0 -map 1:a:0 -c copy -shortest {output_target(output_file, mux_args)}')
+        result = run(concat_cmd, shell=True, stdout=PIPE, stderr=PIPE, text=True)
+        if result.returncode != 0:
+            logger.warning(f"拼接分段失败: {result.stderr[-500:]}")
+            return False
+        return True
     except Exception as e:
-        logger.error(f"检测编码器 {encoder_name} 时出错: {e}")
+        logger.warning(f"分段并行编码失败: {e}")
         return False
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+# 逐个校验附加输出，通过的从 .part 重命名为最终文件名；附加输出失败不影响主输出
+def finish_extra_outputs(output_file, extra_outputs, duration, index, total_count):
+    results = {}
+    for kind, options in extra_outputs.items():
+        final_path = extra_output_path(output_file, kind, options)
+        partial_path = partial_output_path(final_path)
+        ok, reason = verify_output(partial_path, duration)
+        if ok:
+            replace(partial_path, final_path)
+            logger.info(f"✓ 附加输出 {EXTRA_OUTPUT_NAMES[kind]} [{index}/{total_count}]: {final_path}（{format_size(path.getsize(final_path))}）")
+        else:
+            logger.warning(f"附加输出 {EXTRA_OUTPUT_NAMES[kind]} [{index}/{total_count}] 校验失败: {reason}")
+            if path.exists(partial_path):
+                remove(partial_path)
+        encode_stats.extra_output(kind, ok)
+        results[kind] = ok
+    return results
 
 # 在FFmpeg中合成视频，改进错误处理和命令构建
 def ffmpeg_merge(video_file, audio_file, output_file, title, index, total_count, duration, 
                  convert_to_h265=False, convert_framerate=False, 
-                 target_framerate=30, original_framerate=None, attempt=0):
+                 target_framerate=30, original_framerate=None, attempt=0, preset=None,
+                 chunk_workers=1, chunk_min_duration=0, chunk_seconds=0, threads=0, profile='default', encoder=None,
+                 extra_outputs=None, in_place=False, mux_args=None):
     # 确保变量有默认值
     width = 1920
     height = 1080
     original_codec = "h264"  # 设置默认值
     
+    # 先写入同目录下的 .part 文件，全部检查通过后再重命名为最终文件名
+    final_output = output_file
+    output_file = partial_output_path(final_output)
+    
     try:
         # 获取视频信息，包括编码、分辨率等
         try:
@@ -672,11 +2382,42 @@ def ffmpeg_merge(video_file, audio_file, output_file, title, index, total_count,
         # 新增：如果不需要转换，直接使用流复制方案
         start_attempt = 0
         if convert_to_h265 and original_codec in ["h264", "avc"]:
-            logger.info("需要H265转换，跳过流复制方案")
-            start_attempt = 1  # 从转换方案开始尝试
-        else:
+            # 预计节省的空间抵不上编码耗时的，同样直接流复制
+            estimate = None
+            if TRANSCODE_MIN_SAVING_RATIO > 0 or TRANSCODE_MIN_MB_PER_MINUTE > 0:
+                try:
+                    estimate = estimate_transcode(video_file, width, height, duration)
+                except Exception as e:
+                    logger.warning(f"无法估算转码收益，按需转码: {e}")
+            if estimate and not transcode_pays_off(estimate):
+                logger.info(f"预计转码只能节省 {estimate['saving_ratio']:.0%}（{format_size(estimate['saving_bytes'])}），"
+                            f"需编码约 {format_duration(estimate['encode_seconds'])}，"
+                            f"输入 {estimate['input_bpp']:.3f} bpp，跳过H265转换 [{index}/{total_count}]")
+                encode_stats.skip_transcode(duration, estimate['input_bytes'])
+            else:
+                if estimate:
+                    logger.info(f"预计转码节省 {estimate['saving_ratio']:.0%}（{format_size(estimate['saving_bytes'])}），"
+                                f"需编码约 {format_duration(estimate['encode_seconds'])}")
+                logger.info("需要H265转换，跳过流复制方案")
+                start_attempt = 1  # 从转换方案开始尝试
+        # 帧率转换同样需要重新编码，不能使用流复制方案
+        if start_attempt == 0 and needs_framerate_conversion(convert_framerate, target_framerate, original_framerate):
+            logger.info("需要帧率转换，跳过流复制方案")
+            start_attempt = 1
+        elif start_attempt == 0:
             logger.info("不需要转换，使用流复制方案")
         
+        # 原地转码（输入就是已合成的成品）不需要转换时，保留原文件
+        if in_place and start_attempt == 0:
+            logger.info(f"无需转码，保留原文件 [{index}/{total_count}]: {final_output}")
+            return True
+        
+        # 主输出为流复制时，原始存档与主输出内容相同，合成后直接链接，不再写一遍
+        extra_outputs = dict(extra_outputs or {})
+        link_original = start_attempt == 0 and extra_outputs.pop('original', None) is not None
+        extra_args = extra_output_args(final_output, extra_outputs, mux_args)
+        extras_written = False
+        
         # 创建进度条
         position = index % 10
         progress_bar_key = f"ffmpeg_{index}"
@@ -692,6 +2433,22 @@ def ffmpeg_merge(video_file, audio_file, output_file, title, index, total_count,
         attempt = start_attempt
         max_attempts = 6
         
+        # 长视频的CPU编码先尝试分段并行编码，失败再回到单进程方案
+        # 讲座配置丢帧后各分段的时长会变短，按分段拼接会导致音画不同步，因此不分段；分段编码固定使用 libx265
+        if (start_attempt > 0 and convert_to_h265 and not NVIDIA_GPU_SUPPORTED and chunk_workers > 1
+                and profile != 'lecture' and encoder in [None, 'libx265']
+                and chunk_min_duration and duration >= chunk_min_duration):
+            logger.info(f"视频时长 {duration} 秒，使用分段并行编码 [{index}/{total_count}]")
+            success = chunked_transcode(
+                video_file, audio_file, output_file, progress_bar_key, duration, chunk_workers,
+                chunk_seconds, preset, convert_framerate, target_framerate, original_framerate, threads, mux_args
+            )
+            if success:
+                logger.info("分段并行编码成功!")
+            else:
+                logger.warning("分段并行编码失败，回退到单进程方案")
+                encode_progress_bar.reset()
+        
         # 尝试不同的合成方式
         while not success and attempt < max_attempts:
             try:
@@ -708,7 +2465,13 @@ def ffmpeg_merge(video_file, audio_file, output_file, title, index, total_count,
                     convert_framerate=convert_framerate,
                     target_framerate=target_framerate,
                     original_framerate=original_framerate,
-                    attempt=attempt
+                    attempt=attempt,
+                    preset=preset,
+                    threads=threads,
+                    profile=profile,
+                    encoder=encoder,
+                    extra_args=extra_args,
+                    mux_args=mux_args
                 )
                 
                 # 记录当前尝试 - 添加转换信息
@@ -722,41 +2485,31 @@ def ffmpeg_merge(video_file, audio_file, output_file, title, index, total_count,
                 if attempt > start_attempt:
                     encode_progress_bar.reset()
                 
-                # 执行命令
-                process = Popen(
-                    cmd_line, 
-                    stdout=PIPE, 
-                    stderr=STDOUT, 
-                    universal_newlines=True, 
-                    encoding='utf-8',
-                    shell=True,  # 确保命令行正确解析
-                    bufsize=1
-                )
-                
-                # 处理输出并更新进度条
-                for line in process.stdout:
-                    if line.startswith('size='):
-                        time_length = parse_time_2_sec(line)
-                        progress_mgr.update_bar(progress_bar_key, time_length - encode_progress_bar.n)
+                # 执行命令，按进度记录中的精确时间更新进度条
+                def on_progress(record):
+                    seconds = progress_seconds(record)
+                    if seconds is not None:
+                        progress_mgr.update_bar(progress_bar_key, seconds - encode_progress_bar.n)
                 
-                # 检查命令执行结果
-                return_code = process.wait()
+                return_code, stderr_tail, last_progress = run_ffmpeg_with_progress(cmd_line, on_progress)
                 # 在合成成功的代码块中添加帧率验证
                 if return_code == 0:
                     success = True
-                    logger.info(f"{mode}方案 {attempt+1} 成功!")
+                    extras_written = attempt < 5
+                    logger.info(f"{mode}方案 {attempt+1} 成功! {describe_progress(last_progress)}")
                     
                     # 检测输出视频的实际编码
                     actual_codec = detect_video_codec(output_file)
                     if actual_codec:
                         logger.info(f"输出视频编码: {actual_codec}")
                         
-                        # 检查是否成功转换为H265
+                        # 检查是否成功转换为目标编码（保底方案固定为H265）
                         if convert_to_h265 and original_codec in ["h264", "avc"]:
-                            if "hevc" in actual_codec.lower() or "h265" in actual_codec.lower():
-                                logger.info("✓ H265转换成功")
+                            expected_codec = encoder_output_codec(encoder if attempt < 5 else None)
+                            if expected_codec in actual_codec.lower() or (expected_codec == "hevc" and "h265" in actual_codec.lower()):
+                                logger.info(f"✓ {expected_codec.upper()}转换成功")
                             else:
-                                logger.warning("H265转换失败！视频未转换为H265编码")
+                                logger.warning(f"{expected_codec.upper()}转换失败！视频未转换为{expected_codec.upper()}编码")
                                 # 标记为失败以便尝试其他方案
                                 success = False
                                 attempt += 1
@@ -782,7 +2535,7 @@ def ffmpeg_merge(video_file, audio_file, output_file, title, index, total_count,
                     else:
                         logger.warning("无法检测输出视频帧率")
                 else:
-                    logger.warning(f"{mode}方案 {attempt+1} 失败，返回码: {return_code}")
+                    logger.warning(f"{mode}方案 {attempt+1} 失败，返回码: {return_code}\n{stderr_tail}")
                     attempt += 1
             except Exception as e:
                 logger.error(f"{mode}方案 {attempt+1} 异常: {e}")
@@ -800,15 +2553,34 @@ def ffmpeg_merge(video_file, audio_file, output_file, title, index, total_count,
             raise Exception(f"输出文件不存在: {output_file}")
         if path.getsize(output_file) == 0:
             raise Exception(f"输出文件大小为0: {output_file}")
+        
+        # 分段并行编码和保底方案不带附加输出，此时单独生成（都是流复制或音频，开销很小）
+        if extra_args and not extras_written:
+            logger.info(f"单独生成附加输出 [{index}/{total_count}]")
+            return_code, stderr_tail, _ = run_ffmpeg_with_progress(
+                f'ffmpeg -y -i "{video_file}" -i "{audio_file}" {extra_args}')
+            if return_code != 0:
+                logger.warning(f"生成附加输出失败，返回码: {return_code}\n{stderr_tail}")
+        # 原地转码会替换原文件，替换前完整校验一遍新文件
+        if in_place:
+            ok, reason = verify_output(output_file, duration)
+            if not ok:
+                raise Exception(f"转码结果校验失败，保留原文件: {reason}")
+        replace(output_file, final_output)
             
-        logger.info(f"视频 [{index}/{total_count}] '{title}' 合成成功: {output_file}")
+        logger.info(f"视频 [{index}/{total_count}] '{title}' 合成成功: {final_output}")
+        finish_extra_outputs(final_output, extra_outputs, duration, index, total_count)
+        if link_original:
+            original_output = extra_output_path(final_output, 'original')
+            link_or_copy(final_output, original_output)
+            logger.info(f"✓ 附加输出 原始存档 [{index}/{total_count}]: {original_output}（与主输出相同）")
+            encode_stats.extra_output('original', True)
         
-        # 删除临时文件
+        # 删除临时文件；原地转码的输入已被新文件替换
         try:
-            if path.exists(audio_file):
-                remove(audio_file)
-            if path.exists(video_file):
-                remove(video_file)
+            if not in_place:
+                remove_stream_file(audio_file)
+                remove_stream_file(video_file)
         except Exception as e:
             logger.warning(f"清理临时文件时出错，但不影响结果: {e}")
         
@@ -816,11 +2588,75 @@ def ffmpeg_merge(video_file, audio_file, output_file, title, index, total_count,
     except Exception as e:
         logger.error(f"合成视频 {index} 时出错: {e}")
         progress_mgr.close_bar(progress_bar_key)
+        unfinished = [output_file] + [partial_output_path(extra_output_path(final_output, kind, options))
+                                      for kind, options in (extra_outputs or {}).items()]
+        for unfinished_file in unfinished:
+            if path.exists(unfinished_file):
+                try:
+                    remove(unfinished_file)
+                except Exception as e:
+                    logger.warning(f"无法删除未完成的输出文件 {unfinished_file}: {e}")
+        return False
+
+# 仅音频模式的输出格式：编码方式 -> (扩展名, ffmpeg音频参数)
+AUDIO_FORMATS = {
+    'copy': ('.m4a', '-c:a copy'),
+    'aac': ('.m4a', '-c:a aac -b:a {bitrate}'),
+    'opus': ('.opus', '-c:a libopus -b:a {bitrate}'),
+}
+
+# 仅音频模式：把音频流封装为独立的音频文件，流复制失败时回退到AAC重新编码
+def ffmpeg_extract_audio(audio_file, output_file, title, index, total_count, duration,
+                         codec='copy', bitrate='64k'):
+    final_output = output_file
+    output_file = partial_output_path(final_output)
+    progress_bar_key = f"ffmpeg_{index}"
+    encode_progress_bar = progress_mgr.create_bar(
+        progress_bar_key,
+        duration,
+        f'[{index}/{total_count}] {title} audio [2/2]',
+        index % 10,
+        unit='second'
+    )
+    
+    def on_progress(record):
+        seconds = progress_seconds(record)
+        if seconds is not None:
+            progress_mgr.update_bar(progress_bar_key, seconds - encode_progress_bar.n)
+    
+    try:
+        codecs = [codec] if codec != 'copy' else ['copy', 'aac']
+        for attempt, attempt_codec in enumerate(codecs):
+            if attempt:
+                logger.warning(f"音频流复制失败，改用 {attempt_codec} 重新编码 [{index}/{total_count}]")
+                encode_progress_bar.reset()
+            codec_args = AUDIO_FORMATS[attempt_codec][1].format(bitrate=bitrate)
+            cmd_line = f'ffmpeg -y -i "{audio_file}" -vn -map 0:a:0 {codec_args} "{output_file}"'
+            return_code, stderr_tail, last_progress = run_ffmpeg_with_progress(cmd_line, on_progress)
+            if return_code == 0 and path.exists(output_file) and path.getsize(output_file) > 0:
+                break
+            logger.warning(f"音频封装失败，返回码: {return_code}\n{stderr_tail}")
+        else:
+            raise Exception("所有音频封装方式都失败了")
+        
+        replace(output_file, final_output)
+        progress_mgr.close_bar(progress_bar_key)
+        logger.info(f"音频 [{index}/{total_count}] '{title}' 保存成功: {final_output}")
+        remove_stream_file(audio_file)
+        return True
+    except Exception as e:
+        logger.error(f"保存音频 {index} 时出错: {e}")
+        progress_mgr.close_bar(progress_bar_key)
+        if path.exists(output_file):
+            try:
+                remove(output_file)
+            except Exception:
+                pass
         return False
 
 # 清理临时目录
 def cleanup_temp_dir():
-    temp_dir = './download/temp'
+    temp_dir = SCRATCH_DIR
     if path.exists(temp_dir):
         try:
             for filename in listdir(temp_dir):
@@ -835,92 +2671,1056 @@ def cleanup_temp_dir():
         except Exception as e:
             logger.error(f"清理临时目录时出错: {e}")
 
+# 分布式合成：下载端把合成任务写入共享的任务目录（可放在NFS/SMB等共享存储上），
+# 其他机器上的合成进程（python bdownloader_3.0.py encode-worker）领取、执行后写回结果。
+# 目录结构: pending/ 待领取，claimed/ 已领取（文件修改时间即租约心跳），done/ 结果
+# 任务中的路径均为绝对路径，合成机需要以相同路径挂载临时目录和输出目录
+ENCODE_LEASE_SECONDS = 120
+ENCODE_MAX_ATTEMPTS = 3
+ENCODE_CLAIM_TIMEOUT = 600
+
+class EncodeSpool:
+    def __init__(self, root, lease_seconds=ENCODE_LEASE_SECONDS, max_attempts=ENCODE_MAX_ATTEMPTS,
+                 claim_timeout=ENCODE_CLAIM_TIMEOUT):
+        self.root = path.abspath(root)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.claim_timeout = claim_timeout
+        for state in ('pending', 'claimed', 'done'):
+            makedirs(path.join(self.root, state), exist_ok=True)
+
+    def job_path(self, state, job_id):
+        return path.join(self.root, state, f"{job_id}.json")
+
+    # 先写临时文件再重命名，其他进程不会读到写了一半的任务
+    def write_json(self, file_path, data):
+        temp_path = f"{file_path}.{uuid4().hex}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            dump(data, f, indent=2, ensure_ascii=False)
+        replace(temp_path, file_path)
+
+    def read_json(self, file_path):
+        try:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                return loads(f.read())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    # 任务ID以毫秒时间戳开头，按名称排序即先进先出
+    def enqueue(self, job):
+        job_id = f"{int(time() * 1000):013d}_{uuid4().hex[:8]}"
+        self.write_json(self.job_path('pending', job_id), dict(job, job_id=job_id, attempts=0, enqueued=time()))
+        return job_id
+
+    # 通过重命名领取任务：同一时刻只有一个进程能把文件从 pending 移到 claimed
+    def claim(self, worker):
+        pending_dir = path.join(self.root, 'pending')
+        for name in sorted(n for n in listdir(pending_dir) if n.endswith('.json')):
+            job_id = name[:-5]
+            claimed_path = self.job_path('claimed', job_id)
+            try:
+                rename(path.join(pending_dir, name), claimed_path)
+            except OSError:
+                continue  # 已被其他进程领取
+            job = self.read_json(claimed_path)
+            if job is None or path.exists(self.job_path('done', job_id)):
+                remove_stream_file(claimed_path)
+                continue
+            job['attempts'] += 1
+            job['worker'] = worker
+            self.write_json(claimed_path, job)
+            if job['attempts'] > self.max_attempts:
+                self.complete(job_id, {'success': False, 'worker': worker,
+                                       'error': f"合成进程租约已过期 {self.max_attempts} 次，放弃该任务"})
+                continue
+            return job
+        return None
+
+    # 合成进程定期刷新租约；返回 False 表示租约已失效、任务已被重新排队
+    def heartbeat(self, job_id):
+        try:
+            utime(self.job_path('claimed', job_id))
+            return True
+        except OSError:
+            return False
+
+    def complete(self, job_id, result):
+        self.write_json(self.job_path('done', job_id), dict(result, job_id=job_id, completed=time()))
+        remove_stream_file(self.job_path('claimed', job_id))
+
+    # 合成进程崩溃或断网后租约不再刷新，超时的任务放回 pending 由其他进程重新领取
+    def requeue_expired(self):
+        claimed_dir = path.join(self.root, 'claimed')
+        for name in listdir(claimed_dir):
+            if not name.endswith('.json'):
+                continue
+            claimed_path = path.join(claimed_dir, name)
+            try:
+                if time() - stat(claimed_path).st_mtime <= self.lease_seconds:
+                    continue
+                rename(claimed_path, path.join(self.root, 'pending', name))
+                logger.warning(f"合成任务 {name[:-5]} 的租约已过期，重新排队")
+            except OSError:
+                continue
+
+    def result(self, job_id):
+        return self.read_json(self.job_path('done', job_id))
+
+    # 撤回尚未被领取的任务；删除失败说明已被合成进程领取
+    def withdraw(self, job_id):
+        try:
+            remove(self.job_path('pending', job_id))
+            return True
+        except OSError:
+            return False
+
+    # 任务连续在 pending 中超过 claim_timeout 秒（没有合成进程在运行，或合成进程崩溃后租约过期回到 pending）
+    # 时撤回任务并返回 None，由调用方改为本机合成
+    async def wait(self, job_id, poll=1.0):
+        pending_since = None
+        while True:
+            result = self.result(job_id)
+            if result:
+                return result
+            self.requeue_expired()
+            if not path.exists(self.job_path('pending', job_id)):
+                pending_since = None
+            elif pending_since is None:
+                pending_since = monotonic()
+            elif self.claim_timeout and monotonic() - pending_since > self.claim_timeout and self.withdraw(job_id):
+                return None
+            await asyncio_sleep(poll)
+
+encode_spool = None
+
+def init_encode_spool(config):
+    global encode_spool
+    spool_dir = config.get('General', 'encode_spool_dir', fallback='').strip()
+    encode_spool = EncodeSpool(spool_dir, config.getint('General', 'encode_lease_seconds', fallback=ENCODE_LEASE_SECONDS),
+                               claim_timeout=config.getint('General', 'encode_claim_timeout', fallback=ENCODE_CLAIM_TIMEOUT)) \
+        if spool_dir else None
+    if encode_spool:
+        logger.info(f"合成任务将提交到任务目录: {encode_spool.root}")
+    return encode_spool
+
+# 提交合成任务并等待合成进程完成，返回是否成功；无合成进程领取时返回 None
+async def spool_merge(merge_kwargs, duration):
+    for key in ('video_file', 'audio_file', 'output_file'):
+        merge_kwargs[key] = path.abspath(merge_kwargs[key])
+    job_id = encode_spool.enqueue({
+        'merge': merge_kwargs,
+        'output_format': OUTPUT_FORMAT,
+        'faststart': OUTPUT_MUX_ARGS == '-movflags +faststart',
+    })
+    logger.info(f"已提交合成任务 {job_id}: {merge_kwargs['output_file']}")
+    result = await encode_spool.wait(job_id)
+    if result is None:
+        logger.warning(f"合成任务 {job_id} 超过 {encode_spool.claim_timeout} 秒无合成进程领取，已撤回，改为本机合成")
+        return None
+    if result.get('success'):
+        encode_stats.record(duration, result['started'], result['finished'])
+        logger.info(f"合成任务 {job_id} 由 {result.get('worker')} 完成")
+        return True
+    logger.error(f"合成任务 {job_id} 失败（{result.get('worker')}）: {result.get('error', '未知错误')}")
+    return False
+
+# 本机合成环境：线程预算、优先级、编码配置和GPU检测，encode-worker 和 remerge 共用
+def configure_local_encoding(config, jobs=0, detect_gpu=True):
+    concurrent_ffmpeg, encode_threads = plan_encode_budget(
+        jobs or config.getint('General', 'concurrent_ffmpeg', fallback=0),
+        config.getint('General', 'encode_threads', fallback=0),
+        config.getint('General', 'reserved_cores', fallback=1)
+    )
+    configure_encoder_priority(
+        config.getint('General', 'encode_nice', fallback=10),
+        config.get('General', 'encode_cpuset', fallback='').strip()
+    )
+    chunk_workers = config.getint('General', 'chunk_workers', fallback=0) or max(1, min(8, usable_cpu_count() // 2))
+    configure_encode_profile(config)
+    configure_transcode_policy(config)
+    configure_encoder_selection(config)
+    if detect_gpu:
+        gpu_mode = config.get('General', 'gpu_mode', fallback='auto')
+        check_nvidia_gpu_support({'force_gpu': True, 'force_cpu': False}.get(gpu_mode))
+    return concurrent_ffmpeg, encode_threads, chunk_workers
+
+# 下载端的合成设置：输出格式、本机合成环境，以及传给 process_episode 的编码选项和仅音频选项，main、sync、transcode 共用
+# main 在询问硬件加速方式后再检测GPU，传入 detect_gpu=False
+def configure_merge_settings(config, audio_only=False, detect_gpu=True):
+    configure_output_format(
+        config.get('General', 'output_format', fallback='mp4').strip().lower(),
+        config.getboolean('General', 'faststart', fallback=False)
+    )
+    concurrent_ffmpeg, encode_threads, chunk_workers = configure_local_encoding(config, detect_gpu=detect_gpu)
+    merge_options = {
+        'preset': SELECTED_ENCODER['preset'] if SELECTED_ENCODER else config.get('General', 'x265_preset', fallback='medium'),
+        'encoder': SELECTED_ENCODER['encoder'] if SELECTED_ENCODER else None,
+        'chunk_workers': chunk_workers,
+        'chunk_min_duration': config.getint('General', 'chunk_min_duration', fallback=1200),
+        'chunk_seconds': config.getint('General', 'chunk_seconds', fallback=0),
+        'threads': encode_threads,
+        'profile': ENCODE_PROFILE,
+        'extra_outputs': {} if audio_only else parse_extra_outputs(config),
+    }
+    audio_options = None
+    if audio_only:
+        audio_options = {
+            'codec': config.get('General', 'audio_codec', fallback='copy').strip().lower(),
+            'bitrate': config.get('General', 'audio_bitrate', fallback='64k').strip(),
+        }
+        if audio_options['codec'] not in AUDIO_FORMATS:
+            logger.warning(f"未知的音频编码 {audio_options['codec']}，使用 copy")
+            audio_options['codec'] = 'copy'
+    return concurrent_ffmpeg, merge_options, audio_options
+
+# 本机的线程预算和分段并行数取代任务中的设置
+def local_merge_kwargs(merge_kwargs, encode_threads, chunk_workers, x265_preset):
+    merge_kwargs = dict(merge_kwargs, threads=encode_threads, chunk_workers=chunk_workers)
+    # 编码器同样按本机的校准结果选择，本机没有校准结果时不沿用提交端选出的编码器
+    if SELECTED_ENCODER or merge_kwargs.get('encoder'):
+        selection = SELECTED_ENCODER or {'encoder': None, 'preset': x265_preset}
+        merge_kwargs.update(encoder=selection['encoder'], preset=selection['preset'])
+    return merge_kwargs
+
+# 合成进程：从任务目录领取合成任务并执行，线程数和GPU按本机情况决定
+def run_encode_worker(spool_dir=None, jobs=0, poll=2.0, exit_when_idle=False):
+    config = load_config()
+    if not check_ffmpeg():
+        return 1
+    spool_dir = spool_dir or config.get('General', 'encode_spool_dir', fallback='').strip()
+    if not spool_dir:
+        logger.error("未指定任务目录，请使用 --spool 或在配置文件中设置 encode_spool_dir")
+        return 1
+    spool = EncodeSpool(spool_dir, config.getint('General', 'encode_lease_seconds', fallback=ENCODE_LEASE_SECONDS))
+    concurrent_ffmpeg, encode_threads, chunk_workers = configure_local_encoding(config, jobs)
+    x265_preset = config.get('General', 'x265_preset', fallback='medium')
+    worker = f"{gethostname()}:{getpid()}"
+    logger.info(f"合成进程 {worker} 已启动，任务目录: {spool.root}，并行合成 {concurrent_ffmpeg}，每个 {encode_threads} 线程")
+
+    active = {}
+    active_lock = Lock()
+    stopped = Event()
+
+    # 租约心跳：定期刷新正在执行的任务
+    def keep_leases():
+        while not stopped.wait(max(1, spool.lease_seconds / 4)):
+            with active_lock:
+                job_ids = list(active)
+            for job_id in job_ids:
+                if not spool.heartbeat(job_id):
+                    logger.warning(f"合成任务 {job_id} 的租约已失效，可能已被其他合成进程重新领取")
+
+    def run_job(job):
+        started = time()
+        error = None
+        try:
+            merge_kwargs = local_merge_kwargs(job['merge'], encode_threads, chunk_workers, x265_preset)
+            merge_kwargs['mux_args'] = output_mux_args(job.get('output_format', 'mp4'), job.get('faststart', False))
+            success = ffmpeg_merge(**merge_kwargs)
+        except Exception as e:
+            success = False
+            error = str(e)
+        spool.complete(job['job_id'], {
+            'success': success, 'worker': worker, 'started': started, 'finished': time(),
+            'error': error or (None if success else '合成失败，详见合成进程日志'),
+        })
+        with active_lock:
+            active.pop(job['job_id'], None)
+
+    Thread(target=keep_leases, daemon=True).start()
+    try:
+        with ThreadPoolExecutor(max_workers=concurrent_ffmpeg) as executor:
+            while True:
+                spool.requeue_expired()
+                claimed = False
+                while len(active) < concurrent_ffmpeg:
+                    job = spool.claim(worker)
+                    if not job:
+                        break
+                    claimed = True
+                    logger.info(f"领取合成任务 {job['job_id']}: {job['merge'].get('output_file')}")
+                    with active_lock:
+                        active[job['job_id']] = job
+                    executor.submit(run_job, job)
+                if exit_when_idle and not claimed and not active:
+                    break
+                sleep(poll)
+    except KeyboardInterrupt:
+        logger.warning("合成进程被中断，未完成的任务将在租约过期后由其他合成进程重新领取")
+    finally:
+        stopped.set()
+        progress_mgr.close_all()
+    return 0
+
+# 合成失败的隔离区：每个失败任务一个目录，存放已下载的音视频流和清单 manifest.json，
+# 清单记录所属课程/集数和合成参数，remerge 命令据此离线重新合成，无需重新下载
+QUARANTINE_MANIFEST = 'manifest.json'
+MERGE_FUNCTIONS = {'merge': ffmpeg_merge, 'audio': ffmpeg_extract_audio}
+
+# 先确认输入都在、写好清单，再逐个移动；中途失败时把已移动的文件移回原处，任何情况下都不删除输入
+def quarantine_failed_merge(kind, merge_kwargs, episode):
+    job_id = f"{episode.get('original_index', 0):03d}_{uuid4().hex[:8]}"
+    job_dir = path.join(QUARANTINE_DIR, job_id)
+    merge_kwargs = dict(merge_kwargs)
+    moves = []
+    for key in ('video_file', 'audio_file'):
+        stream_file = merge_kwargs.get(key)
+        if not stream_file:
+            continue
+        if not path.exists(stream_file):
+            logger.error(f"无法保留合成失败的输入，文件不存在: {stream_file}")
+            return None
+        target = path.abspath(path.join(job_dir, path.basename(stream_file)))
+        moves.append((stream_file, target))
+        merge_kwargs[key] = target
+    merge_kwargs['output_file'] = path.abspath(merge_kwargs['output_file'])
+
+    moved = []
+    try:
+        makedirs(job_dir, exist_ok=True)
+        write_manifest(job_dir, {
+            'job_id': job_id, 'kind': kind, 'created': time(), 'episode': episode, 'merge': merge_kwargs,
+            'output_format': OUTPUT_FORMAT, 'faststart': OUTPUT_MUX_ARGS == '-movflags +faststart',
+            'attempts': 1,
+        })
+        for stream_file, target in moves:
+            shutil.move(stream_file, target)
+            moved.append((stream_file, target))
+    except Exception as e:
+        logger.error(f"无法保留合成失败的输入: {e}")
+        for stream_file, target in reversed(moved):
+            try:
+                shutil.move(target, stream_file)
+            except Exception as restore_error:
+                logger.error(f"无法移回 {target}: {restore_error}，文件仍保留在隔离目录中")
+                return None
+        try:
+            remove(path.join(job_dir, QUARANTINE_MANIFEST))
+        except OSError:
+            pass
+        try:
+            rmdir(job_dir)
+        except OSError:
+            pass
+        return None
+
+    # 输入都已移入隔离目录，原位置的校验记录不再需要
+    for stream_file, _ in moves:
+        if path.exists(stream_file + INTEGRITY_SUFFIX):
+            remove(stream_file + INTEGRITY_SUFFIX)
+    logger.warning(f"合成失败，输入已保留到 {job_dir}，修复后可运行 remerge 命令重新合成")
+    return job_dir
+
+def write_manifest(job_dir, manifest):
+    temp_path = path.join(job_dir, f"{QUARANTINE_MANIFEST}.tmp")
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        dump(manifest, f, indent=2, ensure_ascii=False)
+    replace(temp_path, path.join(job_dir, QUARANTINE_MANIFEST))
+
+def list_quarantine():
+    manifests = []
+    if not path.isdir(QUARANTINE_DIR):
+        return manifests
+    for name in sorted(listdir(QUARANTINE_DIR)):
+        try:
+            with open(path.join(QUARANTINE_DIR, name, QUARANTINE_MANIFEST), 'r', encoding='utf-8') as f:
+                manifests.append(dict(loads(f.read()), job_dir=path.join(QUARANTINE_DIR, name)))
+        except (OSError, ValueError):
+            continue
+    return manifests
+
+# 离线重新合成隔离区中的任务，成功的删除隔离目录，失败的更新清单中的次数和错误
+def run_remerge(job_ids=None, jobs=0, use_config=False, list_only=False):
+    config = load_config()
+    configure_workspace(config)
+    manifests = [m for m in list_quarantine() if not job_ids or m['job_id'] in job_ids]
+    if list_only or not manifests:
+        for m in manifests:
+            episode = m.get('episode', {})
+            print(f"{m['job_id']}  {episode.get('course_folder', '')}/{episode.get('original_index', 0):03d} "
+                  f"{episode.get('title', '')}  已失败 {m.get('attempts', 1)} 次")
+        if not manifests:
+            print("隔离区中没有需要重新合成的任务")
+        return 0
+    if not check_ffmpeg():
+        return 1
+    concurrent_ffmpeg, encode_threads, chunk_workers = configure_local_encoding(config, jobs)
+    x265_preset = config.get('General', 'x265_preset', fallback='medium')
+    # 使用当前配置的编码设置（预设、讲座配置、附加输出），用于修改配置后重试
+    overrides = {
+        'preset': x265_preset, 'profile': ENCODE_PROFILE, 'encoder': None,
+        'extra_outputs': parse_extra_outputs(config),
+    } if use_config else {}
+
+    def remerge(position, manifest):
+        kind = manifest.get('kind', 'merge')
+        merge_kwargs = dict(manifest['merge'], index=position, total_count=len(manifests))
+        if kind == 'merge':
+            merge_kwargs = local_merge_kwargs(dict(merge_kwargs, **overrides), encode_threads, chunk_workers, x265_preset)
+            merge_kwargs['mux_args'] = output_mux_args(manifest.get('output_format', 'mp4'), manifest.get('faststart', False))
+        makedirs(path.dirname(merge_kwargs['output_file']), exist_ok=True)
+        started = time()
+        try:
+            success = MERGE_FUNCTIONS[kind](**merge_kwargs)
+        except Exception as e:
+            logger.error(f"重新合成 {manifest['job_id']} 时出错: {e}")
+            success = False
+        if success:
+            encode_stats.record(merge_kwargs.get('duration'), started, time())
+            shutil.rmtree(manifest['job_dir'], ignore_errors=True)
+        else:
+            write_manifest(manifest['job_dir'], {
+                **{k: v for k, v in manifest.items() if k != 'job_dir'},
+                'attempts': manifest.get('attempts', 1) + 1, 'last_attempt': time(),
+            })
+        return success
+
+    logger.info(f"重新合成隔离区中的 {len(manifests)} 个任务，并行 {concurrent_ffmpeg} 个，每个 {encode_threads} 线程")
+    try:
+        with ThreadPoolExecutor(max_workers=concurrent_ffmpeg) as executor:
+            results = list(executor.map(remerge, range(1, len(manifests) + 1), manifests))
+    finally:
+        progress_mgr.close_all()
+    print(f"\n重新合成完成: {sum(results)}/{len(results)} 成功")
+    for manifest, success in zip(manifests, results):
+        if not success:
+            print(f"  仍然失败: {manifest['job_id']}，输入保留在 {manifest['job_dir']}")
+    return 0 if all(results) else 1
+
+# 延后转码队列：与分布式合成使用同样的任务目录结构，任务为对已保存成品的原地转码，
+# transcode 命令以 encode-worker 的方式领取执行，转码结果校验通过后原子替换原文件
+deferred_queue = None
+
+def init_deferred_queue(config):
+    global deferred_queue
+    deferred_queue = None
+    if config.getboolean('General', 'deferred_encode', fallback=False):
+        deferred_queue = open_deferred_queue(config)
+        logger.info(f"延后转码已开启，转码任务写入: {deferred_queue.root}")
+    return deferred_queue
+
+def open_deferred_queue(config):
+    queue_dir = config.get('General', 'deferred_queue_dir', fallback='').strip() or path.join(OUTPUT_DIR, 'encode_queue')
+    return EncodeSpool(queue_dir, config.getint('General', 'encode_lease_seconds', fallback=ENCODE_LEASE_SECONDS))
+
+# 把合成参数改写为对成品文件的原地转码任务；附加输出已在流复制合成时生成
+def enqueue_deferred_transcode(merge_kwargs, queue=None, output_format=None):
+    queue = queue or deferred_queue
+    output_file = path.abspath(merge_kwargs['output_file'])
+    job_id = queue.enqueue({
+        'merge': dict(merge_kwargs, video_file=output_file, audio_file=output_file, output_file=output_file,
+                      extra_outputs={}, in_place=True),
+        'output_format': output_format or OUTPUT_FORMAT,
+        'faststart': OUTPUT_MUX_ARGS == '-movflags +faststart',
+    })
+    logger.info(f"已加入延后转码队列 {job_id}: {output_file}")
+    return job_id
+
+MEDIA_DURATION_PATTERN = compile(r'Duration: (\d+):(\d+):(\d+(?:\.\d+)?)')
+MEDIA_VIDEO_PATTERN = compile(r'Stream #\S+.*?: Video: (\w+)')
+
+# 从 ffmpeg -i 的输出中读取视频编码和时长，只读文件头，很快
+def probe_media(file_path):
+    try:
+        result = run(['ffmpeg', '-hide_banner', '-i', file_path], stdout=PIPE, stderr=PIPE, text=True, errors='replace', timeout=30)
+    except TimeoutExpired:
+        return None, 0
+    codec = MEDIA_VIDEO_PATTERN.search(result.stderr)
+    duration = MEDIA_DURATION_PATTERN.search(result.stderr)
+    seconds = int(duration.group(1)) * 3600 + int(duration.group(2)) * 60 + float(duration.group(3)) if duration else 0
+    return (codec.group(1) if codec else None), seconds
+
+# 扫描已有的视频库，为其中仍是H264的成品加入转码任务；跳过临时、失败、队列目录和未完成的文件
+def enqueue_library(queue, library_dir, config):
+    extensions = {ext: name for name, (ext, _) in reversed(list(OUTPUT_FORMATS.items()))}
+    extensions[OUTPUT_EXTENSION] = OUTPUT_FORMAT
+    skipped_dirs = {path.abspath(d) for d in (SCRATCH_DIR, FAILED_DIR, queue.root)}
+    queued = set()
+    for state in ('pending', 'claimed'):
+        state_dir = path.join(queue.root, state)
+        for name in listdir(state_dir):
+            job = queue.read_json(path.join(state_dir, name)) if name.endswith('.json') else None
+            if job:
+                queued.add(job['merge']['output_file'])
+    options = {
+        'convert_to_h265': True,
+        'convert_framerate': config.getboolean('General', 'convert_framerate', fallback=False),
+        'target_framerate': config.getint('General', 'target_framerate', fallback=30),
+        'preset': config.get('General', 'x265_preset', fallback='medium'),
+        'profile': ENCODE_PROFILE,
+    }
+    candidates = []
+    for dirpath, dirnames, filenames in walk(library_dir):
+        dirnames[:] = sorted(d for d in dirnames if path.abspath(path.join(dirpath, d)) not in skipped_dirs)
+        for name in sorted(filenames):
+            root, ext = path.splitext(name)
+            if ext not in extensions or root.endswith(('.part', '.original')):
+                continue
+            file_path = path.abspath(path.join(dirpath, name))
+            if file_path in queued:
+                continue
+            codec, duration = probe_media(file_path)
+            if codec == 'h264':
+                candidates.append((file_path, format_title(root), duration, extensions[ext]))
+    for index, (file_path, title, duration, output_format) in enumerate(candidates, 1):
+        enqueue_deferred_transcode(dict(options, output_file=file_path, title=title, index=index,
+                                        total_count=len(candidates), duration=duration), queue, output_format)
+    return len(candidates)
+
+# 集中处理延后转码队列：可先把已有视频库加入队列，处理完队列中的任务后退出
+def run_transcode(jobs=0, library=None, enqueue_only=False):
+    config = load_config()
+    configure_workspace(config)
+    # GPU由合成进程检测
+    configure_merge_settings(config, detect_gpu=False)
+    queue = open_deferred_queue(config)
+    if library:
+        if not check_ffmpeg():
+            return 1
+        print(f"已把 {enqueue_library(queue, library, config)} 个H264视频加入转码队列 {queue.root}")
+    if enqueue_only:
+        return 0
+    started = time()
+    code = run_encode_worker(queue.root, jobs, poll=1.0, exit_when_idle=True)
+    # 汇总本次处理的任务，成功的记录删除，失败的保留以便查看
+    done_dir = path.join(queue.root, 'done')
+    succeeded, failed = 0, []
+    for name in sorted(listdir(done_dir)):
+        result = queue.read_json(path.join(done_dir, name)) if name.endswith('.json') else None
+        if not result or result.get('finished', 0) < started:
+            continue
+        if result.get('success'):
+            succeeded += 1
+            remove(path.join(done_dir, name))
+        else:
+            failed.append(name[:-5])
+    print(f"\n延后转码完成: {succeeded} 个成功，{len(failed)} 个失败")
+    for job_id in failed:
+        print(f"  失败: {job_id}，原文件保持不变，结果见 {path.join(done_dir, job_id + '.json')}")
+    return code or (1 if failed else 0)
+
+PSNR_PATTERN = compile(r'PSNR .*average:([\d.]+|inf)')
+
+# 试编码输出相对样片的平均PSNR
+def measure_psnr(encoded_file, input_args):
+    cmd_line = (f'ffmpeg -hide_banner -nostats -i "{encoded_file}" {input_args} '
+                f'-lavfi "[0:v]format=yuv420p[a];[1:v:0]format=yuv420p[b];[a][b]psnr" -f null -')
+    try:
+        result = run(cmd_line, shell=True, stdout=PIPE, stderr=PIPE, text=True, errors='replace', timeout=600)
+    except TimeoutExpired:
+        return None
+    match = PSNR_PATTERN.search(result.stderr)
+    if not match:
+        logger.warning(f"无法计算 {encoded_file} 的PSNR")
+        return None
+    return 100.0 if match.group(1) == 'inf' else round(float(match.group(1)), 2)
+
+# 编码器校准：用同一段样片试编码每个可用的编码器/预设，记录速度和输出大小，按速度排序保存
+# 没有指定样片时用 testsrc2 合成画面，它的运动量比讲课视频大，适合比较编码器之间的相对快慢
+def run_calibration(source=None, duration=5, size='1280x720', framerate=30, encoders=None):
+    config = load_config()
+    if not check_ffmpeg():
+        return 1
+    configure_workspace(config)
+    ensure_dirs()
+    configure_encoder_priority(
+        config.getint('General', 'encode_nice', fallback=10),
+        config.get('General', 'encode_cpuset', fallback='').strip()
+    )
+    if source:
+        input_args = f'-t {duration} -i "{source}"'
+        sample = {'source': path.abspath(source), 'duration': duration}
+    else:
+        input_args = f'-f lavfi -i testsrc2=size={size}:rate={framerate}:duration={duration}'
+        sample = {'source': 'testsrc2', 'size': size, 'framerate': framerate, 'duration': duration}
+    target = path.join(SCRATCH_DIR, f'calibrate_{getpid()}.mkv')
+
+    results = []
+    print(f"{'编码器':<18} {'预设':<10} {'速度(fps)':>10} {'输出大小':>10} {'PSNR(dB)':>9}")
+    for encoder, (codec, presets) in CALIBRATION_ENCODERS.items():
+        if encoders and encoder not in encoders:
+            continue
+        if not check_encoder_supported(encoder):
+            continue
+        for preset in presets:
+            preset_args = f'-preset {preset}' if preset else ''
+            cmd_line = f'ffmpeg -y {input_args} -map 0:v:0 -c:v {encoder} {preset_args} -pix_fmt yuv420p -an "{target}"'
+            started = monotonic()
+            return_code, stderr_tail, last_progress = run_ffmpeg_with_progress(cmd_line)
+            elapsed = monotonic() - started
+            frames = int(last_progress.get('frame') or 0)
+            if return_code != 0 or not frames or not path.exists(target):
+                # 硬件编码器列在 -encoders 中，但本机没有对应硬件时会在这里失败
+                logger.warning(f"{encoder} {preset} 试编码失败，跳过该编码器\n{stderr_tail}")
+                results.append({'encoder': encoder, 'codec': codec, 'preset': preset, 'ok': False})
+                break
+            result = {
+                'encoder': encoder, 'codec': codec, 'preset': preset, 'ok': True,
+                'fps': round(frames / elapsed, 2), 'bytes': path.getsize(target), 'seconds': round(elapsed, 2),
+                'psnr': measure_psnr(target, input_args),
+            }
+            results.append(result)
+            print(f"{encoder:<18} {preset or '-':<10} {result['fps']:>10.1f} {format_size(result['bytes']):>10} "
+                  f"{result['psnr'] or 0:>9.2f}")
+    if path.exists(target):
+        remove(target)
+
+    if not any(r['ok'] for r in results):
+        logger.error("没有可用的编码器完成试编码，未保存校准结果")
+        return 1
+    results.sort(key=lambda r: (r['ok'], r.get('fps', 0)), reverse=True)
+    profile = {'host': gethostname(), 'created': time(), 'cpus': usable_cpu_count(), 'sample': sample, 'results': results}
+    try:
+        with open(ENCODER_PROFILE_FILE, 'w', encoding='utf-8') as f:
+            f.write(dumps(profile, indent=2, ensure_ascii=False))
+    except OSError as e:
+        logger.error(f"无法保存校准结果: {e}")
+        return 1
+    print(f"\n校准结果已保存到 {ENCODER_PROFILE_FILE}")
+
+    # 按当前配置显示合成时会选用的编码器
+    configure_encoder_selection(config)
+    if SELECTED_ENCODER:
+        print(f"按当前配置将选用: {SELECTED_ENCODER['encoder']} {SELECTED_ENCODER['preset'] or ''}".rstrip() +
+              f"（{SELECTED_ENCODER['fps']:.1f} fps，输出为参考大小的 {SELECTED_ENCODER['size_ratio']:.0%}）")
+    else:
+        print("按当前配置没有满足大小目标的编码器，将使用默认编码设置")
+    return 0
+
+# 命令行子命令；不带参数时运行交互式下载
+def run_command(args):
+    parser = ArgumentParser(description='B站课程下载器')
+    commands = parser.add_subparsers(dest='command', required=True)
+    worker_parser = commands.add_parser('encode-worker', help='从共享任务目录领取并执行合成任务')
+    worker_parser.add_argument('--spool', help='任务目录，默认使用配置文件中的 encode_spool_dir')
+    worker_parser.add_argument('--jobs', type=int, default=0, help='并行合成数，默认按本机CPU计算')
+    worker_parser.add_argument('--poll', type=float, default=2.0, help='没有任务时的轮询间隔（秒）')
+    worker_parser.add_argument('--exit-when-idle', action='store_true', help='任务目录为空时退出')
+    calibrate_parser = commands.add_parser('calibrate', help='在本机试编码各编码器和预设，保存速度和输出大小供合成时选择')
+    calibrate_parser.add_argument('--source', help='样片路径，默认使用合成的测试画面')
+    calibrate_parser.add_argument('--duration', type=float, default=5, help='试编码时长（秒）')
+    calibrate_parser.add_argument('--size', default='1280x720', help='合成测试画面的分辨率')
+    calibrate_parser.add_argument('--framerate', type=int, default=30, help='合成测试画面的帧率')
+    calibrate_parser.add_argument('--encoders', help='只校准指定的编码器，逗号分隔')
+    remerge_parser = commands.add_parser('remerge', help='离线重新合成 failed/quarantine 中合成失败的任务')
+    remerge_parser.add_argument('ids', nargs='*', help='只重新合成指定的任务，默认全部')
+    remerge_parser.add_argument('--jobs', type=int, default=0, help='并行合成数，默认按本机CPU计算')
+    remerge_parser.add_argument('--use-config', action='store_true', help='使用当前配置文件中的编码设置，而不是失败时记录的设置')
+    remerge_parser.add_argument('--list', action='store_true', help='只列出隔离区中的任务')
+    transcode_parser = commands.add_parser('transcode', help='处理延后转码队列，原地替换已保存的视频')
+    transcode_parser.add_argument('--jobs', type=int, default=0, help='并行转码数，默认按本机CPU计算')
+    transcode_parser.add_argument('--library', help='先把该目录下仍为H264的视频加入队列，用于批量压缩已有视频库')
+    transcode_parser.add_argument('--enqueue-only', action='store_true', help='只加入队列，不执行')
+    sync_parser = commands.add_parser('sync', help='增量同步课程：只下载新增、变更或成品缺失的集数')
+    sync_parser.add_argument('courses', nargs='+', help='课程ID，如 ss360')
+    sync_parser.add_argument('--watch', type=float, default=0, help='每隔N分钟再同步一次，直到按 Ctrl+C 退出')
+    sync_parser.add_argument('--dry-run', action='store_true', help='只列出需要下载的集数')
+    options = parser.parse_args(args)
+    if options.command == 'sync':
+        try:
+            return asyncio_run(run_sync(options.courses, options.watch, options.dry_run))
+        except KeyboardInterrupt:
+            logger.warning("\n同步被用户中断")
+            return 1
+    if options.command == 'transcode':
+        return run_transcode(options.jobs, options.library, options.enqueue_only)
+    if options.command == 'remerge':
+        return run_remerge(options.ids, options.jobs, options.use_config, options.list)
+    if options.command == 'encode-worker':
+        return run_encode_worker(options.spool, options.jobs, options.poll, options.exit_when_idle)
+    if options.command == 'calibrate':
+        encoders = [e.strip() for e in options.encoders.split(',') if e.strip()] if options.encoders else None
+        return run_calibration(options.source, options.duration, options.size, options.framerate, encoders)
+    return 0
+
+# 预估与实测性能：保存上次运行测得的单连接下载速度和各编码方式的速度，供下载计划估算使用
+PERFORMANCE_FILE = './performance.json'
+# 没有实测数据时使用的保守默认值
+DEFAULT_DOWNLOAD_SPEED = 4 * 1024 * 1024  # 单连接字节/秒
+DEFAULT_ENCODE_SPEED = {'copy': 100.0, 'h265_cpu': 1.0, 'h265_gpu': 8.0, 'audio': 200.0,
+                        'h265_cpu_lecture': 4.0, 'h265_gpu_lecture': 16.0}  # 单个合成进程的实时倍率
+# H265转换后视频流相对原H264流的大小比例
+H265_SIZE_RATIO = 0.6
+
+def load_performance():
+    try:
+        with open(PERFORMANCE_FILE, 'r', encoding='utf-8') as f:
+            return loads(f.read())
+    except (OSError, ValueError):
+        return {}
+
+# 与上次的实测值做平滑，避免单次运行的波动
+def save_performance(download_speed=None, encode_mode=None, encode_speed=None):
+    performance = load_performance()
+    if download_speed:
+        old = performance.get('download_speed')
+        performance['download_speed'] = (old + download_speed) / 2 if old else download_speed
+    if encode_mode and encode_speed:
+        speeds = performance.setdefault('encode_speed', {})
+        old = speeds.get(encode_mode)
+        speeds[encode_mode] = (old + encode_speed) / 2 if old else encode_speed
+    try:
+        with open(PERFORMANCE_FILE, 'w', encoding='utf-8') as f:
+            f.write(dumps(performance, indent=2))
+    except OSError as e:
+        logger.warning(f"无法保存性能数据: {e}")
+
+def encode_mode_name(convert_to_h265, audio_only=False):
+    if audio_only:
+        return 'audio'
+    if not convert_to_h265:
+        return 'copy'
+    mode = 'h265_gpu' if NVIDIA_GPU_SUPPORTED else 'h265_cpu'
+    # 讲座配置丢弃重复帧后编码快得多，单独记录速度
+    return f'{mode}_lecture' if ENCODE_PROFILE == 'lecture' else mode
+
+# 下载阶段的吞吐统计，单连接速度 = 下载字节数 / 各集下载耗时之和
+class DownloadStats:
+    def __init__(self):
+        self.lock = Lock()
+        self.bytes = 0
+        self.busy_seconds = 0
+
+    def record(self, nbytes, started, finished):
+        with self.lock:
+            self.bytes += nbytes
+            self.busy_seconds += finished - started
+
+    def speed(self):
+        with self.lock:
+            return self.bytes / self.busy_seconds if self.bytes and self.busy_seconds > 0 else None
+
+download_stats = DownloadStats()
+
+# 下载计划：按每集的DASH码率和时长估算下载量、临时空间峰值、输出大小和耗时
+class JobPlan:
+    def __init__(self, episodes, concurrent_downloads, concurrent_ffmpeg, convert_to_h265=False,
+                 chunk_min_duration=0, chunk_workers=1, audio_only=False, extra_outputs=None):
+        self.episodes = episodes  # original_index -> 每集的预估
+        self.concurrent_downloads = concurrent_downloads
+        self.concurrent_ffmpeg = concurrent_ffmpeg
+        self.mode = encode_mode_name(convert_to_h265, audio_only)
+        performance = load_performance()
+        self.download_speed = performance.get('download_speed') or DEFAULT_DOWNLOAD_SPEED
+        encode_speeds = dict(DEFAULT_ENCODE_SPEED, **performance.get('encode_speed', {}))
+        self.encode_speed = encode_speeds[self.mode]
+        copy_speed = encode_speeds['copy']
+        self.measured = bool(performance)
+        for estimate in episodes.values():
+            transcode = self.mode.startswith('h265') and estimate['video_codec'] == 'avc'
+            video_output = estimate['video_bytes'] * (H265_SIZE_RATIO if transcode else 1)
+            estimate['output_bytes'] = int(video_output + estimate['audio_bytes'])
+            # 附加输出：原始存档为原音视频流大小（流复制时与主输出为同一文件的链接），音频文件约为音频流大小
+            if extra_outputs and 'original' in extra_outputs and transcode:
+                estimate['output_bytes'] += estimate['video_bytes'] + estimate['audio_bytes']
+            if extra_outputs and 'audio' in extra_outputs:
+                estimate['output_bytes'] += estimate['audio_bytes']
+            # 分段并行编码需要额外存放切分和编码后的分段
+            scratch = estimate['video_bytes'] + estimate['audio_bytes']
+            if (transcode and self.mode == 'h265_cpu' and chunk_workers > 1
+                    and chunk_min_duration and estimate['duration'] >= chunk_min_duration):
+                scratch += estimate['video_bytes'] + int(video_output)
+            estimate['scratch_bytes'] = scratch
+            estimate['download_seconds'] = (estimate['video_bytes'] + estimate['audio_bytes']) / self.download_speed
+            estimate['encode_seconds'] = estimate['duration'] / (self.encode_speed if transcode or audio_only else copy_speed)
+            if '+faststart' in OUTPUT_MUX_ARGS:
+                estimate['encode_seconds'] += estimate['output_bytes'] * 2 / FASTSTART_DISK_SPEED
+
+    def totals(self):
+        episodes = self.episodes.values()
+        download_bytes = sum(e['video_bytes'] + e['audio_bytes'] for e in episodes)
+        # 同时占用临时空间的最多为 下载中 + 合成中 的集数
+        holders = self.concurrent_downloads + self.concurrent_ffmpeg
+        peak_scratch = sum(sorted((e['scratch_bytes'] for e in episodes), reverse=True)[:holders])
+        download_wall = sum(e['download_seconds'] for e in episodes) / max(1, self.concurrent_downloads)
+        encode_wall = sum(e['encode_seconds'] for e in episodes) / max(1, self.concurrent_ffmpeg)
+        # 下载和合成流水线并行，总耗时约为较慢一端加上另一端处理一集的时间
+        count = max(1, len(self.episodes))
+        makespan = max(download_wall, encode_wall) + min(download_wall, encode_wall) / count
+        return {
+            'episodes': len(self.episodes),
+            'media_seconds': sum(e['duration'] for e in episodes),
+            'download_bytes': download_bytes,
+            'output_bytes': sum(e['output_bytes'] for e in episodes),
+            'peak_scratch_bytes': peak_scratch,
+            'download_seconds': download_wall,
+            'encode_seconds': encode_wall,
+            'makespan_seconds': makespan,
+        }
+
+    # 检查临时目录和输出目录所在磁盘的剩余空间，返回问题列表
+    def check_space(self, min_free_bytes=0):
+        totals = self.totals()
+        problems = []
+        scratch_usage = shutil.disk_usage(SCRATCH_DIR)
+        output_usage = shutil.disk_usage(OUTPUT_DIR)
+        same_volume = stat(SCRATCH_DIR).st_dev == stat(OUTPUT_DIR).st_dev
+        scratch_need = totals['peak_scratch_bytes'] + min_free_bytes
+        output_need = totals['output_bytes'] + (scratch_need if same_volume else 0)
+        if not same_volume and scratch_usage.free < scratch_need:
+            problems.append(f"临时目录剩余 {format_size(scratch_usage.free)}，预计峰值需要 {format_size(scratch_need)}")
+        if output_usage.free < output_need:
+            problems.append(f"输出目录剩余 {format_size(output_usage.free)}，预计需要 {format_size(output_need)}")
+        return problems
+
+    def report(self):
+        totals = self.totals()
+        source = "上次运行的实测速度" if self.measured else "默认速度（运行一次后将使用实测值）"
+        lines = [
+            f"\n== 下载计划 ({totals['episodes']} 集，总时长 {format_duration(totals['media_seconds'])}) ==",
+            f"下载量: {format_size(totals['download_bytes'])}",
+            f"临时空间峰值: {format_size(totals['peak_scratch_bytes'])}（并行下载 {self.concurrent_downloads}，并行合成 {self.concurrent_ffmpeg}）",
+            f"输出大小: {format_size(totals['output_bytes'])}",
+            f"下载耗时: {format_duration(totals['download_seconds'])}（单连接 {format_size(self.download_speed)}/s）",
+            f"合成耗时: {format_duration(totals['encode_seconds'])}（{self.mode}，单进程 {self.encode_speed:.2f}x 实时）",
+            f"预计总耗时: {format_duration(totals['makespan_seconds'])}，估算依据: {source}",
+        ]
+        if '+faststart' in OUTPUT_MUX_ARGS:
+            # faststart 在合成结束后把整个文件再读写一遍
+            rewrite_bytes = totals['output_bytes'] * 2
+            lines.append(f"faststart 额外读写: {format_size(rewrite_bytes)}，"
+                         f"约 {format_duration(rewrite_bytes / FASTSTART_DISK_SPEED)}（按 {format_size(FASTSTART_DISK_SPEED)}/s 磁盘估算）")
+        return "\n".join(lines)
+
+    # 每集的工作量（预计单槽位耗时秒数），用于整体进度条和ETA
+    def download_cost(self, original_index):
+        estimate = self.episodes.get(original_index)
+        return estimate['download_seconds'] / max(1, self.concurrent_downloads) if estimate else 0
+
+    def encode_cost(self, original_index):
+        estimate = self.episodes.get(original_index)
+        return estimate['encode_seconds'] / max(1, self.concurrent_ffmpeg) if estimate else 0
+
+    def total_cost(self):
+        return sum(self.download_cost(i) + self.encode_cost(i) for i in self.episodes)
+
+def format_size(nbytes):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(nbytes) < 1024:
+            return f"{nbytes:.1f}{unit}"
+        nbytes /= 1024
+    return f"{nbytes:.2f}TB"
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds < 60:
+        return f"{seconds}秒"
+    if seconds < 3600:
+        return f"{seconds // 60}分{seconds % 60}秒"
+    return f"{seconds // 3600}小时{seconds % 3600 // 60}分"
+
+# 按预计工作量从大到小排序（最长处理时间优先），避免最后只剩一个长视频在跑而其他槽位空闲
+# early_count > 0 时，课程顺序的前N集先处理，方便尽早观看
+def order_episodes(selected_episodes, plan, early_count=0):
+    early = selected_episodes[:early_count]
+    rest = sorted(
+        selected_episodes[early_count:],
+        key=lambda item: plan.download_cost(item[0]) + plan.encode_cost(item[0]),
+        reverse=True
+    )
+    return early + rest
+
+# 获取每集的时长和DASH码率，构建下载计划
+async def build_job_plan(selected_episodes, concurrent_downloads, concurrent_ffmpeg, convert_to_h265=False,
+                         chunk_min_duration=0, chunk_workers=1, audio_only=False, extra_outputs=None):
+    # 各集并发获取，由 ApiClient 统一限速；下载地址进入缓存，之后下载时不再重复请求
+    async def estimate(original_index, ep):
+        try:
+            meta = await api_client.episode_meta(ep)
+            download_url_data = await api_client.download_url(ep)
+            streams = video.VideoDownloadURLDataDetecter(data=download_url_data).detect_best_streams()
+            duration = meta.get('duration', 0) or 0
+            return original_index, {
+                'title': meta.get('title', ''),
+                'duration': duration,
+                'video_bytes': 0 if audio_only else estimate_stream_bytes(streams[0], duration),
+                'audio_bytes': estimate_stream_bytes(streams[1], duration),
+                'video_codec': getattr(streams[0].video_codecs, 'name', 'AVC').lower(),
+            }
+        except Exception as e:
+            logger.warning(f"无法获取第 {original_index} 集的信息，计划中忽略该集: {e}")
+            return original_index, None
+    results = await gather(*(estimate(original_index, ep) for original_index, ep in selected_episodes))
+    estimates = {original_index: values for original_index, values in results if values}
+    return JobPlan(estimates, concurrent_downloads, concurrent_ffmpeg, convert_to_h265, chunk_min_duration, chunk_workers, audio_only,
+                   extra_outputs)
+
+# 整体进度：按下载计划中每集的预计工作量推进，ETA随实际速度修正
+class JobProgress:
+    def __init__(self, plan):
+        self.plan = plan
+        self.bar = progress_mgr.create_bar('job_total', round(plan.total_cost(), 1), '总进度', position=10, unit='s', leave=True)
+        self.bar.set_postfix_str(f"预计 {format_duration(plan.totals()['makespan_seconds'])}")
+
+    def downloaded(self, original_index):
+        progress_mgr.update_bar('job_total', self.plan.download_cost(original_index))
+
+    def merged(self, original_index):
+        progress_mgr.update_bar('job_total', self.plan.encode_cost(original_index))
+
+    def close(self):
+        progress_mgr.close_bar('job_total')
+
+# 下载链接过期时重新获取同一路流的 [主链接, 备用链接...]
+async def resolve_stream_urls(ep, stream_index):
+    download_url_data = await api_client.download_url(ep, fresh=True)
+    stream = video.VideoDownloadURLDataDetecter(data=download_url_data).detect_best_streams()[stream_index]
+    return [stream.url, *(stream.backup_url or [])]
+
+# 成品文件名：原始序号加清理后的标题，扩展名取决于输出格式或仅音频模式的音频编码
+def episode_output_name(original_index, title, audio_options=None):
+    output_extension = AUDIO_FORMATS[audio_options.get('codec', 'copy')][0] if audio_options is not None else OUTPUT_EXTENSION
+    return f"{original_index:03d}_{sanitize_filename(title)}{output_extension}"
+
 # 处理单个视频的下载和合成 - 优化为一节课一节课处理
 async def process_episode(ep, position_index, total_count, semaphore, course_folder, 
                           original_index, convert_to_h265=False, convert_framerate=False, 
-                          target_framerate=30, max_retries=3, retry_delay=5):
+                          target_framerate=30, max_retries=3, retry_delay=5, merge_options=None,
+                          download_options=None, ffmpeg_executor=None, job_progress=None, audio_options=None):
+    scratch_reserved = 0
+    # audio_options 不为 None 时为仅音频模式，只下载音频流
+    audio_only = audio_options is not None
     try:
         async with semaphore:
             # 基础参数配置
             ep_id = ep.get_epid()
-            original_title = (await ep.get_meta())['title']
+            meta = await api_client.episode_meta(ep)
+            original_title = meta['title']
             # 替换非法字符
             safe_title = sanitize_filename(original_title)
             title = format_title(safe_title)  # 格式化标题用于显示
             
             # 获取音频和视频的链接，并设置本地保存的文件名
             filename_prefix = f"{original_index}_{uuid4().hex}"
-            download_url_data = await ep.get_download_url()
+            download_url_data = await api_client.download_url(ep)
             
             # 解析下载链接
             detector = video.VideoDownloadURLDataDetecter(data=download_url_data)
             streams = detector.detect_best_streams()
             
             # 在这里定义 audio_file 和 video_file
-            audio_file = f"./download/temp/{filename_prefix}_audio.m4s"
-            video_file = f"./download/temp/{filename_prefix}_video.m4s"
+            audio_file = path.join(SCRATCH_DIR, f"{filename_prefix}_audio.m4s")
+            video_file = path.join(SCRATCH_DIR, f"{filename_prefix}_video.m4s")
             
             # 使用课程文件夹保存文件，使用原始序号作为文件名前缀
-            output_file = f"./download/{course_folder}/{original_index:03d}_{safe_title}.mp4"
+            output_file = path.join(OUTPUT_DIR, course_folder, episode_output_name(original_index, original_title, audio_options))
             
             # 确保课程文件夹存在
-            makedirs(f"./download/{course_folder}", exist_ok=True)
+            makedirs(path.join(OUTPUT_DIR, course_folder), exist_ok=True)
             
-            # 下载音频和视频
-            await download_file(streams[1].url, audio_file, title, position_index, total_count, "audio [1/3]", max_retries, retry_delay)
-            await download_file(streams[0].url, video_file, title, position_index, total_count, "video [2/3]", max_retries, retry_delay)
+            # 预留临时空间，直到合成完成后释放
+            if scratch_space:
+                scratch_reserved = sum(estimate_stream_bytes(stream, meta.get('duration', 0))
+                                       for stream in (streams[1:2] if audio_only else streams[:2]))
+                await scratch_space.acquire(scratch_reserved)
+            
+            # 下载音频和视频，启用缓存时先查缓存
+            cid = meta.get('cid') or ep_id
+            stream_jobs = [(1, audio_file, "audio [1/2]")] if audio_only else \
+                [(1, audio_file, "audio [1/3]"), (0, video_file, "video [2/3]")]
+            for stream_index, stream_file, task_type in stream_jobs:
+                stream = streams[stream_index]
+                cache_key = stream_cache_key(cid, stream)
+                if stream_cache and stream_cache.fetch(cache_key, stream_file):
+                    continue
+                download_started = time()
+                downloader = download_pool.download if download_pool else download_file
+                await downloader(stream.url, stream_file, title, position_index, total_count, task_type, max_retries, retry_delay,
+                                    backup_urls=stream.backup_url or (),
+                                    resolve_urls=partial(resolve_stream_urls, ep, stream_index),
+                                    **(download_options or {}))
+                download_stats.record(path.getsize(stream_file) if path.exists(stream_file) else 0, download_started, time())
+                if stream_cache:
+                    stream_cache.store(cache_key, stream_file)
             
             # 验证下载的文件是否存在且大小大于0
             if not path.exists(audio_file) or path.getsize(audio_file) == 0:
                 raise Exception(f"音频文件下载失败或大小为0: {audio_file}")
-            if not path.exists(video_file) or path.getsize(video_file) == 0:
+            if not audio_only and (not path.exists(video_file) or path.getsize(video_file) == 0):
                 raise Exception(f"视频文件下载失败或大小为0: {video_file}")
+            if job_progress:
+                job_progress.downloaded(original_index)
             
-            # 获取视频时长用于进度条
-            video_meta = await ep.get_meta()
-            duration = video_meta.get('duration', 0)
+        # 合成阶段不占用下载并发名额，下载槽位释放后即可开始下一集的下载
+        # 获取视频时长用于进度条
+        duration = meta.get('duration', 0)
 
-            # 获取视频原始帧率
-            original_framerate = None
-            if convert_framerate:
-                try:
-                    # 使用新函数确保正确检测帧率
-                    original_framerate = detect_video_framerate(video_file)
-                    if original_framerate:
-                        logger.info(f"检测到视频原始帧率: {original_framerate}fps")
-                    else:
-                        logger.warning("无法检测视频帧率，使用默认值60fps")
-                        original_framerate = 60.0  # 设置合理的默认值
-                except Exception as e:
-                    logger.error(f"检测视频帧率失败: {e}")
+        # 获取视频原始帧率
+        original_framerate = None
+        if convert_framerate and not audio_only:
+            try:
+                # 使用新函数确保正确检测帧率
+                original_framerate = detect_video_framerate(video_file)
+                if original_framerate:
+                    logger.info(f"检测到视频原始帧率: {original_framerate}fps")
+                else:
+                    logger.warning("无法检测视频帧率，使用默认值60fps")
                     original_framerate = 60.0  # 设置合理的默认值
-            
-            # 立即处理合成任务
-            result = ffmpeg_merge(
-                video_file, 
-                audio_file, 
-                output_file, 
-                title, 
-                position_index, 
-                total_count, 
-                duration,
-                convert_to_h265,  # 传入转换标志
-                convert_framerate,  # 帧率转换标志
-                target_framerate,  # 目标帧率
-                original_framerate  # 原始帧率
-            )
-            
-            return {"success": result, "position_index": position_index, "original_index": original_index, "episode": ep}
+            except Exception as e:
+                logger.error(f"检测视频帧率失败: {e}")
+                original_framerate = 60.0  # 设置合理的默认值
+        
+        # 交给合成线程池执行，避免编码阻塞驱动下载的事件循环
+        deferred_kwargs = None
+        if audio_only:
+            merge_kwargs = {
+                'audio_file': audio_file, 'output_file': output_file, 'title': title,
+                'index': position_index, 'total_count': total_count, 'duration': duration,
+                **audio_options
+            }
+            merge_call = partial(ffmpeg_extract_audio, **merge_kwargs)
+        else:
+            merge_kwargs = {
+                'video_file': video_file, 'audio_file': audio_file, 'output_file': output_file,
+                'title': title, 'index': position_index, 'total_count': total_count, 'duration': duration,
+                'convert_to_h265': convert_to_h265, 'convert_framerate': convert_framerate,
+                'target_framerate': target_framerate, 'original_framerate': original_framerate,
+                **(merge_options or {})  # 其他编码选项（预设等）
+            }
+            # 延后转码：现在只流复制合成，转换参数留给队列中的转码任务
+            if deferred_queue and (convert_to_h265 or convert_framerate):
+                deferred_kwargs = dict(merge_kwargs)
+                merge_kwargs.update(convert_to_h265=False, convert_framerate=False)
+            merge_call = partial(ffmpeg_merge, **merge_kwargs)
+        
+        # 在合成线程内计时，不把排队等待计入编码耗时
+        def timed_merge():
+            merge_started = time()
+            merged = merge_call()
+            if merged:
+                encode_stats.record(duration, merge_started, time())
+            return merged
+        
+        result = None
+        if encode_spool and not audio_only:
+            # 提交到共享任务目录，由其他机器上的合成进程执行
+            result = await spool_merge(dict(merge_kwargs), duration)
+        # 未使用任务目录，或任务无人领取已撤回时在本机合成
+        if result is None and ffmpeg_executor:
+            result = await get_running_loop().run_in_executor(ffmpeg_executor, timed_merge)
+        elif result is None:
+            result = timed_merge()
+        if job_progress:
+            job_progress.merged(original_index)
+        if result and deferred_kwargs:
+            enqueue_deferred_transcode(deferred_kwargs)
+        # 下载完整但合成失败的，保留输入以便修好编码问题后用 remerge 命令重新合成
+        if not result and KEEP_FAILED_INPUTS:
+            quarantine_failed_merge('audio' if audio_only else 'merge', merge_kwargs, {
+                'ep_id': ep_id, 'title': original_title, 'original_index': original_index, 'course_folder': course_folder,
+            })
+        
+        return {"success": result, "position_index": position_index, "original_index": original_index, "episode": ep}
             
     except Exception as e:
         logger.error(f"处理视频 {position_index} 时出错: {e}")
         # 尝试清理可能的临时文件
         try:
             # 使用 locals().get() 安全地检查变量是否存在
-            if 'audio_file' in locals() and path.exists(audio_file):
-                remove(audio_file)
-            if 'video_file' in locals() and path.exists(video_file):
-                remove(video_file)
+            if 'audio_file' in locals():
+                remove_stream_file(audio_file)
+            if 'video_file' in locals():
+                remove_stream_file(video_file)
         except Exception:
             pass
         
@@ -931,129 +3731,339 @@ async def process_episode(ep, position_index, total_count, semaphore, course_fol
             "episode": ep,
             "error": str(e)
         }
-        with open(f"./download/failed/{original_index:03d}_error.json", "w", encoding="utf-8") as f:
-            dumps(error_info, f, indent=2, ensure_ascii=False)
+        with open(path.join(FAILED_DIR, f"{original_index:03d}_error.json"), "w", encoding="utf-8") as f:
+            dump(error_info, f, indent=2, ensure_ascii=False, default=str)
             
         return {"success": False, "position_index": position_index, "original_index": original_index, "episode": ep, "error": str(e)}
+    finally:
+        if scratch_reserved:
+            await scratch_space.release(scratch_reserved)
+
+# 增量同步：每个课程目录下保存同步记录（各集的ep_id、cid和成品文件名），
+# 与课程列表对比后只下载新增、变更或成品缺失的集数，不需要交互选择范围
+SYNC_JOURNAL = '.sync.json'
+SYNC_AUDIO_JOURNAL = '.sync_audio.json'  # 仅音频模式的成品与视频不同，分开记录
+SYNC_DOWNLOAD_KINDS = {'new': '新增', 'changed': '已变更', 'missing': '成品缺失'}
+
+def load_sync_journal(journal_file):
+    try:
+        with open(journal_file, 'r', encoding='utf-8') as f:
+            journal = loads(f.read())
+    except (FileNotFoundError, ValueError):
+        journal = {}
+    journal.setdefault('episodes', {})
+    return journal
+
+def save_sync_journal(journal_file, journal):
+    temp_path = f"{journal_file}.{uuid4().hex}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        dump(journal, f, indent=2, ensure_ascii=False)
+    replace(temp_path, journal_file)
+
+# 课程信息接口中包含各集的 id 和 cid，据此计算指纹；指纹未变且成品都在时不需要再获取课程列表
+def course_fingerprint(course_info):
+    episodes = course_info.get('episodes')
+    if not episodes:
+        return None
+    return sha256(dumps([[ep.get('id'), ep.get('cid')] for ep in episodes]).encode()).hexdigest()
+
+def journal_files_present(course_dir, journal):
+    return all(path.exists(path.join(course_dir, entry['file'])) for entry in journal['episodes'].values())
+
+# 对比课程列表与同步记录，listing 为 [(原始序号, 单集对象, 元数据)]
+def plan_sync(course_dir, journal, listing, audio_options=None):
+    plan = {'new': [], 'changed': [], 'missing': [], 'adopted': [], 'unchanged': []}
+    for original_index, ep, meta in listing:
+        entry = journal['episodes'].get(str(ep.get_epid()))
+        if entry and entry.get('cid') == meta.get('cid'):
+            kind = 'unchanged' if path.exists(path.join(course_dir, entry['file'])) else 'missing'
+        elif entry:
+            kind = 'changed'
+        else:
+            # 没有同步记录但成品已存在（例如之前交互下载的），直接记入同步记录
+            name = episode_output_name(original_index, meta['title'], audio_options)
+            kind = 'adopted' if path.exists(path.join(course_dir, name)) else 'new'
+        plan[kind].append((original_index, ep, meta))
+    return plan
+
+def journal_entry(original_index, meta, audio_options=None):
+    return {
+        'cid': meta.get('cid'), 'index': original_index, 'title': meta.get('title'),
+        'duration': meta.get('duration'), 'file': episode_output_name(original_index, meta['title'], audio_options),
+        'synced': int(time()),
+    }
+
+# 同步时的下载和合成设置全部取自配置文件
+def sync_settings(config):
+    audio_only = config.getboolean('General', 'audio_only', fallback=False)
+    concurrent_ffmpeg, merge_options, audio_options = configure_merge_settings(config, audio_only)
+    settings = {
+        'convert_to_h265': False, 'convert_framerate': False,
+        'target_framerate': config.getint('General', 'target_framerate', fallback=30),
+        'max_retries': config.getint('General', 'max_retries', fallback=3),
+        'retry_delay': config.getint('General', 'retry_delay', fallback=5),
+        'merge_options': merge_options,
+        'download_options': {'verify': config.getboolean('General', 'verify_downloads', fallback=True)},
+        'audio_options': audio_options,
+    }
+    if audio_only:
+        concurrent_downloads = config.getint('General', 'audio_concurrent_downloads', fallback=8)
+        concurrent_ffmpeg = max(concurrent_ffmpeg, concurrent_downloads)
+    else:
+        concurrent_downloads = config.getint('General', 'concurrent_downloads', fallback=2)
+        settings['convert_framerate'] = config.getboolean('General', 'convert_framerate', fallback=False)
+        settings['convert_to_h265'] = config.getboolean('General', 'convert_to_h265', fallback=False)
+        if settings['convert_to_h265'] and not check_h265_support(NVIDIA_GPU_SUPPORTED):
+            logger.warning("当前系统不支持H265编码，将使用H264")
+            settings['convert_to_h265'] = False
+    return settings, max(1, concurrent_downloads), concurrent_ffmpeg
+
+# 同步一个课程，返回各类集数和本次使用的API请求数
+async def sync_course(cheese_list, settings, concurrent_downloads, concurrent_ffmpeg, dry_run=False):
+    calls_before = api_client.stats['calls']
+    course_info = await api_client.course_meta(cheese_list, fresh=True)
+    if 'title' not in course_info:
+        raise Exception(f"获取课程信息失败，API返回: {course_info}")
+    course_folder = sanitize_filename(course_info['title'])
+    course_dir = path.join(OUTPUT_DIR, course_folder)
+    audio_options = settings['audio_options']
+    journal_file = path.join(course_dir, SYNC_AUDIO_JOURNAL if audio_options is not None else SYNC_JOURNAL)
+    journal = load_sync_journal(journal_file)
+    fingerprint = course_fingerprint(course_info)
+    summary = {'title': course_folder, 'episodes': len(journal['episodes']), 'downloaded': 0, 'failed': 0, 'up_to_date': False}
+
+    # 课程没有变化：只用了一次课程信息请求
+    if fingerprint and fingerprint == journal.get('fingerprint') and journal_files_present(course_dir, journal):
+        summary['up_to_date'] = True
+        summary['api_calls'] = api_client.stats['calls'] - calls_before
+        return summary
+
+    episodes = await api_client.course_list(cheese_list, fresh=True)
+    listing = [(i, ep, await api_client.listed_episode_meta(ep)) for i, ep in enumerate(episodes, 1)]
+    plan = plan_sync(course_dir, journal, listing, audio_options)
+    summary.update({kind: len(items) for kind, items in plan.items()}, episodes=len(listing))
+    for kind, label in SYNC_DOWNLOAD_KINDS.items():
+        for original_index, ep, meta in plan[kind]:
+            print(f"  [{original_index}] {meta['title']}（{label}）")
+    selected = sorted((item for kind in SYNC_DOWNLOAD_KINDS for item in plan[kind]), key=lambda item: item[0])
+    if dry_run:
+        summary['api_calls'] = api_client.stats['calls'] - calls_before
+        return summary
+
+    makedirs(course_dir, exist_ok=True)
+    journal.update(season_id=course_info.get('season_id'), title=course_info['title'])
+    for original_index, ep, meta in plan['adopted']:
+        journal['episodes'][str(ep.get_epid())] = journal_entry(original_index, meta, audio_options)
+    for original_index, ep, meta in plan['unchanged']:
+        journal['episodes'][str(ep.get_epid())]['index'] = original_index
+
+    results = []
+    if selected:
+        semaphore = Semaphore(concurrent_downloads)
+        with ThreadPoolExecutor(max_workers=concurrent_ffmpeg) as ffmpeg_executor:
+            results = await gather(*(
+                process_episode(ep, i, len(selected), semaphore, course_folder, original_index,
+                                ffmpeg_executor=ffmpeg_executor, **settings)
+                for i, (original_index, ep, meta) in enumerate(selected, 1)
+            ))
+        for (original_index, ep, meta), result in zip(selected, results):
+            if result.get('success'):
+                journal['episodes'][str(ep.get_epid())] = journal_entry(original_index, meta, audio_options)
+    summary['downloaded'] = sum(1 for r in results if r.get('success'))
+    summary['failed'] = len(results) - summary['downloaded']
+
+    # 有失败的集数时不保存指纹，下次同步会重新获取课程列表并重试
+    journal['fingerprint'] = fingerprint if not summary['failed'] else None
+    save_sync_journal(journal_file, journal)
+    summary['api_calls'] = api_client.stats['calls'] - calls_before
+    return summary
+
+def parse_course_id(course_id):
+    return int(course_id[2:] if course_id.startswith('ss') else course_id)
+
+# 非交互同步一个或多个课程；watch 大于0时每隔 watch 分钟再同步一次，直到被中断
+async def run_sync(course_ids, watch=0, dry_run=False):
+    config = load_config()
+    configure_workspace(config)
+    ensure_dirs()
+    cleanup_temp_dir()
+    init_scratch_space(config)
+    if not check_ffmpeg():
+        return 1
+    init_stream_cache(config)
+    configure_retry_policy(config)
+    init_api_client(config)
+    init_download_pool(config)
+    init_encode_spool(config)
+    init_deferred_queue(config)
+    settings, concurrent_downloads, concurrent_ffmpeg = sync_settings(config)
+    try:
+        season_ids = [parse_course_id(course_id) for course_id in course_ids]
+    except ValueError:
+        print("无效的课程ID，请使用 ss360 或 360 的格式")
+        return 1
+
+    credential = await load_credential(interactive=False)
+    if credential is None:
+        print("没有有效的登录凭证，请先不带参数运行一次程序扫码登录")
+        return 1
+
+    courses = [cheese.CheeseList(season_id=season_id, credential=credential) for season_id in season_ids]
+    failed = 0
+    try:
+        while True:
+            for season_id, cheese_list in zip(season_ids, courses):
+                started = time()
+                try:
+                    summary = await sync_course(cheese_list, settings, concurrent_downloads, concurrent_ffmpeg, dry_run)
+                except Exception as e:
+                    logger.error(f"同步课程 ss{season_id} 时出错: {e}")
+                    failed += 1
+                    continue
+                failed += summary['failed']
+                if summary['up_to_date']:
+                    print(f"ss{season_id} {summary['title']}: 没有变化（共 {summary['episodes']} 集，"
+                          f"{summary['api_calls']} 次API请求，{time() - started:.1f} 秒）")
+                    continue
+                print(f"ss{season_id} {summary['title']}: 共 {summary['episodes']} 集，新增 {summary['new']}，"
+                      f"变更 {summary['changed']}，成品缺失 {summary['missing']}，沿用已有文件 {summary['adopted']}" +
+                      ("（仅预览，未下载）" if dry_run else f"；下载成功 {summary['downloaded']}，失败 {summary['failed']}") +
+                      f"（{summary['api_calls']} 次API请求，{time() - started:.1f} 秒）")
+            if watch <= 0:
+                break
+            print(f"{watch} 分钟后再次同步，按 Ctrl+C 退出")
+            await asyncio_sleep(watch * 60)
+    finally:
+        close_download_pool()
+        progress_mgr.close_all()
+        cleanup_temp_dir()
+    return 1 if failed else 0
 
 # 主程序 - 添加配置文件支持和改进错误处理
 async def main():
     try:
+        # 加载配置，确定临时目录和输出目录
+        config = load_config()
+        configure_workspace(config)
         ensure_dirs()  # 确保目录存在
         cleanup_temp_dir()  # 清理临时目录
+        init_scratch_space(config)
         
         # 检查FFmpeg是否已安装
         if not check_ffmpeg():
             print("\n程序无法继续，请安装FFmpeg后重试。")
             return
             
-        # 加载配置
-        config = load_config()
+        init_stream_cache(config)
+        configure_retry_policy(config)
+        init_api_client(config)
+        init_download_pool(config)
+        init_encode_spool(config)
+        init_deferred_queue(config)
         default_convert_to_h265 = config.getboolean('General', 'convert_to_h265', fallback=False)
         default_concurrent_downloads = config.getint('General', 'concurrent_downloads', fallback=2)
-        default_concurrent_ffmpeg = config.getint('General', 'concurrent_ffmpeg', fallback=1)
         gpu_mode = config.get('General', 'gpu_mode', fallback='auto')
         max_retries = config.getint('General', 'max_retries', fallback=3)
         retry_delay = config.getint('General', 'retry_delay', fallback=5)
+        verify_downloads = config.getboolean('General', 'verify_downloads', fallback=True)
 
-        # 询问用户是否开启帧率转换
-        default_convert_framerate = config.getboolean('General', 'convert_framerate', fallback=False)
-        default_target_framerate = config.getint('General', 'target_framerate', fallback=30)
+        # 询问用户下载模式，仅音频模式跳过视频相关的设置
+        default_audio_only = config.getboolean('General', 'audio_only', fallback=False)
+        print("\n== 下载模式 ==")
+        print("1. 视频（音视频合成）")
+        print("2. 仅音频（适合纯讲课内容，下载量和磁盘占用大幅减少）")
+        choice = input(f"请选择下载模式 (默认: {'仅音频' if default_audio_only else '视频'}): ").strip()
+        audio_only = choice == '2' or (choice != '1' and default_audio_only)
+        # GPU在询问硬件加速方式后检测
+        concurrent_ffmpeg, merge_options, audio_options = configure_merge_settings(config, audio_only, detect_gpu=False)
+        encode_threads = merge_options['threads']
+        extra_outputs = merge_options['extra_outputs']
+        if extra_outputs:
+            logger.info(f"附加输出: {', '.join(EXTRA_OUTPUT_NAMES[kind] for kind in extra_outputs)}")
+        if audio_only:
+            logger.info(f"仅音频模式: {audio_options}")
         
-        print("\n== 帧率转换设置 ==")
-        print("开启帧率转换可以调整视频的流畅度")
-        print("常见帧率: 24 (电影感), 30 (标准), 60 (流畅)")
-        print("1. 开启帧率转换")
-        print("2. 保持原始帧率")
-        choice = input(f"请选择 (默认: {'开启' if default_convert_framerate else '保持'}): ").strip() or None
+        convert_framerate = False
+        target_framerate = config.getint('General', 'target_framerate', fallback=30)
+        convert_to_h265 = False
+        if not audio_only:
+            # 询问用户是否开启帧率转换
+            default_convert_framerate = config.getboolean('General', 'convert_framerate', fallback=False)
+            default_target_framerate = config.getint('General', 'target_framerate', fallback=30)
         
-        convert_framerate = default_convert_framerate
-        target_framerate = default_target_framerate
+            print("\n== 帧率转换设置 ==")
+            print("开启帧率转换可以调整视频的流畅度")
+            print("常见帧率: 24 (电影感), 30 (标准), 60 (流畅)")
+            print("1. 开启帧率转换")
+            print("2. 保持原始帧率")
+            choice = input(f"请选择 (默认: {'开启' if default_convert_framerate else '保持'}): ").strip() or None
         
-        if choice == '1':
-            convert_framerate = True
-            try:
-                user_input = input(f"请输入目标帧率 (默认: {default_target_framerate}): ").strip()
-                if user_input:
-                    target_framerate = int(user_input)
-                    if target_framerate < 1 or target_framerate > 120:
-                        logger.warning(f"无效的帧率 {target_framerate}，使用默认值 {default_target_framerate}")
-                        target_framerate = default_target_framerate
-            except ValueError:
-                logger.warning(f"输入无效，使用默认帧率 {default_target_framerate}")
-                target_framerate = default_target_framerate
-
-        # 询问用户是否开启H265转换
-        print("\n== H265转换设置 ==")
-        print("开启H265转换可以减小文件大小（约30-50%），但会增加处理时间")
-        print("注意：只有原始编码为H264的视频会被转换")
-        print("      原始就是H265的视频将保持原样")
-        print("1. 开启H265转换（推荐）")
-        print("2. 保持原始编码")
-        choice = input(f"请选择 (默认: {'开启' if default_convert_to_h265 else '保持'}): ").strip() or None
+            convert_framerate = default_convert_framerate
+            target_framerate = default_target_framerate
         
-        convert_to_h265 = default_convert_to_h265
-        if choice == '1':
-            convert_to_h265 = True
-        elif choice == '2':
-            convert_to_h265 = False
-
-        # 在main函数中修改H265检测部分
-        if convert_to_h265:
-            logger.info("已启用H265转换")
-            hevc_supported = check_h265_support(NVIDIA_GPU_SUPPORTED)
-            
-            if not hevc_supported:
-                logger.warning("当前系统不支持H265编码，将使用H264")
-                convert_to_h265 = False
-            else:
-                logger.info("系统支持H265编码")
+            if choice == '1':
+                convert_framerate = True
+                try:
+                    user_input = input(f"请输入目标帧率 (默认: {default_target_framerate}): ").strip()
+                    if user_input:
+                        target_framerate = int(user_input)
+                        if target_framerate < 1 or target_framerate > 120:
+                            logger.warning(f"无效的帧率 {target_framerate}，使用默认值 {default_target_framerate}")
+                            target_framerate = default_target_framerate
+                except ValueError:
+                    logger.warning(f"输入无效，使用默认帧率 {default_target_framerate}")
+                    target_framerate = default_target_framerate
+
+            # 询问用户是否开启H265转换
+            print("\n== H265转换设置 ==")
+            print("开启H265转换可以减小文件大小（约30-50%），但会增加处理时间")
+            print("注意：只有原始编码为H264的视频会被转换")
+            print("      原始就是H265的视频将保持原样")
+            print("1. 开启H265转换（推荐）")
+            print("2. 保持原始编码")
+            choice = input(f"请选择 (默认: {'开启' if default_convert_to_h265 else '保持'}): ").strip() or None
         
-        # 询问用户是否要强制使用GPU/CPU模式
-        print("\n== 硬件加速设置 ==")
-        print("1. 自动检测 (默认)")
-        print("2. 强制使用GPU")
-        print("3. 强制使用CPU")
-        print(f"当前配置: {gpu_mode}")
+            convert_to_h265 = default_convert_to_h265
+            if choice == '1':
+                convert_to_h265 = True
+            elif choice == '2':
+                convert_to_h265 = False
+
+            # 在main函数中修改H265检测部分
+            if convert_to_h265:
+                logger.info("已启用H265转换")
+                hevc_supported = check_h265_support(NVIDIA_GPU_SUPPORTED)
+            
+                if not hevc_supported:
+                    logger.warning("当前系统不支持H265编码，将使用H264")
+                    convert_to_h265 = False
+                else:
+                    logger.info("系统支持H265编码")
         
-        choice = input("请选择 (输入数字1-3，直接回车使用配置文件设置): ").strip()
+            if deferred_queue and (convert_to_h265 or convert_framerate):
+                print(f"\n延后转码已开启：先流复制保存，转码任务写入 {deferred_queue.root}，稍后运行 transcode 命令处理")
         
-        force_mode = None
-        if choice == '1' or (not choice and gpu_mode == 'auto'):
-            force_mode = None
-        elif choice == '2' or (not choice and gpu_mode == 'force_gpu'):
-            force_mode = True
-        elif choice == '3' or (not choice and gpu_mode == 'force_cpu'):
-            force_mode = False
+            # 询问用户是否要强制使用GPU/CPU模式
+            print("\n== 硬件加速设置 ==")
+            print("1. 自动检测 (默认)")
+            print("2. 强制使用GPU")
+            print("3. 强制使用CPU")
+            print(f"当前配置: {gpu_mode}")
         
-        # 检测NVIDIA GPU支持状态
-        check_nvidia_gpu_support(force_mode)
+            choice = input("请选择 (输入数字1-3，直接回车使用配置文件设置): ").strip()
         
-        credential = None
+            force_mode = None
+            if choice == '1' or (not choice and gpu_mode == 'auto'):
+                force_mode = None
+            elif choice == '2' or (not choice and gpu_mode == 'force_gpu'):
+                force_mode = True
+            elif choice == '3' or (not choice and gpu_mode == 'force_cpu'):
+                force_mode = False
         
-        if path.exists('./bilibili.session'):
-            try:
-                with open('bilibili.session', 'r', encoding='utf-8') as file:
-                    cookies_data = loads(file.read())
-                    credential = Credential(
-                        sessdata=cookies_data.get('SESSDATA', ''),
-                        bili_jct=cookies_data.get('bili_jct', ''),
-                        buvid3=cookies_data.get('buvid3', '')
-                    )
-                
-                # 验证凭证是否有效
-                if not await credential.check_valid():
-                    logger.info("凭证已过期，需要重新登录")
-                    credential = await login_with_qrcode()
-            except Exception as e:
-                logger.error(f"读取会话文件出错: {e}")
-                credential = await login_with_qrcode()
-        else:
-            credential = await login_with_qrcode()
+            # 检测NVIDIA GPU支持状态
+            check_nvidia_gpu_support(force_mode)
         
-        # 保存凭证到文件
-        with open('bilibili.session', 'w', encoding='utf-8') as file:
-            file.write(dumps(credential.get_cookies(), indent=4, ensure_ascii=False))
+        credential = await load_credential()
         
         print('请输入要下载的课程序号,只需要最后的ID')
         print('例如你的课程地址是https://www.bilibili.com/cheese/play/ss360')
@@ -1075,7 +4085,7 @@ async def main():
             
             # 获取课程信息 - 修正方法为get_meta()
             try:
-                course_info = await cheese_list.get_meta()
+                course_info = await api_client.course_meta(cheese_list)
                 if 'title' not in course_info:
                     print(f"获取课程信息失败，API返回: {course_info}")
                     return
@@ -1085,16 +4095,15 @@ async def main():
                 
                 # 确保课程文件夹存在
                 course_folder = course_title
-                if not path.exists(f"./download/{course_folder}"):
-                    makedirs(f"./download/{course_folder}")
+                makedirs(path.join(OUTPUT_DIR, course_folder), exist_ok=True)
                 
                 # 获取课程列表
-                episodes = await cheese_list.get_list()
+                episodes = await api_client.course_list(cheese_list)
                 
                 # 显示所有集数供用户选择
                 print("\n课程包含以下集数:")
                 for i, ep in enumerate(episodes, 1):
-                    meta = await ep.get_meta()
+                    meta = await api_client.episode_meta(ep)
                     title = meta.get('title', f'第{i}集')
                     print(f"[{i}] {title}")
                 
@@ -1149,7 +4158,9 @@ async def main():
                 
                 print(f"已选择下载 {len(selected_episodes)} 集视频")
                 
-                # 询问用户并行下载数量，使用配置文件默认值
+                # 询问用户并行下载数量，使用配置文件默认值；仅音频模式的流小得多，默认并发更高
+                if audio_only:
+                    default_concurrent_downloads = config.getint('General', 'audio_concurrent_downloads', fallback=8)
                 concurrent_downloads = default_concurrent_downloads
                 try:
                     user_input = input(f'请输入并行下载的数量（默认为{default_concurrent_downloads}）: ').strip()
@@ -1163,10 +4174,48 @@ async def main():
                     logger.warning(f"输入无效，使用默认值{default_concurrent_downloads}")
                     concurrent_downloads = default_concurrent_downloads
                 
+                # 仅音频模式的封装几乎不占CPU，与下载数同样并行
+                if audio_only:
+                    concurrent_ffmpeg = max(concurrent_ffmpeg, concurrent_downloads)
+                
+                # 下载前估算下载量、临时空间、输出大小和耗时，并检查磁盘空间
+                job_plan = None
+                if config.getboolean('General', 'preflight', fallback=True):
+                    print("\n正在获取各集信息，生成下载计划...")
+                    job_plan = await build_job_plan(
+                        selected_episodes, concurrent_downloads, concurrent_ffmpeg, convert_to_h265 and not deferred_queue,
+                        0 if ENCODE_PROFILE == 'lecture' else config.getint('General', 'chunk_min_duration', fallback=1200),
+                        merge_options['chunk_workers'], audio_only, extra_outputs
+                    )
+                    print(job_plan.report())
+                    logger.info(job_plan.totals())
+                    problems = job_plan.check_space(scratch_space.min_free_bytes if scratch_space else 0)
+                    for problem in problems:
+                        print(f"⚠ 磁盘空间可能不足: {problem}")
+                    
+                    # 仅在磁盘空间可能不足时确认是否继续
+                    if problems:
+                        print("\n1. 仍然开始下载 (默认)")
+                        print("2. 取消下载")
+                        if input("请选择是否开始下载: ").strip() == '2':
+                            print("已取消，未下载任何文件")
+                            return
+                
+                # 按预计工作量调整处理顺序，文件名仍使用原始序号
+                if job_plan and config.get('General', 'schedule_order', fallback='longest_first') == 'longest_first':
+                    selected_episodes = order_episodes(
+                        selected_episodes, job_plan, config.getint('General', 'early_episodes', fallback=0)
+                    )
+                    logger.info(f"处理顺序: {[original_index for original_index, _ in selected_episodes]}")
+                
                 # 创建信号量以限制并发下载数
                 semaphore = Semaphore(concurrent_downloads)
                 
-                # 创建用于ffmpeg合成的线程池
+                # 按计划中的预计工作量显示整体进度和剩余时间
+                job_progress = JobProgress(job_plan) if job_plan and job_plan.episodes else None
+                
+                # 创建用于ffmpeg合成的线程池，大小即并行合成数
+                ffmpeg_executor = ThreadPoolExecutor(max_workers=concurrent_ffmpeg)
                 tasks = []
                 # 在创建下载任务时传入帧率转换参数
                 for i, (original_index, ep) in enumerate(selected_episodes, 1):
@@ -1181,27 +4230,56 @@ async def main():
                         convert_framerate,  # 帧率转换标志
                         target_framerate,   # 目标帧率
                         max_retries,       # 最大重试次数
-                        retry_delay        # 重试延迟
+                        retry_delay,       # 重试延迟
+                        merge_options,     # 编码选项
+                        {'verify': verify_downloads},  # 下载选项
+                        ffmpeg_executor,   # 合成线程池
+                        job_progress,      # 整体进度
+                        audio_options      # 仅音频模式的选项
                     ))
                     tasks.append(task)
                 
                 # 等待所有任务完成
                 results = await gather(*tasks)
+                ffmpeg_executor.shutdown(wait=True)
+                if job_progress:
+                    job_progress.close()
                 
                 # 统计下载结果
                 success_count = sum(1 for r in results if r.get("success", False))
                 failed_count = len(selected_episodes) - success_count
                 print(f"\n下载完成，成功: {success_count}, 失败: {failed_count}")
                 
+                # 报告编码总吞吐，用于检查并行合成数和线程预算是否合适
+                stats = encode_stats.summary()
+                if stats:
+                    print(f"编码统计: {stats['episodes']} 集，媒体时长 {stats['media_seconds'] / 60:.1f} 分钟，"
+                          f"合成阶段耗时 {stats['wall_seconds']:.0f} 秒，总吞吐 {stats['realtime_factor']:.2f}x 实时，"
+                          f"平均同时合成 {stats['average_parallelism']:.2f} 个（并行合成 {concurrent_ffmpeg}，每个 {encode_threads} 线程）")
+                
+                if stats and stats['skipped_transcodes']:
+                    print(f"跳过转码: {stats['skipped_transcodes']} 集预计节省空间不足，已直接流复制")
+                if stats and stats['extra_outputs']:
+                    print("附加输出: " + "，".join(f"{EXTRA_OUTPUT_NAMES[kind]} {ok} 个成功" + (f"、{failed} 个校验失败" if failed else "")
+                                                  for kind, (ok, failed) in stats['extra_outputs'].items()))
+                
+                # 保存实测的下载和合成速度，供下次生成下载计划时使用；跳过转码的集数不计入编码速度
+                encoded_seconds = stats['media_seconds'] - stats['skipped_media_seconds'] if stats else 0
+                save_performance(
+                    download_stats.speed(),
+                    encode_mode_name(convert_to_h265 and not deferred_queue, audio_only),
+                    encoded_seconds / stats['busy_seconds'] if stats and stats['busy_seconds'] > 0 and encoded_seconds > 0 else None
+                )
+                
                 # 显示失败的任务
                 if failed_count > 0:
                     print("\n失败的任务:")
                     for result in results:
                         if not result.get("success", False):
-                            meta = await result['episode'].get_meta()
+                            meta = await api_client.episode_meta(result['episode'])
                             title = meta.get('title', f'第{result["original_index"]}集')
                             print(f"  - [{result['original_index']}] {title}: {result.get('error', '未知错误')}")
-                            print(f"    错误详情已保存到: ./download/failed/{result['original_index']:03d}_error.json")
+                            print(f"    错误详情已保存到: {path.join(FAILED_DIR, format(result['original_index'], '03d'))}_error.json")
                 
             except Exception as e:
                 logger.error(f"处理课程信息时出错: {e}")
@@ -1214,6 +4292,7 @@ async def main():
             print_exc()
         
         # 在主函数结束前确保清理所有进度条
+        close_download_pool()
         progress_mgr.close_all()
         cleanup_temp_dir()  # 最后清理临时目录
         
@@ -1222,15 +4301,19 @@ async def main():
         from traceback import print_exc
         print_exc()
         # 确保清理资源
+        close_download_pool()
         progress_mgr.close_all()
         cleanup_temp_dir()
 
 if __name__ == "__main__":
+    if len(argv) > 1:
+        raise SystemExit(run_command(argv[1:]))
     # 运行主程序
     try:
         asyncio_run(main())
     except KeyboardInterrupt:
         logger.warning("\n程序被用户中断")
+        close_download_pool()
         progress_mgr.close_all()
         cleanup_temp_dir()
     except Exception as e:
@@ -0,0 +1,82 @@
+"""多进程下载扩展性基准测试。
+
+对每个下载进程数（download_processes）各跑一遍 bench_e2e 的 episodes 模式，
+本地CDN使用固定数量的服务进程，统计总吞吐、加速比以及主进程和工作进程的CPU时间，
+用于确认在高带宽下增加下载进程能否突破单个事件循环的CPU上限。
+
+示例:
+    python benchmarks/bench_download_scaling.py --workers 1,2,4 --episodes 16 --video-size 80
+    python benchmarks/bench_download_scaling.py --workers 1,2,4,8 --concurrency 16 --cdn-processes 8
+"""
+from os import path, remove
+from argparse import ArgumentParser
+from json import load
+from subprocess import run
+from tempfile import mkstemp
+import sys
+
+sys.path.insert(0, path.dirname(path.abspath(__file__)))
+from common import save_results, compare_results
+
+BENCH_E2E = path.join(path.dirname(path.abspath(__file__)), 'bench_e2e.py')
+
+# 用独立的子进程跑一次 bench_e2e，返回其指标
+def run_once(args, workers):
+    fd, output_file = mkstemp(suffix='.json', prefix='bdownloader_scaling_')
+    cmd = [
+        sys.executable, BENCH_E2E, '--mode', 'episodes',
+        '--episodes', str(args.episodes), '--video-size', str(args.video_size), '--audio-size', str(args.audio_size),
+        '--concurrency', str(args.concurrency), '--cdn-processes', str(args.cdn_processes),
+        '--set', f'download_processes={workers}', '--set', 'verify_downloads=' + ('true' if args.verify else 'false'),
+        '--output', output_file,
+    ]
+    try:
+        run(cmd, check=True, capture_output=not args.verbose)
+        with open(output_file, 'r', encoding='utf-8') as f:
+            return load(f)['metrics']
+    finally:
+        remove(output_file)
+
+def main():
+    parser = ArgumentParser(description='多进程下载扩展性基准测试')
+    parser.add_argument('--workers', default='1,2,4', help='要测试的下载进程数列表，1为在主进程中下载')
+    parser.add_argument('--episodes', type=int, default=16, help='集数')
+    parser.add_argument('--video-size', type=float, default=60, help='每集视频流大小（MiB）')
+    parser.add_argument('--audio-size', type=float, default=6, help='每集音频流大小（MiB）')
+    parser.add_argument('--concurrency', type=int, default=8, help='并行下载数')
+    parser.add_argument('--cdn-processes', type=int, help='本地CDN服务进程数，默认与最大下载进程数相同')
+    parser.add_argument('--no-verify', dest='verify', action='store_false', help='关闭下载校验，只测传输本身')
+    parser.add_argument('--verbose', action='store_true', help='显示每次运行的输出')
+    parser.add_argument('--output', help='结果JSON路径')
+    parser.add_argument('--compare', help='与之前的结果JSON对比')
+    args = parser.parse_args()
+
+    levels = [int(x) for x in args.workers.split(',') if x]
+    args.cdn_processes = args.cdn_processes or max(levels)
+
+    rows = []
+    metrics = {}
+    baseline = None
+    print(f"{'进程数':>6} {'吞吐(MiB/s)':>12} {'加速比':>8} {'主进程CPU(s)':>13} {'工作进程CPU(s)':>15} {'成功':>6}")
+    for workers in levels:
+        result = run_once(args, workers)
+        throughput = result.get('throughput_mib_s') or 0
+        baseline = baseline or throughput
+        speedup = throughput / baseline if baseline else 0
+        row = {
+            'workers': workers, 'throughput_mib_s': throughput, 'speedup': round(speedup, 2),
+            'makespan_s': result['makespan_s'], 'cpu_seconds': result['cpu_seconds'],
+            'worker_cpu_seconds': result.get('worker_cpu_seconds'), 'episodes_ok': result['episodes_ok'],
+        }
+        rows.append(row)
+        metrics[f'throughput_mib_s@{workers}'] = throughput
+        metrics[f'speedup@{workers}'] = row['speedup']
+        print(f"{workers:>6} {throughput:>12.1f} {speedup:>8.2f} {row['cpu_seconds']:>13.2f} "
+              f"{row['worker_cpu_seconds'] or 0:>15.2f} {row['episodes_ok']:>4}/{args.episodes}")
+
+    save_results('download_scaling', vars(args), metrics, args.output, {'runs': rows})
+    if args.compare:
+        compare_results(metrics, args.compare)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,332 @@
+"""端到端下载基准测试。
+
+启动本地CDN（支持Range、限速、延迟、故障注入、链接过期）和模拟的课程/单集对象，
+驱动 process_episode 或 main 完整跑一遍，统计吞吐、首集完成时间、总耗时和峰值内存，
+结果保存为JSON以便在不同提交之间对比。
+
+示例:
+    python benchmarks/bench_e2e.py --episodes 20 --video-size 40 --concurrency 4
+    python benchmarks/bench_e2e.py --mode main --bandwidth 20 --fault-rate 0.1 --compare old.json
+    python benchmarks/bench_e2e.py --mode sync --episodes 500 --video-size 0.1 --audio-size 0.01 --concurrency 8
+"""
+from os import path, remove, getcwd, chdir, makedirs
+from argparse import ArgumentParser
+from asyncio import Semaphore, create_task, gather, run as asyncio_run
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter, process_time
+from types import SimpleNamespace
+from configparser import ConfigParser
+from tempfile import mkdtemp
+from subprocess import run
+from multiprocessing import Process
+import shutil
+import sys
+import tracemalloc
+
+try:
+    from resource import getrusage, RUSAGE_SELF, RUSAGE_CHILDREN
+except ImportError:  # Windows 没有 resource 模块，只统计主进程CPU时间，不统计子进程CPU时间和峰值内存
+    getrusage = None
+
+sys.path.insert(0, path.dirname(path.abspath(__file__)))
+from common import load_bdownloader, save_results, compare_results
+from fake_bilibili import CDNProcess, FakeEpisode, FakeCheeseList, FakeApiLimiter, FakeCredential, write_fake_session
+
+MB = 1024 * 1024
+
+# 使用ffmpeg的lavfi源生成真实的分片MP4音视频流，用于包含合成阶段的测试
+def generate_real_media(workdir, duration, width=1280, height=720, fps=30):
+    video_file = path.join(workdir, f'src_video_{duration}.m4s')
+    audio_file = path.join(workdir, f'src_audio_{duration}.m4s')
+    frag = '-movflags frag_keyframe+empty_moov+default_base_moof'
+    if not path.exists(video_file):
+        run(f'ffmpeg -y -v error -f lavfi -i testsrc2=size={width}x{height}:rate={fps} -t {duration} '
+            f'-c:v libx264 -preset ultrafast -g {fps * 2} -an {frag} -f mp4 "{video_file}"', shell=True, check=True)
+    if not path.exists(audio_file):
+        run(f'ffmpeg -y -v error -f lavfi -i sine=frequency=440 -t {duration} -c:a aac -vn {frag} -f mp4 "{audio_file}"',
+            shell=True, check=True)
+    return video_file, audio_file
+
+# 根据参数为每一集规划时长和文件
+def plan_episodes(args, workdir):
+    episodes = []
+    for i in range(1, args.episodes + 1):
+        # --uneven 时每隔若干集插入一个长集，模拟课程时长不均匀的情况
+        duration = args.duration * (args.uneven if args.uneven and i % 5 == 0 else 1)
+        if args.real_media:
+            video_src, audio_src = generate_real_media(workdir, duration)
+            video_spec = {'source_file': video_src}
+            audio_spec = {'source_file': audio_src}
+            video_size = path.getsize(video_src)
+            audio_size = path.getsize(audio_src)
+        else:
+            scale = duration / args.duration
+            video_size = int(args.video_size * MB * scale)
+            audio_size = int(args.audio_size * MB * scale)
+            video_spec = {'size': video_size, 'seed': i * 2}
+            audio_spec = {'size': audio_size, 'seed': i * 2 + 1}
+        episodes.append({
+            'epid': 1000 + i, 'title': f'第{i}讲 合成测试', 'duration': duration,
+            'video_name': f'ep{i}_video.m4s', 'audio_name': f'ep{i}_audio.m4s',
+            'video_size': video_size, 'audio_size': audio_size,
+            'video_spec': video_spec, 'audio_spec': audio_spec,
+        })
+    return episodes
+
+# 跳过合成时使用的替身：只删除输入并写出占位输出
+def stub_merge(video_file, audio_file, output_file, *args, **kwargs):
+    with open(output_file, 'wb') as f:
+        f.write(b'\0')
+    for file in (video_file, audio_file):
+        if path.exists(file):
+            remove(file)
+    return True
+
+# 记录每一集的完成时间
+def record_episodes(bd, timeline, started):
+    original = bd.process_episode
+
+    async def recorded(*args, **kwargs):
+        try:
+            result = await original(*args, **kwargs)
+        except Exception:
+            timeline.append((perf_counter() - started, False))
+            raise
+        timeline.append((perf_counter() - started, bool(result and result.get('success'))))
+        return result
+
+    bd.process_episode = recorded
+
+# 独立的合成进程：加载一份主程序，从任务目录领取合成任务，未使用真实媒体时同样替换为占位合成
+def encode_worker_main(workdir, spool_dir, real_media):
+    bd = load_bdownloader(workdir)
+    if not real_media:
+        bd.ffmpeg_merge = stub_merge
+        bd.check_ffmpeg = lambda: True
+    chdir(workdir)
+    bd.run_encode_worker(spool_dir, jobs=1, poll=0.2)
+
+# 把 --set 指定的配置写入工作目录下的 config.ini，main 和 episodes 模式都会读取
+def write_bench_config(workdir, settings):
+    config = ConfigParser()
+    config.add_section('General')
+    for item in settings:
+        key, _, value = item.partition('=')
+        config.set('General', key.strip(), value.strip())
+    with open(path.join(workdir, 'config.ini'), 'w', encoding='utf-8') as f:
+        config.write(f)
+
+# 直接并发调用 process_episode，与 main 中的调度方式一致
+async def drive_episodes(bd, course, concurrency, convert_to_h265=False):
+    config = bd.load_config()
+    bd.configure_workspace(config)
+    bd.ensure_dirs()
+    bd.init_scratch_space(config)
+    bd.init_stream_cache(config)
+    bd.configure_retry_policy(config)
+    bd.init_api_client(config)
+    bd.init_download_pool(config)
+    bd.init_encode_spool(config)
+    bd.init_deferred_queue(config)
+    concurrent_ffmpeg, encode_threads = bd.plan_encode_budget(
+        config.getint('General', 'concurrent_ffmpeg', fallback=0),
+        config.getint('General', 'encode_threads', fallback=0),
+        config.getint('General', 'reserved_cores', fallback=1))
+    episodes = await bd.api_client.course_list(course)
+    course_folder = bd.sanitize_filename(course.title)
+    semaphore = Semaphore(concurrency)
+    with ThreadPoolExecutor(max_workers=concurrent_ffmpeg) as ffmpeg_executor:
+        tasks = [
+            create_task(bd.process_episode(ep, i, len(episodes), semaphore, course_folder, i,
+                                           max_retries=config.getint('General', 'max_retries', fallback=3),
+                                           retry_delay=config.getint('General', 'retry_delay', fallback=5),
+                                           convert_to_h265=convert_to_h265,
+                                           merge_options={'threads': encode_threads,
+                                                          'preset': config.get('General', 'x265_preset', fallback='medium')},
+                                           ffmpeg_executor=ffmpeg_executor))
+            for i, ep in enumerate(episodes, 1)
+        ]
+        try:
+            return await gather(*tasks)
+        finally:
+            bd.close_download_pool()
+
+# 通过替换 input 驱动交互式 main
+async def drive_main(bd, course, concurrency, workdir):
+    answers = {
+        '课程序号': f'ss{course.season_id}',
+        '输入数字1-3': '3',  # 强制CPU，避免检测GPU
+        '请输入选项': '1',   # 全部下载
+        '并行下载': str(concurrency),
+    }
+
+    def fake_input(prompt=''):
+        for key, answer in answers.items():
+            if key in prompt:
+                return answer
+        return ''
+
+    write_fake_session(workdir)
+    bd.input = fake_input
+    bd.Credential = FakeCredential
+    bd.cheese = SimpleNamespace(CheeseList=lambda season_id=None, credential=None, **kwargs: course)
+    await bd.main()
+
+# 增量同步：先同步除最后一集外的课程，再加入最后一集同步一次，最后测量没有变化时的同步耗时和API请求数
+async def drive_sync(bd, course, workdir):
+    write_fake_session(workdir)
+    bd.Credential = FakeCredential
+    bd.cheese = SimpleNamespace(CheeseList=lambda season_id=None, credential=None, **kwargs: course)
+    course_id = f'ss{course.season_id}'
+    held_back = course.episodes.pop()
+    await bd.run_sync([course_id])
+    course.episodes.append(held_back)
+    await bd.run_sync([course_id])
+    calls_before = course.api_calls + sum(ep.api_calls for ep in course.episodes)
+    started = perf_counter()
+    await bd.run_sync([course_id])
+    return {
+        'sync_noop_s': round(perf_counter() - started, 3),
+        'sync_noop_api_calls': course.api_calls + sum(ep.api_calls for ep in course.episodes) - calls_before,
+    }
+
+def main():
+    parser = ArgumentParser(description='端到端下载基准测试')
+    parser.add_argument('--mode', choices=['episodes', 'main', 'sync'], default='episodes',
+                        help='驱动 process_episode、完整的 main 还是 sync 子命令')
+    parser.add_argument('--episodes', type=int, default=10, help='集数')
+    parser.add_argument('--duration', type=int, default=60, help='每集时长（秒）')
+    parser.add_argument('--uneven', type=int, default=0, help='每5集中插入一个时长为N倍的长集')
+    parser.add_argument('--video-size', type=float, default=20, help='视频流大小（MiB，按时长缩放）')
+    parser.add_argument('--audio-size', type=float, default=2, help='音频流大小（MiB，按时长缩放）')
+    parser.add_argument('--concurrency', type=int, default=2, help='并行下载数')
+    parser.add_argument('--bandwidth', type=float, default=0, help='单连接带宽（MiB/s），0为不限速')
+    parser.add_argument('--latency', type=float, default=0.0, help='每个请求的延迟（秒）')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='返回503的请求比例')
+    parser.add_argument('--fault-rate', type=float, default=0.0, help='传输中途断开的请求比例')
+    parser.add_argument('--stall-rate', type=float, default=0.0, help='传输中途卡住的请求比例')
+    parser.add_argument('--stall-seconds', type=float, default=30.0, help='卡住的时长（秒）')
+    parser.add_argument('--ignore-range-rate', type=float, default=0.0, help='忽略Range返回完整文件的请求比例')
+    parser.add_argument('--html-error-rate', type=float, default=0.0, help='以200返回HTML错误页的请求比例')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='返回412限流的请求比例')
+    parser.add_argument('--dead-primary', action='store_true', help='主链接指向不可连接的节点，只有备用链接可用')
+    parser.add_argument('--api-rate', type=float, default=0, help='模拟API风控：每秒超过N次请求返回-352，0为不限制')
+    parser.add_argument('--url-ttl', type=int, default=0, help='下载链接有效期（秒），0为不过期')
+    parser.add_argument('--cdn-processes', type=int, default=1, help='本地CDN的服务进程数，测试多进程下载时避免服务端成为瓶颈')
+    parser.add_argument('--encode-workers', type=int, default=0, help='启动N个合成进程，通过共享任务目录分布式合成')
+    parser.add_argument('--real-media', action='store_true', help='用ffmpeg生成真实音视频并执行合成')
+    parser.add_argument('--h265', action='store_true', help='episodes 模式下开启H265转换，配合 --set deferred_encode=true 对比延后转码')
+    parser.add_argument('--tracemalloc', action='store_true', help='使用tracemalloc统计Python堆峰值（有额外开销）')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE', help='写入config.ini [General]的配置项，可重复')
+    parser.add_argument('--workdir', help='工作目录，默认使用临时目录')
+    parser.add_argument('--keep', action='store_true', help='保留工作目录')
+    parser.add_argument('--output', help='结果JSON路径')
+    parser.add_argument('--compare', help='与之前的结果JSON对比')
+    args = parser.parse_args()
+
+    if args.real_media and not shutil.which('ffmpeg'):
+        parser.error('--real-media 需要 ffmpeg')
+
+    workdir = path.abspath(args.workdir or mkdtemp(prefix='bdownloader_bench_'))
+    makedirs(workdir, exist_ok=True)
+    episodes_plan = plan_episodes(args, workdir)
+    file_specs = {}
+    for ep in episodes_plan:
+        file_specs[ep['video_name']] = ep['video_spec']
+        file_specs[ep['audio_name']] = ep['audio_spec']
+    cdn_config = {
+        'bandwidth': int(args.bandwidth * MB), 'latency': args.latency, 'error_rate': args.error_rate,
+        'fault_rate': args.fault_rate, 'stall_rate': args.stall_rate, 'stall_seconds': args.stall_seconds,
+        'ignore_range_rate': args.ignore_range_rate, 'html_error_rate': args.html_error_rate,
+        'url_ttl': args.url_ttl, 'rate_limit_rate': args.rate_limit_rate,
+    }
+
+    spool_dir = path.join(workdir, 'spool')
+    if args.mode == 'sync':
+        # sync 子命令不交互，并行下载数取自配置
+        args.set.insert(0, f'concurrent_downloads={args.concurrency}')
+    if args.encode_workers:
+        args.set.append(f'encode_spool_dir={spool_dir}')
+    write_bench_config(workdir, args.set)
+    encode_workers = [Process(target=encode_worker_main, args=(workdir, spool_dir, args.real_media), daemon=True)
+                      for _ in range(args.encode_workers)]
+    for worker in encode_workers:
+        worker.start()
+    old_cwd = getcwd()
+    with CDNProcess(file_specs, cdn_config, args.cdn_processes) as cdn:
+        bd = load_bdownloader(workdir)
+        if not args.real_media:
+            bd.ffmpeg_merge = stub_merge
+            bd.check_ffmpeg = lambda: True
+        limiter = FakeApiLimiter(args.api_rate)
+        episodes = [
+            FakeEpisode(cdn, ep['epid'], ep['title'], ep['duration'], ep['video_name'], ep['audio_name'],
+                        ep['video_size'], ep['audio_size'], dead_primary=args.dead_primary, limiter=limiter)
+            for ep in episodes_plan
+        ]
+        course = FakeCheeseList('基准测试课程', episodes, limiter=limiter)
+
+        chdir(workdir)
+        timeline = []
+        if args.tracemalloc:
+            tracemalloc.start()
+        cpu_before = process_time()
+        children_before = getrusage(RUSAGE_CHILDREN) if getrusage else None
+        started = perf_counter()
+        record_episodes(bd, timeline, started)
+        sync_metrics = {}
+        try:
+            if args.mode == 'episodes':
+                asyncio_run(drive_episodes(bd, course, args.concurrency, args.h265))
+            elif args.mode == 'sync':
+                sync_metrics = asyncio_run(drive_sync(bd, course, workdir))
+            else:
+                asyncio_run(drive_main(bd, course, args.concurrency, workdir))
+        finally:
+            makespan = perf_counter() - started
+            chdir(old_cwd)
+        cpu_seconds = process_time() - cpu_before
+        usage = getrusage(RUSAGE_SELF) if getrusage else None
+        # 下载工作进程结束后计入子进程CPU时间（CDN进程此时尚未退出，不会计入）
+        children = getrusage(RUSAGE_CHILDREN) if getrusage else None
+        peak_traced = tracemalloc.get_traced_memory()[1] if args.tracemalloc else None
+        server_stats = cdn.stats()
+    for worker in encode_workers:
+        worker.terminate()
+        worker.join(10)
+
+    succeeded = sum(1 for _, ok in timeline if ok)
+    payload = sum(ep['video_size'] + ep['audio_size'] for ep in episodes_plan)
+    first_ok = min((t for t, ok in timeline if ok), default=None)
+    metrics = {
+        'makespan_s': round(makespan, 3),
+        'time_to_first_episode_s': round(first_ok, 3) if first_ok is not None else None,
+        'episodes_ok': succeeded,
+        'episodes_failed': len(episodes_plan) - succeeded,
+        'payload_mib': round(payload / MB, 2),
+        'throughput_mib_s': round(payload / MB / makespan, 2) if succeeded == len(episodes_plan) else None,
+        'bytes_served_mib': round(server_stats['bytes_served'] / MB, 2),
+        'cpu_seconds': round(cpu_seconds, 3),
+        'worker_cpu_seconds': round(children.ru_utime + children.ru_stime
+                                    - children_before.ru_utime - children_before.ru_stime, 3) if children else None,
+        # Linux下 ru_maxrss 单位为KiB，macOS下为字节
+        'peak_rss_mib': round(usage.ru_maxrss / (MB if sys.platform == 'darwin' else 1024), 2) if usage else None,
+        'peak_traced_mib': round(peak_traced / MB, 2) if peak_traced is not None else None,
+        'api_calls': sum(ep.api_calls for ep in episodes) + course.api_calls,
+        'api_rejected': limiter.rejected,
+        **sync_metrics,
+    }
+    print('\n== 端到端基准测试结果 ==')
+    for key, value in metrics.items():
+        print(f"  {key:<28} {value}")
+    print(f"  服务端统计: {server_stats}")
+
+    output_file = save_results('e2e', vars(args), metrics, args.output, {'server': server_stats})
+    if args.compare:
+        compare_results(metrics, args.compare)
+    if not args.keep and not args.workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return output_file
+
+if __name__ == '__main__':
+    main()
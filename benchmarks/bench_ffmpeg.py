@@ -0,0 +1,405 @@
+"""ffmpeg 合成/转码方案基准测试。
+
+用 ffmpeg 的 lavfi 源按不同分辨率、帧率、时长生成合成输入，逐一计时 build_ffmpeg_cmd
+可能产生的每种方案（流复制、libx265 各预设、-preset fast、fps 滤镜、缩放），
+统计编码速度(fps)、实时倍率、输出大小和CPU时间，并给出 concurrent_ffmpeg 和 x265_preset 的推荐值。
+
+示例:
+    python benchmarks/bench_ffmpeg.py --resolutions 1280x720,1920x1080 --framerates 30,60 --durations 10
+    python benchmarks/bench_ffmpeg.py --presets ultrafast,fast,medium --concurrency-sweep --write-config config.ini
+    python benchmarks/bench_ffmpeg.py --lecture --durations 60 --default-preset fast
+    python benchmarks/bench_ffmpeg.py --estimate --resolutions 1280x720 --durations 20 --default-preset fast
+    python benchmarks/bench_ffmpeg.py --multi-output --resolutions 1280x720 --durations 30 --default-preset fast
+"""
+from os import path, cpu_count
+from argparse import ArgumentParser
+from subprocess import run, Popen, PIPE, DEVNULL
+from time import perf_counter
+from tempfile import mkdtemp
+import shutil
+import sys
+
+try:
+    from resource import getrusage, RUSAGE_CHILDREN
+except ImportError:  # Windows 没有 resource 模块，CPU时间记为 nan
+    getrusage = None
+
+sys.path.insert(0, path.dirname(path.abspath(__file__)))
+from common import load_bdownloader, save_results, compare_results
+
+# 生成H264视频流和AAC音频流，模拟B站下发的DASH流
+def make_inputs(workdir, width, height, fps, duration):
+    video_file = path.join(workdir, f'in_{width}x{height}_{fps}_{duration}_video.m4s')
+    audio_file = path.join(workdir, f'in_{duration}_audio.m4s')
+    if not path.exists(video_file):
+        run(f'ffmpeg -y -v error -f lavfi -i testsrc2=size={width}x{height}:rate={fps} -t {duration} '
+            f'-c:v libx264 -preset veryfast -g {fps * 5} -an -f mp4 "{video_file}"', shell=True, check=True)
+    if not path.exists(audio_file):
+        run(f'ffmpeg -y -v error -f lavfi -i sine=frequency=440 -t {duration} -c:a aac -vn -f mp4 "{audio_file}"',
+            shell=True, check=True)
+    return video_file, audio_file
+
+# 生成模拟幻灯片讲座的视频：每 slide_seconds 秒换一页的静态画面，可叠加右下角的小窗口模拟讲师画面
+def make_lecture_input(workdir, width, height, fps, duration, talking_head, slide_seconds=8):
+    kind = 'head' if talking_head else 'slides'
+    video_file = path.join(workdir, f'lecture_{kind}_{width}x{height}_{fps}_{duration}_video.m4s')
+    if not path.exists(video_file):
+        # 幻灯片：每 slide_seconds 秒换一页，再按目标帧率重复输出同一画面
+        slides = f'testsrc2=size={width}x{height}:rate=1/{slide_seconds},fps={fps}'
+        if talking_head:
+            # 画中画：右下角叠加一个每帧都在变化的小画面，模拟讲师镜头
+            head = f'testsrc2=size={width // 6}x{height // 6}:rate={fps}'
+            filtergraph = f'{slides}[slides];{head}[head];[slides][head]overlay=W-w-20:H-h-20'
+        else:
+            filtergraph = slides
+        run(f'ffmpeg -y -v error -filter_complex "{filtergraph}" -t {duration} '
+            f'-c:v libx264 -preset veryfast -g {fps * 5} -an -f mp4 "{video_file}"', shell=True, check=True)
+    return video_file
+
+# 用 framecrc 逐包列出视频流统计帧数，只依赖 ffmpeg
+def count_frames(video_file, stream='v:0'):
+    result = run(f'ffmpeg -v error -i "{video_file}" -map 0:{stream} -c copy -f framecrc -',
+                 shell=True, stdout=PIPE, stderr=DEVNULL, text=True)
+    if result.returncode != 0:
+        return None
+    return sum(1 for line in result.stdout.splitlines() if line and not line.startswith('#'))
+
+# 对比默认配置和讲座配置（丢弃重复帧）的H265编码耗时、输出大小和帧数
+def lecture_comparison(bd, workdir, width, height, fps, duration, preset, threads):
+    rows = []
+    metrics = {}
+    _, audio_file = make_inputs(workdir, width, height, fps, duration)
+    for talking_head in (False, True):
+        label = f"{'slides_head' if talking_head else 'slides'}_{width}x{height}p{fps}_{duration}s"
+        video_file = make_lecture_input(workdir, width, height, fps, duration, talking_head)
+        input_frames = count_frames(video_file)
+        print(f"\n== 讲座配置对比 {label}（输入 {input_frames} 帧）==")
+        results = {}
+        for profile in ('default', 'lecture'):
+            output_file = path.join(workdir, f'lecture_out_{label}_{profile}.mp4')
+            cmd_line = bd.build_ffmpeg_cmd(video_file, audio_file, output_file, width=width, height=height,
+                                           convert_to_h265=True, attempt=1, preset=preset, threads=threads,
+                                           profile=profile)
+            code, wall, cpu, size, stderr = time_command(cmd_line, output_file)
+            frames = count_frames(output_file) if code == 0 else None
+            # 丢帧不应影响音频，两种配置的音频包数应一致
+            audio_packets = count_frames(output_file, 'a:0') if code == 0 else None
+            row = {'input': label, 'profile': profile, 'command': cmd_line, 'returncode': code,
+                   'wall_s': round(wall, 3), 'cpu_s': round(cpu, 3), 'size_bytes': size,
+                   'input_frames': input_frames, 'output_frames': frames, 'audio_packets': audio_packets}
+            rows.append(row)
+            results[profile] = row
+            if code != 0:
+                print(f"  {profile:<8} 失败 (返回码 {code}): {stderr.strip()[-200:]}")
+                continue
+            dropped = 1 - frames / input_frames if frames and input_frames else 0
+            print(f"  {profile:<8} {wall:>7.2f}s  CPU {cpu:>7.2f}s  {size / 1024:>9.0f} KiB  "
+                  f"输出 {frames} 帧（丢弃 {dropped:.1%}），音频 {audio_packets} 包")
+        default, lecture = results['default'], results['lecture']
+        if default['size_bytes'] and lecture['size_bytes']:
+            speedup = default['wall_s'] / lecture['wall_s']
+            size_ratio = lecture['size_bytes'] / default['size_bytes']
+            print(f"  讲座配置: 编码加速 {speedup:.2f}x，输出大小为默认配置的 {size_ratio:.1%}")
+            metrics[f'lecture_speedup@{label}'] = round(speedup, 2)
+            metrics[f'lecture_size_ratio@{label}'] = round(size_ratio, 3)
+            metrics[f'lecture_frames_dropped@{label}'] = round(1 - lecture['output_frames'] / input_frames, 3)
+    return rows, metrics
+
+# 按不同码率重新编码同一内容，模拟B站下发的高/低码率H264流
+def make_bitrate_input(workdir, width, height, fps, duration, content, bitrate):
+    video_file = path.join(workdir, f'est_{content}_{width}x{height}_{fps}_{duration}_{bitrate}_video.m4s')
+    if not path.exists(video_file):
+        if content == 'slides':
+            source = make_lecture_input(workdir, width, height, fps, duration, talking_head=True)
+        else:
+            source, _ = make_inputs(workdir, width, height, fps, duration)
+        run(f'ffmpeg -y -v error -i "{source}" -c:v libx264 -preset veryfast -b:v {bitrate} -maxrate {bitrate} '
+            f'-bufsize {bitrate} -g {fps * 5} -an -f mp4 "{video_file}"', shell=True, check=True)
+    return video_file
+
+# 对比转码收益估算与实际 libx265 编码的输出大小，检查哪些输入会被判定为不值得转码
+def estimate_comparison(bd, workdir, width, height, fps, duration, preset, threads, bitrates):
+    rows = []
+    metrics = {}
+    _, audio_file = make_inputs(workdir, width, height, fps, duration)
+    print(f"\n== 转码收益估算 {width}x{height}p{fps}_{duration}s（预设 {preset}）==")
+    print(f"  {'输入':<22} {'输入大小':>10} {'预计大小':>10} {'实际大小':>10} {'预计节省':>8} {'实际节省':>8} {'判定':>6}")
+    for content in ('motion', 'slides'):
+        for bitrate in bitrates:
+            video_file = make_bitrate_input(workdir, width, height, fps, duration, content, bitrate)
+            estimate = bd.estimate_transcode(video_file, width, height, duration)
+            output_file = path.join(workdir, f'est_out_{content}_{bitrate}.mp4')
+            cmd_line = bd.build_ffmpeg_cmd(video_file, audio_file, output_file, width=width, height=height,
+                                           convert_to_h265=True, attempt=1, preset=preset, threads=threads)
+            code, wall, cpu, _, stderr = time_command(cmd_line.replace('-map 1:a:0', '-an').replace('-c:a copy', ''), output_file)
+            actual = path.getsize(output_file) if code == 0 else None
+            label = f'{content}_{bitrate}'
+            row = {'input': label, 'input_bytes': estimate['input_bytes'], 'predicted_bytes': estimate['predicted_bytes'],
+                   'actual_bytes': actual, 'encode_wall_s': round(wall, 3), 'complexity': round(estimate['complexity'], 3),
+                   'pays_off': bd.transcode_pays_off(estimate)}
+            rows.append(row)
+            actual_saving = 1 - actual / estimate['input_bytes'] if actual else None
+            print(f"  {label:<22} {estimate['input_bytes'] / 1024:>9.0f}K {estimate['predicted_bytes'] / 1024:>9.0f}K "
+                  f"{(actual or 0) / 1024:>9.0f}K {estimate['saving_ratio']:>8.0%} {actual_saving or 0:>8.0%} "
+                  f"{'转码' if row['pays_off'] else '复制':>6}")
+            if actual:
+                metrics[f'estimate_error@{label}'] = round(estimate['predicted_bytes'] / actual - 1, 3)
+    return rows, metrics
+
+# 对比一次ffmpeg调用同时生成H265主输出、原始存档和音频文件，与分三次调用各生成一个的耗时
+def multi_output_comparison(bd, workdir, width, height, fps, duration, preset, threads):
+    video_file, audio_file = make_inputs(workdir, width, height, fps, duration)
+    label = f'{width}x{height}p{fps}_{duration}s'
+    extra_outputs = {'original': {}, 'audio': {'codec': 'copy', 'bitrate': '64k'}}
+    print(f"\n== 多输出合成 {label}（预设 {preset}）==")
+    rows = []
+    totals = {}
+    for mode in ('separate', 'single'):
+        output_file = path.join(workdir, f'multi_{mode}_{label}.mp4')
+        main_cmd = bd.build_ffmpeg_cmd(video_file, audio_file, output_file, width=width, height=height,
+                                       convert_to_h265=True, attempt=1, preset=preset, threads=threads,
+                                       extra_args=bd.extra_output_args(output_file, extra_outputs) if mode == 'single' else '')
+        commands = [main_cmd]
+        if mode == 'separate':
+            # 每个附加输出单独一次调用，各自重新读取输入
+            commands += [f'ffmpeg -y -i "{video_file}" -i "{audio_file}" {bd.extra_output_args(output_file, {kind: options})}'
+                         for kind, options in extra_outputs.items()]
+        wall = cpu = 0
+        for cmd_line in commands:
+            code, cmd_wall, cmd_cpu, _, stderr = time_command(cmd_line, output_file)
+            if code != 0:
+                print(f"  {mode:<8} 失败 (返回码 {code}): {stderr.strip()[-200:]}")
+                break
+            wall += cmd_wall
+            cpu += cmd_cpu
+        else:
+            outputs = [output_file] + [bd.partial_output_path(bd.extra_output_path(output_file, kind, options))
+                                       for kind, options in extra_outputs.items()]
+            verified = [bd.verify_output(f, duration)[0] for f in outputs[1:]]
+            rows.append({'input': label, 'mode': mode, 'invocations': len(commands), 'wall_s': round(wall, 3),
+                         'cpu_s': round(cpu, 3), 'sizes': [path.getsize(f) for f in outputs], 'verified': verified})
+            totals[mode] = wall
+            print(f"  {mode:<8} {len(commands)} 次调用 {wall:>7.2f}s  CPU {cpu:>7.2f}s  附加输出校验 {sum(verified)}/{len(verified)}")
+    metrics = {}
+    if len(totals) == 2:
+        metrics[f'multi_output_speedup@{label}'] = round(totals['separate'] / totals['single'], 3)
+        print(f"  一次调用相对分开调用: {totals['separate'] / totals['single']:.2f}x")
+    return rows, metrics
+
+# 枚举合成阶梯中可能出现的方案，参数与 ffmpeg_merge 调用 build_ffmpeg_cmd 时一致
+def strategies(presets, default_preset):
+    yield 'copy', {'attempt': 0}
+    for preset in presets:
+        yield f'x265_{preset}', {'attempt': 1, 'convert_to_h265': True, 'preset': preset}
+    yield 'x265_ladder_fast', {'attempt': 4, 'convert_to_h265': True}
+    yield 'x265_fps30', {'attempt': 1, 'convert_to_h265': True, 'preset': default_preset,
+                         'convert_framerate': True, 'target_framerate': 30}
+    yield 'x265_scale', {'attempt': 3, 'convert_to_h265': True, 'preset': default_preset}
+
+# 执行一条命令并统计耗时、CPU时间和输出大小
+def time_command(cmd_line, output_file):
+    before = getrusage(RUSAGE_CHILDREN) if getrusage else None
+    started = perf_counter()
+    result = run(cmd_line, shell=True, stdout=DEVNULL, stderr=PIPE, text=True)
+    wall = perf_counter() - started
+    after = getrusage(RUSAGE_CHILDREN) if getrusage else None
+    cpu = after.ru_utime + after.ru_stime - before.ru_utime - before.ru_stime if after else float('nan')
+    size = path.getsize(output_file) if result.returncode == 0 and path.exists(output_file) else None
+    return result.returncode, wall, cpu, size, result.stderr[-500:]
+
+# 同时运行N个相同的编码，测量总吞吐，用于推荐 concurrent_ffmpeg
+def concurrency_sweep(bd, workdir, video_file, audio_file, width, height, frames, preset, levels):
+    results = []
+    for level in levels:
+        processes = []
+        started = perf_counter()
+        for i in range(level):
+            output_file = path.join(workdir, f'sweep_{level}_{i}.mp4')
+            cmd_line = bd.build_ffmpeg_cmd(video_file, audio_file, output_file, width=width, height=height,
+                                           convert_to_h265=True, attempt=1, preset=preset)
+            processes.append(Popen(cmd_line, shell=True, stdout=DEVNULL, stderr=DEVNULL))
+        codes = [p.wait() for p in processes]
+        wall = perf_counter() - started
+        aggregate_fps = frames * level / wall if all(c == 0 for c in codes) else None
+        results.append({'concurrency': level, 'wall_s': round(wall, 3), 'aggregate_fps': aggregate_fps and round(aggregate_fps, 2)})
+        print(f"  并发 {level}: 总耗时 {wall:.2f}s, 总吞吐 {aggregate_fps or 0:.1f} fps")
+    return results
+
+# 选择总吞吐提升不足10%之前的最小并发数
+def recommend_concurrency(sweep, min_gain=0.10):
+    best = sweep[0]
+    for row in sweep[1:]:
+        if not row['aggregate_fps'] or not best['aggregate_fps']:
+            break
+        if row['aggregate_fps'] < best['aggregate_fps'] * (1 + min_gain):
+            break
+        best = row
+    return best['concurrency']
+
+# 选择输出大小在最小值容差内的最快预设
+def recommend_preset(runs, presets, tolerance):
+    totals = {}
+    for preset in presets:
+        rows = [r for r in runs if r['strategy'] == f'x265_{preset}']
+        if not rows or any(r['size_bytes'] is None for r in rows):
+            continue
+        totals[preset] = (sum(r['wall_s'] for r in rows), sum(r['size_bytes'] for r in rows))
+    if not totals:
+        return None
+    smallest = min(size for _, size in totals.values())
+    candidates = [(wall, preset) for preset, (wall, size) in totals.items() if size <= smallest * (1 + tolerance)]
+    return min(candidates)[1]
+
+# 只改写 [General] 中对应键所在的行，保留用户配置文件中的注释、顺序和换行符
+def write_config(config_file, recommendations):
+    updates = {key.lower(): str(value) for key, value in recommendations.items() if value is not None}
+    try:
+        with open(config_file, 'r', encoding='utf-8', newline='') as f:
+            lines = f.read().splitlines(keepends=True)
+    except FileNotFoundError:
+        lines = []
+    newline = '\r\n' if lines and lines[0].endswith('\r\n') else '\n'
+    if lines and not lines[-1].endswith(('\r', '\n')):
+        lines[-1] += newline
+    section = None
+    insert_at = None
+    for i, line in enumerate(lines):
+        stripped = line.strip()
+        if stripped.startswith('[') and stripped.endswith(']'):
+            section = stripped[1:-1].strip()
+            if section == 'General':
+                insert_at = i + 1
+            continue
+        if section != 'General':
+            continue
+        if not stripped or stripped.startswith(('#', ';')):
+            continue
+        insert_at = i + 1
+        key = stripped.split('=' if '=' in stripped else ':', 1)[0].strip()
+        if key.lower() in updates:
+            indent = line[:len(line) - len(line.lstrip())]
+            lines[i] = f"{indent}{key} = {updates.pop(key.lower())}{newline}"
+    added = [f"{key} = {value}{newline}" for key, value in updates.items()]
+    if insert_at is None:
+        added.insert(0, f"[General]{newline}")
+        if lines and lines[-1].strip():
+            added.insert(0, newline)
+        insert_at = len(lines)
+    lines[insert_at:insert_at] = added
+    with open(config_file, 'w', encoding='utf-8', newline='') as f:
+        f.write(''.join(lines))
+    print(f"已写入推荐配置到: {config_file}")
+
+def main():
+    parser = ArgumentParser(description='ffmpeg 合成/转码方案基准测试')
+    parser.add_argument('--resolutions', default='1280x720,1920x1080', help='分辨率列表')
+    parser.add_argument('--framerates', default='30,60', help='帧率列表')
+    parser.add_argument('--durations', default='10', help='时长列表（秒）')
+    parser.add_argument('--presets', default='ultrafast,superfast,veryfast,faster,fast,medium', help='要测试的libx265预设')
+    parser.add_argument('--default-preset', default='medium', help='fps/缩放方案使用的预设')
+    parser.add_argument('--size-tolerance', type=float, default=0.10, help='推荐预设时允许比最小输出大多少')
+    parser.add_argument('--lecture', action='store_true', help='只对比默认配置与讲座配置（丢弃重复帧）')
+    parser.add_argument('--estimate', action='store_true', help='只对比转码收益估算与实际编码结果')
+    parser.add_argument('--multi-output', action='store_true', help='只对比一次调用生成多个输出与分开调用的耗时')
+    parser.add_argument('--bitrates', default='4M,1500k,600k,250k', help='--estimate 使用的输入码率列表')
+    parser.add_argument('--threads', type=int, default=0, help='每个编码进程的线程数，0为不限制')
+    parser.add_argument('--concurrency-sweep', action='store_true', help='测试并行编码数对总吞吐的影响')
+    parser.add_argument('--max-concurrency', type=int, default=cpu_count() or 1, help='并发测试的上限')
+    parser.add_argument('--write-config', help='把推荐值写入指定的config.ini')
+    parser.add_argument('--workdir', help='工作目录，默认使用临时目录')
+    parser.add_argument('--keep', action='store_true', help='保留工作目录')
+    parser.add_argument('--output', help='结果JSON路径')
+    parser.add_argument('--compare', help='与之前的结果JSON对比')
+    args = parser.parse_args()
+
+    if not shutil.which('ffmpeg'):
+        parser.error('需要 ffmpeg')
+
+    workdir = path.abspath(args.workdir or mkdtemp(prefix='bdownloader_ffbench_'))
+    bd = load_bdownloader(workdir)
+    presets = [p for p in args.presets.split(',') if p]
+    resolutions = [tuple(int(x) for x in r.split('x')) for r in args.resolutions.split(',')]
+    framerates = [int(x) for x in args.framerates.split(',')]
+    durations = [int(x) for x in args.durations.split(',')]
+
+    if args.lecture or args.estimate or args.multi_output:
+        runs, metrics = [], {}
+        for width, height in resolutions:
+            for fps in framerates:
+                for duration in durations:
+                    if args.lecture:
+                        rows, extra_metrics = lecture_comparison(bd, workdir, width, height, fps, duration,
+                                                                 args.default_preset, args.threads)
+                    elif args.multi_output:
+                        rows, extra_metrics = multi_output_comparison(bd, workdir, width, height, fps, duration,
+                                                                      args.default_preset, args.threads)
+                    else:
+                        rows, extra_metrics = estimate_comparison(bd, workdir, width, height, fps, duration,
+                                                                  args.default_preset, args.threads,
+                                                                  [b for b in args.bitrates.split(',') if b])
+                    runs.extend(rows)
+                    metrics.update(extra_metrics)
+        name = 'ffmpeg_lecture' if args.lecture else 'ffmpeg_multi_output' if args.multi_output else 'ffmpeg_estimate'
+        save_results(name, vars(args), metrics, args.output, {'runs': runs})
+        if args.compare:
+            compare_results(metrics, args.compare)
+        if not args.keep and not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+        return
+
+    runs = []
+    metrics = {}
+    for width, height in resolutions:
+        for fps in framerates:
+            for duration in durations:
+                video_file, audio_file = make_inputs(workdir, width, height, fps, duration)
+                frames = fps * duration
+                label = f'{width}x{height}p{fps}_{duration}s'
+                print(f"\n== 输入 {label} ==")
+                for name, options in strategies(presets, args.default_preset):
+                    output_file = path.join(workdir, f'out_{label}_{name}.mp4')
+                    cmd_line = bd.build_ffmpeg_cmd(video_file, audio_file, output_file, width=width, height=height,
+                                                   original_framerate=fps, **options)
+                    code, wall, cpu, size, stderr = time_command(cmd_line, output_file)
+                    row = {
+                        'input': label, 'strategy': name, 'command': cmd_line, 'returncode': code,
+                        'wall_s': round(wall, 3), 'cpu_s': round(cpu, 3),
+                        'encode_fps': round(frames / wall, 2), 'realtime_factor': round(duration / wall, 2),
+                        'size_bytes': size,
+                    }
+                    runs.append(row)
+                    if code != 0:
+                        print(f"  {name:<18} 失败 (返回码 {code}): {stderr.strip()[-200:]}")
+                        continue
+                    print(f"  {name:<18} {row['encode_fps']:>9.1f} fps  {row['realtime_factor']:>7.2f}x  "
+                          f"{size / 1024:>10.0f} KiB  CPU {cpu:>7.2f}s")
+                    metrics[f'{name}@{label}_fps'] = row['encode_fps']
+                    metrics[f'{name}@{label}_kib'] = round(size / 1024, 1)
+
+    recommendations = {'x265_preset': recommend_preset(runs, presets, args.size_tolerance)}
+    sweep = None
+    if args.concurrency_sweep:
+        width, height = resolutions[-1]
+        fps, duration = framerates[0], durations[0]
+        video_file, audio_file = make_inputs(workdir, width, height, fps, duration)
+        preset = recommendations['x265_preset'] or args.default_preset
+        print(f"\n== 并行编码测试 ({width}x{height}p{fps}, 预设 {preset}) ==")
+        levels = sorted({1, 2, *range(4, args.max_concurrency + 1, 2), args.max_concurrency})
+        sweep = concurrency_sweep(bd, workdir, video_file, audio_file, width, height, fps * duration, preset, levels)
+        recommendations['concurrent_ffmpeg'] = recommend_concurrency(sweep)
+        for row in sweep:
+            if row['aggregate_fps']:
+                metrics[f"aggregate_fps@concurrency_{row['concurrency']}"] = row['aggregate_fps']
+
+    print(f"\n推荐配置: {recommendations}")
+    save_results('ffmpeg', vars(args), metrics, args.output,
+                 {'runs': runs, 'concurrency_sweep': sweep, 'recommendations': recommendations})
+    if args.compare:
+        compare_results(metrics, args.compare)
+    if args.write_config:
+        write_config(args.write_config, recommendations)
+    if not args.keep and not args.workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+from os import path, makedirs, chdir, getcwd
+from subprocess import run, PIPE
+from json import dump, load
+from time import strftime
+from importlib.util import spec_from_file_location, module_from_spec
+import sys
+
+# 仓库根目录与主程序路径
+REPO_ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+MAIN_SCRIPT = path.join(REPO_ROOT, 'bdownloader_3.0.py')
+RESULTS_DIR = path.join(REPO_ROOT, 'benchmarks', 'results')
+
+# 主程序文件名带有"."，无法直接import，这里按路径加载
+# 注意：主程序在导入时会在当前目录创建日志文件，调用前应先切换到工作目录
+def load_bdownloader(workdir=None):
+    old_cwd = getcwd()
+    if workdir:
+        makedirs(workdir, exist_ok=True)
+        chdir(workdir)
+    try:
+        spec = spec_from_file_location('bdownloader', MAIN_SCRIPT)
+        module = module_from_spec(spec)
+        sys.modules['bdownloader'] = module
+        spec.loader.exec_module(module)
+        return module
+    finally:
+        if workdir:
+            chdir(old_cwd)
+
+# 获取当前提交号，用于区分不同版本的测试结果
+def git_revision():
+    try:
+        result = run(['git', 'rev-parse', '--short', 'HEAD'], stdout=PIPE, stderr=PIPE, text=True, cwd=REPO_ROOT, timeout=10)
+        rev = result.stdout.strip() or 'unknown'
+        dirty = run(['git', 'status', '--porcelain', '--untracked-files=no'], stdout=PIPE, stderr=PIPE,
+                    text=True, cwd=REPO_ROOT, timeout=10).stdout.strip()
+        return f"{rev}-dirty" if dirty else rev
+    except Exception:
+        return 'unknown'
+
+# 保存测试结果为JSON，默认保存到 benchmarks/results/<名称>_<提交号>_<时间>.json
+def save_results(name, params, metrics, output_file=None, extra=None):
+    rev = git_revision()
+    result = {
+        'benchmark': name,
+        'git_rev': rev,
+        'timestamp': strftime('%Y-%m-%d %H:%M:%S'),
+        'python': sys.version.split()[0],
+        'platform': sys.platform,
+        'params': params,
+        'metrics': metrics,
+    }
+    if extra:
+        result.update(extra)
+    if not output_file:
+        makedirs(RESULTS_DIR, exist_ok=True)
+        output_file = path.join(RESULTS_DIR, f"{name}_{rev}_{strftime('%Y%m%d_%H%M%S')}.json")
+    with open(output_file, 'w', encoding='utf-8') as f:
+        dump(result, f, indent=2, ensure_ascii=False)
+    print(f"测试结果已保存到: {output_file}")
+    return output_file
+
+# 与基准结果对比，打印各项指标的变化百分比
+def compare_results(metrics, baseline_file):
+    with open(baseline_file, 'r', encoding='utf-8') as f:
+        baseline = load(f)
+    print(f"\n== 与基准 {baseline.get('git_rev', '?')} ({baseline_file}) 对比 ==")
+    for key, value in metrics.items():
+        old = baseline.get('metrics', {}).get(key)
+        if not isinstance(value, (int, float)) or not isinstance(old, (int, float)):
+            continue
+        change = f"{(value - old) / old * 100:+.1f}%" if old else "n/a"
+        print(f"  {key:<28} {old:>14.3f} -> {value:>14.3f}  ({change})")
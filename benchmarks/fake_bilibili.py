@@ -0,0 +1,374 @@
+from os import path
+from json import dumps, loads
+from time import time, monotonic
+from random import Random
+from struct import pack
+from asyncio import sleep as asyncio_sleep, run as asyncio_run, Event
+from multiprocessing import Process, Queue
+from urllib.request import urlopen
+from zlib import crc32
+
+from aiohttp import web
+from bilibili_api.exceptions import ResponseCodeException
+
+# 本地CDN配置的默认值
+DEFAULT_CDN_CONFIG = {
+    'bandwidth': 0,        # 单连接带宽上限（字节/秒），0表示不限速
+    'latency': 0.0,        # 每个请求的首字节延迟（秒）
+    'error_rate': 0.0,     # 直接返回503的请求比例
+    'fault_rate': 0.0,     # 传输中途断开连接的请求比例
+    'stall_rate': 0.0,     # 传输中途卡住的请求比例
+    'stall_seconds': 30.0, # 卡住的时长（秒）
+    'ignore_range_rate': 0.0,  # 忽略Range、直接返回完整文件(200)的请求比例
+    'html_error_rate': 0.0,    # 以200状态返回HTML错误页的请求比例
+    'rate_limit_rate': 0.0,    # 返回412（风控限流）的请求比例
+    'url_ttl': 0,          # 链接有效期（秒），0表示永不过期
+    'chunk_size': 65536,   # 服务端每次写出的块大小
+    'seed': 42,
+}
+
+# 按 "bytes=start-end" 解析Range请求头
+def parse_range(header, size):
+    if not header or not header.startswith('bytes='):
+        return None
+    start_text, _, end_text = header[6:].split(',')[0].partition('-')
+    try:
+        if start_text == '':
+            length = int(end_text)
+            return max(0, size - length), size - 1
+        start = int(start_text)
+        end = int(end_text) if end_text else size - 1
+    except ValueError:
+        return None
+    if start >= size:
+        return start, -1
+    return start, min(end, size - 1)
+
+# 模拟B站CDN的本地服务：提供合成的DASH m4s文件，支持Range、限速、延迟、故障注入和链接过期
+class SyntheticCDN:
+    def __init__(self, files, config=None):
+        self.files = files  # 文件名 -> bytes
+        self.config = dict(DEFAULT_CDN_CONFIG)
+        self.config.update(config or {})
+        self.random = Random(self.config['seed'])
+        self.stats = {'requests': 0, 'head_requests': 0, 'bytes_served': 0, 'errors': 0,
+                      'faults': 0, 'stalls': 0, 'expired': 0, 'range_requests': 0,
+                      'ignored_ranges': 0, 'html_errors': 0, 'rate_limited': 0}
+        self.runner = None
+        self.base_url = None
+
+    def url_for(self, name):
+        ttl = self.config['url_ttl']
+        deadline = int(time() + ttl) if ttl else 0
+        return f"{self.base_url}/{name}?deadline={deadline}"
+
+    async def handle_stats(self, request):
+        return web.json_response(self.stats)
+
+    async def handle_file(self, request):
+        name = request.match_info['name']
+        data = self.files.get(name)
+        if data is None:
+            return web.Response(status=404)
+
+        deadline = int(request.query.get('deadline', '0') or 0)
+        if deadline and time() > deadline:
+            self.stats['expired'] += 1
+            return web.Response(status=403, text='url expired')
+
+        if request.method == 'HEAD':
+            self.stats['head_requests'] += 1
+            if self.config['latency']:
+                await asyncio_sleep(self.config['latency'])
+            return web.Response(headers={'Content-Length': str(len(data)), 'Accept-Ranges': 'bytes'})
+
+        self.stats['requests'] += 1
+        if self.config['latency']:
+            await asyncio_sleep(self.config['latency'])
+        if self.random.random() < self.config['error_rate']:
+            self.stats['errors'] += 1
+            return web.Response(status=503, text='injected error')
+        if self.random.random() < self.config['rate_limit_rate']:
+            self.stats['rate_limited'] += 1
+            return web.Response(status=412, text='rate limited')
+        if self.random.random() < self.config['html_error_rate']:
+            self.stats['html_errors'] += 1
+            return web.Response(status=200, text='<!DOCTYPE html><html><body>busy</body></html>', content_type='text/html')
+
+        size = len(data)
+        byte_range = parse_range(request.headers.get('Range'), size)
+        if byte_range and self.random.random() < self.config['ignore_range_rate']:
+            self.stats['ignored_ranges'] += 1
+            byte_range = None
+        if byte_range:
+            start, end = byte_range
+            if end < start:
+                return web.Response(status=416, headers={'Content-Range': f'bytes */{size}'})
+            self.stats['range_requests'] += 1
+            status = 206
+            headers = {'Content-Range': f'bytes {start}-{end}/{size}'}
+        else:
+            start, end = 0, size - 1
+            status = 200
+            headers = {}
+        headers['Accept-Ranges'] = 'bytes'
+        headers['Content-Type'] = 'video/mp4'
+
+        response = web.StreamResponse(status=status, headers=headers)
+        response.content_length = end - start + 1
+        await response.prepare(request)
+
+        # 决定本次传输是否注入故障，以及在哪个位置注入
+        fault_at = stall_at = None
+        if self.random.random() < self.config['fault_rate']:
+            fault_at = start + int((end - start + 1) * self.random.random())
+        elif self.random.random() < self.config['stall_rate']:
+            stall_at = start + int((end - start + 1) * self.random.random())
+
+        bandwidth = self.config['bandwidth']
+        chunk_size = self.config['chunk_size']
+        began = monotonic()
+        sent = 0
+        offset = start
+        while offset <= end:
+            chunk_end = min(offset + chunk_size, end + 1)
+            if fault_at is not None and offset <= fault_at < chunk_end:
+                self.stats['faults'] += 1
+                await response.write(data[offset:fault_at])
+                self.stats['bytes_served'] += fault_at - offset
+                request.transport.close()
+                return response
+            if stall_at is not None and offset <= stall_at < chunk_end:
+                self.stats['stalls'] += 1
+                stall_at = None
+                await asyncio_sleep(self.config['stall_seconds'])
+            await response.write(data[offset:chunk_end])
+            sent += chunk_end - offset
+            self.stats['bytes_served'] += chunk_end - offset
+            offset = chunk_end
+            if bandwidth:
+                # 按单连接带宽限速
+                ahead = sent / bandwidth - (monotonic() - began)
+                if ahead > 0:
+                    await asyncio_sleep(ahead)
+        await response.write_eof()
+        return response
+
+    async def start(self, host='127.0.0.1', port=0):
+        app = web.Application()
+        app.router.add_get('/__stats', self.handle_stats)
+        app.router.add_get('/{name}', self.handle_file)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://{host}:{port}"
+        return self.base_url
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+
+# 生成确定性的合成m4s数据（ftyp + 若干 moof/mdat 顶层box，负载为伪随机字节），或读取真实媒体文件
+def build_payload(size=None, seed=0, source_file=None, fragment_size=1024 * 1024):
+    if source_file:
+        with open(source_file, 'rb') as f:
+            return f.read()
+    rng = Random(seed)
+    parts = [pack('>I4s', 24, b'ftyp') + b'iso5' + pack('>I', 512) + b'iso6mp41']
+    written = 24
+    while written < size:
+        moof_size = min(104, size - written)
+        if moof_size < 8:
+            # 剩余空间不足一个box头，补到上一个mdat里
+            last = parts.pop()
+            parts.append(pack('>I', len(last) + moof_size) + last[4:] + rng.randbytes(moof_size))
+            break
+        parts.append(pack('>I4s', moof_size, b'moof') + rng.randbytes(moof_size - 8))
+        written += moof_size
+        mdat_size = min(fragment_size, size - written)
+        if mdat_size < 8:
+            last = parts.pop()
+            parts.append(pack('>I', len(last) + mdat_size) + last[4:] + rng.randbytes(mdat_size))
+            break
+        parts.append(pack('>I4s', mdat_size, b'mdat') + rng.randbytes(mdat_size - 8))
+        written += mdat_size
+    return b''.join(parts)
+
+def _cdn_process_main(file_specs, config, queue):
+    files = {name: build_payload(**spec) for name, spec in file_specs.items()}
+    cdn = SyntheticCDN(files, config)
+
+    async def serve():
+        queue.put(await cdn.start())
+        await Event().wait()
+
+    asyncio_run(serve())
+
+# 在独立进程中运行CDN，避免服务端开销干扰客户端的吞吐和内存测量
+# processes 大于1时启动多个服务进程（各自一个端口），文件按名称分散到各进程，避免服务端先成为瓶颈
+class CDNProcess:
+    def __init__(self, file_specs, config=None, processes=1):
+        # file_specs: 文件名 -> {'size': int, 'seed': int} 或 {'source_file': 路径}
+        self.file_specs = file_specs
+        self.config = dict(DEFAULT_CDN_CONFIG)
+        self.config.update(config or {})
+        self.process_count = max(1, processes)
+        self.processes = []
+        self.base_urls = []
+
+    @property
+    def base_url(self):
+        return self.base_urls[0] if self.base_urls else None
+
+    def shard(self, name):
+        return crc32(name.encode()) % self.process_count
+
+    def __enter__(self):
+        queue = Queue()
+        for index in range(self.process_count):
+            files = {name: spec for name, spec in self.file_specs.items() if self.shard(name) == index}
+            process = Process(target=_cdn_process_main, args=(files, self.config, queue), daemon=True)
+            process.start()
+            self.processes.append(process)
+            self.base_urls.append(queue.get(timeout=120))
+        return self
+
+    def __exit__(self, *exc):
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+                process.join(10)
+
+    def url_for(self, name):
+        ttl = self.config['url_ttl']
+        deadline = int(time() + ttl) if ttl else 0
+        return f"{self.base_urls[self.shard(name)]}/{name}?deadline={deadline}"
+
+    def stats(self):
+        total = {}
+        for base_url in self.base_urls:
+            with urlopen(f"{base_url}/__stats", timeout=10) as response:
+                for key, value in loads(response.read()).items():
+                    total[key] = total.get(key, 0) + value
+        return total
+
+# 不可连接的CDN节点，用于测试备用链接和熔断
+DEAD_HOST = 'http://127.0.0.1:9'
+
+# 模拟B站API的风控：滑动1秒窗口内的请求超过 rate 次时返回 -352
+class FakeApiLimiter:
+    def __init__(self, rate=0):
+        self.rate = rate
+        self.recent = []
+        self.calls = 0
+        self.rejected = 0
+
+    def check(self):
+        self.calls += 1
+        if not self.rate:
+            return
+        now = monotonic()
+        self.recent = [t for t in self.recent if now - t < 1]
+        if len(self.recent) >= self.rate:
+            self.rejected += 1
+            raise ResponseCodeException(-352, '风控校验失败')
+        self.recent.append(now)
+
+# 模拟 cheese.CheeseList 中的单集对象
+# dead_primary 为 True 时主链接指向不可连接的节点，真实地址放在 backup_url 中
+class FakeEpisode:
+    def __init__(self, cdn, epid, title, duration, video_name, audio_name, video_size, audio_size, cid=None,
+                 dead_primary=False, limiter=None):
+        self.cdn = cdn
+        self.epid = epid
+        self.cid = cid or epid * 10
+        self.title = title
+        self.duration = duration
+        self.video_name = video_name
+        self.audio_name = audio_name
+        self.video_size = video_size
+        self.audio_size = audio_size
+        self.dead_primary = dead_primary
+        self.limiter = limiter or FakeApiLimiter()
+        self.api_calls = 0
+        self.listed = False
+
+    def stream_urls(self, name):
+        url = self.cdn.url_for(name)
+        if self.dead_primary:
+            return f"{DEAD_HOST}/{name}", [url]
+        return url, []
+
+    def get_epid(self):
+        return self.epid
+
+    # 与 bilibili_api 一致：课程列表已返回的单集元数据直接读取，不再请求
+    async def get_meta(self):
+        if not self.listed:
+            self.api_calls += 1
+            self.limiter.check()
+        return {'id': self.epid, 'cid': self.cid, 'title': self.title, 'duration': self.duration}
+
+    async def get_download_url(self):
+        self.api_calls += 1
+        self.limiter.check()
+        duration = max(self.duration, 1)
+        segment_base = {'initialization': '0-999', 'index_range': '1000-1999'}
+        video_url, video_backup = self.stream_urls(self.video_name)
+        audio_url, audio_backup = self.stream_urls(self.audio_name)
+        return {
+            'dash': {
+                'duration': self.duration,
+                'video': [{
+                    'id': 80, 'base_url': video_url, 'backup_url': video_backup,
+                    'bandwidth': self.video_size * 8 // duration, 'codecs': 'avc1.640032', 'codecid': 7,
+                    'frame_rate': '30', 'width': 1920, 'height': 1080, 'sar': '1:1',
+                    'mime_type': 'video/mp4', 'segment_base': segment_base,
+                }],
+                'audio': [{
+                    'id': 30280, 'base_url': audio_url, 'backup_url': audio_backup,
+                    'bandwidth': self.audio_size * 8 // duration, 'codecs': 'mp4a.40.2',
+                    'mime_type': 'audio/mp4', 'segment_base': segment_base,
+                }],
+            }
+        }
+
+# 模拟 cheese.CheeseList
+class FakeCheeseList:
+    def __init__(self, title, episodes, season_id=1, limiter=None):
+        self.title = title
+        self.episodes = episodes
+        self.season_id = season_id
+        self.limiter = limiter or FakeApiLimiter()
+        self.api_calls = 0
+
+    async def get_meta(self):
+        self.api_calls += 1
+        self.limiter.check()
+        return {'season_id': self.season_id, 'title': self.title, 'ep_count': len(self.episodes),
+                'episodes': [{'id': ep.epid, 'cid': ep.cid, 'title': ep.title, 'duration': ep.duration}
+                             for ep in self.episodes]}
+
+    async def get_list(self):
+        self.api_calls += 1
+        self.limiter.check()
+        for ep in self.episodes:
+            ep.listed = True
+        return list(self.episodes)
+
+# 模拟登录凭证，跳过扫码登录
+class FakeCredential:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    async def check_valid(self):
+        return True
+
+    def get_cookies(self):
+        return {'SESSDATA': 'benchmark', 'bili_jct': 'benchmark', 'buvid3': 'benchmark'}
+
+def write_fake_session(workdir):
+    with open(path.join(workdir, 'bilibili.session'), 'w', encoding='utf-8') as f:
+        f.write(dumps(FakeCredential().get_cookies()))
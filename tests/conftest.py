@@ -0,0 +1,13 @@
+"""测试共用的夹具：在临时目录中加载主脚本，避免日志和配置文件写入仓库目录。"""
+from os import path
+import sys
+
+import pytest
+
+sys.path.insert(0, path.join(path.dirname(path.dirname(path.abspath(__file__))), 'benchmarks'))
+from common import load_bdownloader
+
+
+@pytest.fixture(scope='session')
+def bd(tmp_path_factory):
+    return load_bdownloader(str(tmp_path_factory.mktemp('bdownloader')))
@@ -0,0 +1,132 @@
+"""ApiClient 的令牌桶限速、请求合并、缓存有效期，以及列表中已有的元数据不占用令牌。"""
+from asyncio import Event, gather, run
+
+import pytest
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    async def sleep(self, seconds):
+        self.now += seconds
+        self.slept += seconds
+
+
+@pytest.fixture
+def clock(bd, monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(bd, 'monotonic', clock.monotonic)
+    monkeypatch.setattr(bd, 'asyncio_sleep', clock.sleep)
+    return clock
+
+
+def constant(value):
+    async def factory():
+        return value
+    return factory
+
+
+def test_token_bucket_paces_requests(bd, clock):
+    client = bd.ApiClient(rate=2, burst=1)
+
+    async def scenario():
+        for i in range(5):
+            await client.call(('key', i), constant(i))
+    run(scenario())
+    # 第一个请求使用初始令牌，之后每个请求等待 1/rate 秒
+    assert clock.slept == pytest.approx(2.0)
+    assert client.stats['calls'] == 5
+
+
+def test_concurrent_requests_are_coalesced(bd, clock):
+    client = bd.ApiClient()
+    calls = []
+
+    async def scenario():
+        release = Event()
+
+        async def factory():
+            calls.append(1)
+            await release.wait()
+            return 'meta'
+        waiters = [client.call('same', factory) for _ in range(3)]
+
+        async def unblock():
+            release.set()
+        return await gather(*waiters, unblock())
+    results = run(scenario())
+    assert results[:3] == ['meta'] * 3
+    assert len(calls) == 1
+    assert client.stats['coalesced'] == 2
+
+
+def test_ttl_cache_expires(bd, clock):
+    client = bd.ApiClient()
+    values = iter(['first', 'second'])
+
+    async def factory():
+        return next(values)
+
+    async def scenario():
+        results = [await client.call('url', factory, ttl=10)]
+        clock.now += 5
+        results.append(await client.call('url', factory, ttl=10))
+        clock.now += 6
+        results.append(await client.call('url', factory, ttl=10))
+        return results
+    assert run(scenario()) == ['first', 'first', 'second']
+    assert client.stats['calls'] == 2
+
+
+class ListedEpisode:
+    def __init__(self, epid):
+        self.epid = epid
+
+    def get_epid(self):
+        return self.epid
+
+    async def get_meta(self):
+        return {'id': self.epid, 'cid': self.epid * 10, 'title': f'第{self.epid}讲'}
+
+
+class FakeCourse:
+    season_id = 1
+
+    def __init__(self, count):
+        self.episodes = [ListedEpisode(i) for i in range(1, count + 1)]
+
+    async def get_meta(self):
+        return {'season_id': 1, 'title': '课程'}
+
+    async def get_list(self):
+        return self.episodes
+
+
+# 列表返回的元数据已经在本地，500集的课程逐集读取元数据不应产生限速等待
+def test_listed_episode_meta_costs_no_token(bd, clock):
+    client = bd.ApiClient(rate=5, burst=10)
+    course = FakeCourse(500)
+
+    async def scenario():
+        episodes = await client.course_list(course)
+        return [await client.episode_meta(ep) for ep in episodes]
+    metas = run(scenario())
+    assert len(metas) == 500
+    assert clock.slept == 0
+    assert client.stats['calls'] == 1
+
+
+def test_unlisted_episode_meta_is_rate_limited(bd, clock):
+    client = bd.ApiClient(rate=5, burst=1)
+
+    async def scenario():
+        for i in range(1, 4):
+            await client.episode_meta(ListedEpisode(i))
+    run(scenario())
+    assert client.stats['calls'] == 3
+    assert clock.slept == pytest.approx(0.4)
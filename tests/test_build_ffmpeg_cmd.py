@@ -0,0 +1,19 @@
+"""build_ffmpeg_cmd 各方案命令的检查。"""
+
+
+# 检测到GPU编码器时，x265的预设不能传给GPU编码器，保底的 libx265 方案仍要带上预设
+def test_gpu_encoder_does_not_take_x265_preset(bd, monkeypatch):
+    monkeypatch.setattr(bd, 'check_encoder_supported', lambda name: name == 'hevc_nvenc')
+    options = dict(use_gpu=True, convert_to_h265=True, preset='veryslow')
+
+    gpu_cmd = bd.build_ffmpeg_cmd('video.m4s', 'audio.m4s', 'out.mp4', attempt=1, **options)
+    assert '-c:v hevc_nvenc' in gpu_cmd
+    assert '-preset veryslow' not in gpu_cmd
+
+    fallback_cmd = bd.build_ffmpeg_cmd('video.m4s', 'audio.m4s', 'out.mp4', attempt=5, **options)
+    assert '-c:v libx265 -preset veryslow' in fallback_cmd
+
+
+def test_cpu_encode_keeps_preset(bd):
+    cmd = bd.build_ffmpeg_cmd('video.m4s', 'audio.m4s', 'out.mp4', convert_to_h265=True, attempt=1, preset='slow')
+    assert '-c:v libx265 -preset slow' in cmd
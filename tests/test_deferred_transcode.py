@@ -0,0 +1,33 @@
+"""延后转码队列中的任务。"""
+from re import search
+from shutil import which
+from subprocess import run
+
+import pytest
+
+needs_ffmpeg = pytest.mark.skipif(which('ffmpeg') is None, reason='需要 ffmpeg')
+
+
+def stream_framerate(file_path):
+    stderr = run(['ffmpeg', '-hide_banner', '-i', file_path], capture_output=True, text=True).stderr
+    return float(search(r'Video: .*?([\d.]+) fps', stderr).group(1))
+
+
+# 只开启帧率转换的延后任务也要真正转换帧率，而不是当作无需转码直接完成
+@needs_ffmpeg
+def test_deferred_framerate_job_converts_framerate(bd, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    output_file = str(tmp_path / '001_测试.mp4')
+    run(f'ffmpeg -y -v error -f lavfi -i testsrc2=size=320x240:rate=30 -f lavfi -i sine=frequency=440 -t 2 '
+        f'-c:v libx264 -preset ultrafast -c:a aac -shortest "{output_file}"', shell=True, check=True)
+    queue = bd.EncodeSpool(str(tmp_path / 'encode_queue'))
+    bd.enqueue_deferred_transcode({
+        'video_file': output_file, 'audio_file': output_file, 'output_file': output_file,
+        'title': '测试', 'index': 1, 'total_count': 1, 'duration': 2,
+        'convert_to_h265': False, 'convert_framerate': True, 'target_framerate': 15, 'original_framerate': 30,
+        'preset': 'ultrafast',
+    }, queue=queue, output_format='mp4')
+
+    bd.run_encode_worker(queue.root, jobs=1, poll=0.1, exit_when_idle=True)
+
+    assert stream_framerate(output_file) == 15
@@ -0,0 +1,88 @@
+"""低速看门狗的窗口和等待时间处理，以及下载错误到重试策略的分类。"""
+from asyncio import TimeoutError as AsyncTimeoutError
+
+from aiohttp import ClientConnectionError, ClientPayloadError, ServerDisconnectedError
+import pytest
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 500.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(bd, monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(bd, 'monotonic', clock)
+    return clock
+
+
+# 每秒收到 speed 字节，持续 seconds 秒，返回看门狗最后一次的结果
+def run_at(watchdog, clock, speed, seconds):
+    result = None
+    for _ in range(seconds):
+        clock.now += 1
+        result = watchdog.feed(speed)
+    return result
+
+
+def test_watchdog_waits_for_a_full_window(bd, clock):
+    watchdog = bd.ThroughputWatchdog(min_speed=1000, window=10)
+    assert run_at(watchdog, clock, 10, 9) is None
+    assert run_at(watchdog, clock, 10, 2) == pytest.approx(10)
+
+
+def test_watchdog_accepts_steady_speed(bd, clock):
+    watchdog = bd.ThroughputWatchdog(min_speed=1000, window=10)
+    assert run_at(watchdog, clock, 2000, 60) is None
+
+
+def test_watchdog_trips_after_speed_drops(bd, clock):
+    watchdog = bd.ThroughputWatchdog(min_speed=1000, window=10)
+    assert run_at(watchdog, clock, 5000, 20) is None
+    # 速度下降后，窗口内仍有之前的高速数据，不会立即触发
+    assert run_at(watchdog, clock, 100, 5) is None
+    assert run_at(watchdog, clock, 100, 10) == pytest.approx(100)
+
+
+def test_watchdog_disabled_without_min_speed(bd, clock):
+    watchdog = bd.ThroughputWatchdog(min_speed=0, window=10)
+    assert run_at(watchdog, clock, 0, 60) is None
+
+
+def test_watchdog_ignores_paused_time(bd, clock):
+    watchdog = bd.ThroughputWatchdog(min_speed=1000, window=10)
+    assert run_at(watchdog, clock, 2000, 5) is None
+    # 带宽预算限速等待的30秒不计入窗口
+    clock.now += 30
+    watchdog.pause(30)
+    assert run_at(watchdog, clock, 2000, 5) is None
+
+
+@pytest.mark.parametrize('status, kind', [
+    (403, 'expired'), (404, 'expired'), (410, 'expired'),
+    (412, 'rate_limited'), (429, 'rate_limited'),
+    (408, 'transient'), (500, 'transient'), (502, 'transient'), (503, 'transient'),
+    (400, 'fatal'), (401, 'fatal'),
+])
+def test_classify_http_status(bd, status, kind):
+    assert bd.classify_download_error(bd.DownloadHTTPError(status, 'https://cdn.example.com/video.m4s')) == kind
+
+
+@pytest.mark.parametrize('make_error, kind', [
+    (lambda bd: AsyncTimeoutError(), 'transient'),
+    (lambda bd: ClientConnectionError('connection reset'), 'transient'),
+    (lambda bd: ServerDisconnectedError(), 'transient'),
+    (lambda bd: ClientPayloadError('payload'), 'transient'),
+    (lambda bd: bd.StreamCorruptError('box', 0), 'transient'),
+    (lambda bd: bd.DownloadIncompleteError('short'), 'transient'),
+    (lambda bd: bd.DownloadStalledError('slow'), 'transient'),
+    (lambda bd: PermissionError('denied'), 'fatal'),
+    (lambda bd: OSError(28, 'No space left on device'), 'fatal'),
+    (lambda bd: ValueError('unexpected'), 'transient'),
+])
+def test_classify_other_errors(bd, make_error, kind):
+    assert bd.classify_download_error(make_error(bd)) == kind
@@ -0,0 +1,75 @@
+"""从响应头取得文件大小，以及只有HEAD给出大小时按2%容差接受分块传输的下载。"""
+from asyncio import run
+from types import SimpleNamespace
+
+from aiohttp import web
+import pytest
+
+from fake_bilibili import build_payload
+
+
+@pytest.mark.parametrize('header, expected', [
+    ('bytes 0-0/1000', (0, 1000)),
+    ('bytes 500-999/1000', (500, 1000)),
+    ('bytes */1000', (0, 1000)),
+    ('bytes 0-99/*', (0, 0)),
+    (None, (0, 0)),
+    ('', (0, 0)),
+    ('garbage', (0, 0)),
+])
+def test_parse_content_range(bd, header, expected):
+    assert bd.parse_content_range(header) == expected
+
+
+@pytest.mark.parametrize('status, headers, expected', [
+    (206, {'Content-Range': 'bytes 0-0/4096'}, (0, 4096)),
+    (206, {'Content-Range': 'bytes 1024-4095/4096', 'Content-Length': '3072'}, (1024, 4096)),
+    (206, {}, (0, 0)),
+    (200, {'Content-Length': '4096'}, (0, 4096)),
+    (200, {'Transfer-Encoding': 'chunked'}, (0, 0)),
+])
+def test_response_file_size(bd, status, headers, expected):
+    assert bd.response_file_size(SimpleNamespace(status=status, headers=headers)) == expected
+
+
+# GET使用分块传输不带大小，HEAD报告的大小比实际多1%
+async def download_with_inexact_head(bd, save_path, head_size):
+    payload = build_payload(200032, seed=3, fragment_size=4096)
+
+    async def handle(request):
+        if request.method == 'HEAD':
+            return web.Response(headers={'Content-Length': str(head_size(len(payload)))})
+        response = web.StreamResponse(headers={'Content-Type': 'video/mp4'})
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+        await response.write(payload)
+        await response.write_eof()
+        return response
+
+    app = web.Application()
+    app.router.add_route('*', '/video.m4s', handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    try:
+        await bd.download_file(f'http://127.0.0.1:{port}/video.m4s', str(save_path), 'test', 1, 1, 'video',
+                               max_retries=1, retry_delay=0, verify=True)
+    finally:
+        await runner.cleanup()
+    return payload
+
+
+def test_verified_download_tolerates_inexact_head_size(bd, tmp_path):
+    save_path = tmp_path / 'video.m4s'
+    payload = run(download_with_inexact_head(bd, save_path, lambda size: size + size // 100))
+    assert save_path.read_bytes() == payload
+    record = bd.load_integrity(str(save_path))
+    assert record['complete'] and record['expected_size'] == len(payload)
+
+
+def test_verified_download_rejects_head_size_beyond_tolerance(bd, tmp_path):
+    save_path = tmp_path / 'video.m4s'
+    with pytest.raises(bd.DownloadIncompleteError):
+        run(download_with_inexact_head(bd, save_path, lambda size: size + size // 10))
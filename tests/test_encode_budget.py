@@ -0,0 +1,18 @@
+"""plan_encode_budget 自动分配时应尽量用满可用核心。"""
+import pytest
+
+
+@pytest.mark.parametrize('cores, expected', [
+    (2, (1, 1)), (5, (1, 4)), (9, (1, 8)), (10, (2, 4)), (16, (2, 7)), (17, (2, 8)), (33, (4, 8)),
+])
+def test_auto_budget_uses_available_cores(bd, monkeypatch, cores, expected):
+    monkeypatch.setattr(bd, 'usable_cpu_count', lambda: cores)
+    concurrent_ffmpeg, encode_threads = bd.plan_encode_budget(0, 0, reserved_cores=1)
+    assert (concurrent_ffmpeg, encode_threads) == expected
+    assert concurrent_ffmpeg * encode_threads <= cores - 1
+
+
+def test_explicit_settings_are_kept(bd, monkeypatch):
+    monkeypatch.setattr(bd, 'usable_cpu_count', lambda: 16)
+    assert bd.plan_encode_budget(3, 0, reserved_cores=1) == (3, 5)
+    assert bd.plan_encode_budget(0, 4, reserved_cores=1) == (3, 4)
@@ -0,0 +1,38 @@
+"""没有合成进程领取的任务在超时后撤回，由下载端改为本机合成。"""
+from asyncio import get_running_loop, run, sleep as asyncio_sleep
+from os import listdir
+
+
+def test_unclaimed_job_is_withdrawn(bd, tmp_path, monkeypatch):
+    spool = bd.EncodeSpool(str(tmp_path / 'spool'), claim_timeout=0.2)
+    monkeypatch.setattr(bd, 'encode_spool', spool)
+    merge_kwargs = {'video_file': 'v.m4s', 'audio_file': 'a.m4s', 'output_file': 'out.mp4'}
+
+    assert run(bd.spool_merge(merge_kwargs, 10)) is None
+    assert listdir(tmp_path / 'spool' / 'pending') == []
+
+
+def test_claimed_job_waits_for_worker(bd, tmp_path):
+    spool = bd.EncodeSpool(str(tmp_path / 'spool'), claim_timeout=0.2)
+    job_id = spool.enqueue({'merge': {}})
+
+    async def worker():
+        job = spool.claim('worker')
+        await asyncio_sleep(0.6)  # 执行时间超过领取超时，不应被撤回
+        spool.complete(job['job_id'], {'success': True, 'worker': 'worker'})
+
+    async def scenario():
+        task = get_running_loop().create_task(worker())
+        result = await spool.wait(job_id, poll=0.05)
+        await task
+        return result
+    assert run(scenario())['success']
+
+
+# 合成进程崩溃后租约过期，任务回到 pending 且没有其他合成进程时同样撤回
+def test_job_from_crashed_worker_is_withdrawn(bd, tmp_path):
+    spool = bd.EncodeSpool(str(tmp_path / 'spool'), lease_seconds=0, claim_timeout=0.2)
+    job_id = spool.enqueue({'merge': {}})
+    assert spool.claim('crashed')
+    assert run(spool.wait(job_id, poll=0.05)) is None
+    assert not any(listdir(tmp_path / 'spool' / state) for state in ('pending', 'claimed'))
@@ -0,0 +1,51 @@
+"""合成进程和 remerge 按任务各自的输出格式封装，不修改全局设置。"""
+from threading import Lock
+from time import sleep
+
+JOBS = {'001': ('fmp4', False), '002': ('mp4', True), '003': ('mkv', False)}
+
+
+def recording_merge(recorded, lock):
+    def merge(output_file, mux_args=None, **kwargs):
+        sleep(0.2)  # 让多个任务同时执行
+        with lock:
+            recorded[output_file] = mux_args
+        return True
+    return merge
+
+
+def test_encode_worker_uses_per_job_mux_args(bd, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(bd, 'check_ffmpeg', lambda: True)
+    recorded, lock = {}, Lock()
+    monkeypatch.setattr(bd, 'ffmpeg_merge', recording_merge(recorded, lock))
+    global_mux_args = bd.OUTPUT_MUX_ARGS
+    spool = bd.EncodeSpool(str(tmp_path / 'spool'))
+    for name, (output_format, faststart) in JOBS.items():
+        spool.enqueue({'merge': {'output_file': name, 'duration': 1},
+                       'output_format': output_format, 'faststart': faststart})
+
+    bd.run_encode_worker(str(tmp_path / 'spool'), jobs=3, poll=0.1, exit_when_idle=True)
+
+    assert recorded == {name: bd.output_mux_args(*options) for name, options in JOBS.items()}
+    assert bd.OUTPUT_MUX_ARGS == global_mux_args
+
+
+def test_remerge_uses_per_job_mux_args(bd, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(bd, 'check_ffmpeg', lambda: True)
+    recorded, lock = {}, Lock()
+    monkeypatch.setitem(bd.MERGE_FUNCTIONS, 'merge', recording_merge(recorded, lock))
+    bd.configure_workspace(bd.load_config())
+    global_mux_args = bd.OUTPUT_MUX_ARGS
+    for index, (name, (output_format, faststart)) in enumerate(JOBS.items(), 1):
+        bd.makedirs(bd.path.join(bd.QUARANTINE_DIR, name))
+        bd.write_manifest(bd.path.join(bd.QUARANTINE_DIR, name), {
+            'job_id': name, 'kind': 'merge', 'episode': {'original_index': index},
+            'merge': {'output_file': str(tmp_path / name), 'duration': 1},
+            'output_format': output_format, 'faststart': faststart,
+        })
+
+    assert bd.run_remerge(jobs=3) == 0
+    assert recorded == {str(tmp_path / name): bd.output_mux_args(*options) for name, options in JOBS.items()}
+    assert bd.OUTPUT_MUX_ARGS == global_mux_args
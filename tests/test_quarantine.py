@@ -0,0 +1,48 @@
+"""quarantine_failed_merge 在任何失败情况下都不能丢失已下载的输入。"""
+from os import listdir, path
+
+
+def make_streams(tmp_path):
+    scratch = tmp_path / 'scratch'
+    scratch.mkdir()
+    video_file = scratch / '001_video.m4s'
+    audio_file = scratch / '001_audio.m4s'
+    video_file.write_bytes(b'video')
+    audio_file.write_bytes(b'audio')
+    return {'video_file': str(video_file), 'audio_file': str(audio_file), 'output_file': str(tmp_path / '001.mp4')}
+
+
+def test_quarantine_moves_inputs_and_writes_manifest(bd, tmp_path, monkeypatch):
+    monkeypatch.setattr(bd, 'QUARANTINE_DIR', str(tmp_path / 'quarantine'))
+    merge_kwargs = make_streams(tmp_path)
+    job_dir = bd.quarantine_failed_merge('merge', merge_kwargs, {'original_index': 1})
+    assert sorted(listdir(job_dir)) == ['001_audio.m4s', '001_video.m4s', bd.QUARANTINE_MANIFEST]
+    assert not path.exists(merge_kwargs['video_file'])
+    manifest = bd.list_quarantine()[0]
+    assert manifest['merge']['video_file'] == path.join(job_dir, '001_video.m4s')
+
+
+def test_missing_input_moves_nothing(bd, tmp_path, monkeypatch):
+    monkeypatch.setattr(bd, 'QUARANTINE_DIR', str(tmp_path / 'quarantine'))
+    merge_kwargs = make_streams(tmp_path)
+    (tmp_path / 'scratch' / '001_audio.m4s').unlink()
+    assert bd.quarantine_failed_merge('merge', merge_kwargs, {'original_index': 1}) is None
+    assert path.exists(merge_kwargs['video_file'])
+    assert not path.exists(tmp_path / 'quarantine')
+
+
+def test_failed_move_restores_inputs(bd, tmp_path, monkeypatch):
+    monkeypatch.setattr(bd, 'QUARANTINE_DIR', str(tmp_path / 'quarantine'))
+    merge_kwargs = make_streams(tmp_path)
+    real_move = bd.shutil.move
+
+    def failing_move(src, dst):
+        if src.endswith('_audio.m4s'):
+            raise OSError('disk full')
+        return real_move(src, dst)
+
+    monkeypatch.setattr(bd.shutil, 'move', failing_move)
+    assert bd.quarantine_failed_merge('merge', merge_kwargs, {'original_index': 1}) is None
+    assert open(merge_kwargs['video_file'], 'rb').read() == b'video'
+    assert open(merge_kwargs['audio_file'], 'rb').read() == b'audio'
+    assert listdir(tmp_path / 'quarantine') == []
@@ -0,0 +1,37 @@
+"""多进程下载时，限流闸门和熔断器的状态在所有工作进程间共享。"""
+from time import time
+
+
+def trip(gate, breaker, host):
+    gate.backoff(10)
+    for _ in range(breaker.threshold):
+        breaker.record_failure(host)
+
+
+def test_backoff_and_breaker_are_shared_between_processes(bd):
+    context = bd.process_context()
+    manager = context.Manager()
+    try:
+        gate = bd.RateLimitGate(context)
+        breaker = bd.HostCircuitBreaker(threshold=3, cooldown=60, manager=manager)
+        worker = context.Process(target=trip, args=(gate, breaker, 'cdn.example:443'))
+        worker.start()
+        worker.join(30)
+        assert worker.exitcode == 0
+        assert gate.state[0] > time()
+        assert not breaker.allow('cdn.example:443')
+        assert breaker.allow('other.example:443')
+    finally:
+        manager.shutdown()
+
+
+def test_local_gate_and_breaker_still_work(bd):
+    gate = bd.RateLimitGate()
+    assert gate.backoff(2) > 0
+    gate.success()
+    assert gate.state[1] == 0
+    breaker = bd.HostCircuitBreaker(threshold=2, cooldown=60)
+    breaker.record_failure('a')
+    assert breaker.allow('a')
+    breaker.record_failure('a')
+    assert not breaker.allow('a')
@@ -0,0 +1,25 @@
+"""共用同一缓存目录的多个 StreamCache 实例不会丢失彼此的索引条目。"""
+
+
+def store_many(bd, root, source_dir, prefix, count):
+    cache = bd.StreamCache(root, 1024 ** 3)
+    for i in range(count):
+        source = source_dir / f'{prefix}_{i}.m4s'
+        source.write_bytes(f'{prefix}-{i}'.encode())
+        assert cache.store(f'{prefix}-{i}', str(source))
+
+
+def test_concurrent_instances_keep_all_entries(bd, tmp_path):
+    context = bd.process_context()
+    root = tmp_path / 'cache'
+    workers = [context.Process(target=store_many, args=(bd, str(root), tmp_path, f'p{n}', 30)) for n in range(3)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(60)
+        assert worker.exitcode == 0
+
+    cache = bd.StreamCache(str(root), 1024 ** 3)
+    assert len(cache.index['keys']) == 90
+    assert cache.fetch('p2-29', str(tmp_path / 'restored.m4s'))
+    assert (tmp_path / 'restored.m4s').read_bytes() == b'p2-29'
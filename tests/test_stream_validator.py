@@ -0,0 +1,92 @@
+"""StreamValidator 边下载边检查顶层box结构：完整文件、截断、box大小错误和错误页面，以及校验信息sidecar。"""
+from hashlib import sha256
+from struct import pack
+
+import pytest
+
+from fake_bilibili import build_payload
+
+
+def feed_in_chunks(validator, data, chunk_size=7):
+    for start in range(0, len(data), chunk_size):
+        validator.feed(data[start:start + chunk_size])
+
+
+def box(box_type, payload=b''):
+    return pack('>I4s', 8 + len(payload), box_type) + payload
+
+
+@pytest.fixture
+def payload():
+    return build_payload(50000, seed=1, fragment_size=4096)
+
+
+def test_valid_file(bd, payload):
+    validator = bd.StreamValidator(len(payload))
+    feed_in_chunks(validator, payload)
+    assert validator.finish() == sha256(payload).hexdigest()
+    assert validator.checkpoint[0] == len(payload)
+
+
+def test_largesize_box(bd):
+    data = box(b'ftyp', b'iso5') + pack('>I4sQ', 1, b'mdat', 16 + 100) + bytes(100)
+    validator = bd.StreamValidator(len(data))
+    feed_in_chunks(validator, data, chunk_size=5)
+    assert validator.finish() == sha256(data).hexdigest()
+
+
+def test_truncated_file_rolls_back_to_last_box(bd, payload):
+    validator = bd.StreamValidator(len(payload))
+    feed_in_chunks(validator, payload[:30000])
+    assert validator.finish() is None
+    boundary = validator.rollback()
+    assert 0 < boundary < 30000
+    # 从最后一个完整box处续传得到同样的哈希
+    feed_in_chunks(validator, payload[boundary:])
+    assert validator.finish() == sha256(payload).hexdigest()
+
+
+def test_box_beyond_end_of_file(bd):
+    data = box(b'ftyp', b'iso5') + pack('>I4s', 1000, b'mdat') + bytes(100)
+    validator = bd.StreamValidator(len(data))
+    with pytest.raises(bd.StreamCorruptError) as error:
+        validator.feed(data)
+    assert error.value.offset == 12
+
+
+def test_box_smaller_than_header(bd):
+    data = box(b'ftyp', b'iso5') + pack('>I4s', 4, b'mdat')
+    with pytest.raises(bd.StreamCorruptError) as error:
+        bd.StreamValidator().feed(data)
+    assert error.value.offset == 12
+
+
+def test_html_error_page(bd):
+    with pytest.raises(bd.StreamCorruptError, match='错误页面') as error:
+        bd.StreamValidator().feed(b'<html><body>403 Forbidden</body></html>')
+    assert error.value.offset == 0
+
+
+def test_resume_truncates_corrupt_tail(bd, payload, tmp_path):
+    probe = bd.StreamValidator(len(payload))
+    probe.feed(payload[:20000])
+    boundary = probe.checkpoint[0]
+    # 某个完整box之后写入了错误页面
+    save_path = tmp_path / 'video.m4s'
+    save_path.write_bytes(payload[:boundary] + b'<html><body>502 Bad Gateway</body></html>')
+    validator = bd.StreamValidator(len(payload))
+    assert bd.resume_validator(str(save_path), validator) == boundary
+    assert save_path.read_bytes() == payload[:boundary]
+
+
+def test_integrity_sidecar_round_trip(bd, payload, tmp_path):
+    save_path = str(tmp_path / 'video.m4s')
+    validator = bd.StreamValidator(len(payload))
+    validator.feed(payload)
+    digest = validator.finish()
+    bd.save_integrity(save_path, 'https://cdn.example.com/video.m4s?token=1', len(payload), validator, digest)
+    record = bd.load_integrity(save_path)
+    assert record['complete'] and record['sha256'] == digest
+    assert record['url'] == 'https://cdn.example.com/video.m4s'
+    assert record['verified_offset'] == len(payload)
+    assert bd.load_integrity(str(tmp_path / 'missing.m4s')) is None
@@ -0,0 +1,50 @@
+"""临时目录会在启动和结束时被清空，只能使用程序自己的目录。"""
+from configparser import ConfigParser
+
+import pytest
+
+
+@pytest.fixture
+def workspace(bd, monkeypatch):
+    for name in ('SCRATCH_DIR', 'OUTPUT_DIR', 'FAILED_DIR', 'QUARANTINE_DIR', 'KEEP_FAILED_INPUTS'):
+        monkeypatch.setattr(bd, name, getattr(bd, name))
+
+    def configure(**settings):
+        config = ConfigParser()
+        config.read_dict({'General': settings})
+        bd.configure_workspace(config)
+        return bd.SCRATCH_DIR
+    return configure
+
+
+def test_configured_scratch_uses_owned_subdirectory(bd, workspace, tmp_path):
+    scratch_root = tmp_path / 'scratch'
+    scratch_root.mkdir()
+    keep = scratch_root / 'user_file.txt'
+    keep.write_text('keep')
+    scratch_dir = workspace(output_dir=str(tmp_path / 'out'), scratch_dir=str(scratch_root))
+    assert scratch_dir == str(scratch_root / bd.SCRATCH_SUBDIR)
+
+    bd.ensure_dirs()
+    (scratch_root / bd.SCRATCH_SUBDIR / 'stream.m4s').write_bytes(b'x')
+    bd.cleanup_temp_dir()
+    assert keep.read_text() == 'keep'
+    assert not (scratch_root / bd.SCRATCH_SUBDIR / 'stream.m4s').exists()
+
+
+@pytest.mark.parametrize('scratch, cache', [
+    ('.', ''),                 # 输出目录的上级
+    ('out/sub', ''),           # 输出目录之下
+    ('cache/tmp', 'cache'),    # 缓存目录之下
+    ('shared', 'shared/cache'),  # 缓存目录的上级
+])
+def test_scratch_overlapping_output_or_cache_falls_back(bd, workspace, tmp_path, monkeypatch, scratch, cache):
+    monkeypatch.chdir(tmp_path)
+    scratch_dir = workspace(output_dir='out', scratch_dir=scratch, cache_dir=cache)
+    assert scratch_dir == bd.path.join('out', 'temp')
+
+
+def test_scratch_containing_other_directories_is_rejected(bd, workspace, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with pytest.raises(Exception, match='临时目录'):
+        workspace(output_dir='out', deferred_queue_dir='out/temp/queue')